@@ -8,16 +8,27 @@ python -c "import wbia_cnn"
 from __future__ import absolute_import, division, print_function, unicode_literals
 from wbia_cnn import models
 from wbia_cnn import _plugin_grabmodels as grabmodels
+from wbia_cnn import _plugin_registry as registry
+from wbia_cnn import inference_service
 import utool as ut
 import six
 import numpy as np
-import random
 import os
+import threading
 import wbia.constants as const
 from six.moves import zip, range
 
 print, rrr, profile = ut.inject2(__name__)
 
+# Run the background models once on whole chips instead of on patches
+USE_FCN_BACKGROUND = ut.get_argflag('--fcn-background')
+# Whole chips are padded up to a multiple of this so chips of similar size
+# share one compiled predict function
+FCN_BUCKET_SIZE = ut.get_argval('--fcn-bucket', type_=int, default=64)
+# Compiled whole-chip predict functions kept per model
+FCN_MAX_FUNCS = 16
+# Guards the creation of the per-model locks of get_fcn_predict_func
+_FCN_LOCK = threading.Lock()
 
 try:
     from wbia.control.controller_inject import make_ibs_register_decorator
@@ -95,7 +106,6 @@ def generate_thumbnail_class_list(
 
     # Load chips and resize to the target
     data_shape = (192, 192, 3)
-    batch_size = None
     # Define model and load weights
     print('\n[wbia_cnn] Loading model...')
     if nInput is None:
@@ -108,8 +118,6 @@ def generate_thumbnail_class_list(
             thumbnail_list = list(thumbnail_list)
             nInput = len(thumbnail_list)
 
-    model = models.ClassifierModel(batch_size=batch_size, data_shape=data_shape)
-
     if classifier_weight_filepath in [None, 'v3_zebra']:
         weights_path = grabmodels.ensure_model('classifier_v3_zebra', redownload=False)
     elif classifier_weight_filepath in ['coco_zebra']:
@@ -171,29 +179,12 @@ def generate_thumbnail_class_list(
     else:
         raise ValueError('Classifier does not have a valid trained model')
 
-    model_state_fpath = model.get_model_state_fpath(fpath=weights_path)
-    print('[model] loading model state from: %s' % (model_state_fpath,))
-    model_state = ut.load_cPkl(model_state_fpath)
-
-    model.encoder = model_state.get('encoder', None)
-    model.output_dims = model_state['output_dims']
-    model.data_params = model_state['data_params']
-    model._fix_center_mean_std()
-
-    model.init_arch()
-    model.batch_size = 128
-    model.hyperparams['whiten_on'] = True
-    model.best_results = model_state['best_results']
-    model.set_all_param_values(model.best_results['weights'])
-
-    # Create the Theano primitives
-    # create theano symbolic expressions that define the network
-    print('\n[wbia_cnn] --- COMPILING SYMBOLIC THEANO FUNCTIONS ---')
-    print('[model] creating Theano primitives...')
-    theano_predict = model.build_predict_func()
+    # Reuse the warm model (and its compiled predict function) if loaded
+    model = registry.get_plugin_model(models.ClassifierModel, weights_path, data_shape)
 
     print('[wbia_cnn] Performing inference...')
-    test_results = model.process_batch(theano_predict, np.array(thumbnail_list))
+    # Concurrent callers share batches when the service is enabled
+    test_results = inference_service.predict_outputs(model, np.array(thumbnail_list))
 
     prediction_list = model.encoder.inverse_transform(test_results['predictions'])
     confidence_list = test_results['confidences']
@@ -209,7 +200,6 @@ def generate_thumbnail_class2_list(
 
     # Load chips and resize to the target
     data_shape = (192, 192, 3)
-    batch_size = None
     # Define model and load weights
     print('\n[wbia_cnn] Loading model...')
     if nInput is None:
@@ -222,8 +212,6 @@ def generate_thumbnail_class2_list(
             thumbnail_list = list(thumbnail_list)
             nInput = len(thumbnail_list)
 
-    model = models.Classifier2Model(batch_size=batch_size, data_shape=data_shape)
-
     if classifier_two_weight_filepath in [None, 'v3']:
         weights_path = grabmodels.ensure_model('classifier2_v3', redownload=False)
     elif classifier_two_weight_filepath in ['candidacy']:
@@ -235,30 +223,12 @@ def generate_thumbnail_class2_list(
     else:
         raise ValueError('Classifier does not have a valid trained model')
 
-    model_state_fpath = model.get_model_state_fpath(fpath=weights_path)
-    print('[model] loading model state from: %s' % (model_state_fpath,))
-    model_state = ut.load_cPkl(model_state_fpath)
-
-    category_list = model_state['category_list']
-    model.encoder = model_state.get('encoder', None)
-    model.output_dims = model_state['output_dims']
-    model.data_params = model_state['data_params']
-    model._fix_center_mean_std()
-
-    model.init_arch()
-    model.batch_size = 128
-    model.hyperparams['whiten_on'] = True
-    model.best_results = model_state['best_results']
-    model.set_all_param_values(model.best_results['weights'])
-
-    # Create the Theano primitives
-    # create theano symbolic expressions that define the network
-    print('\n[wbia_cnn] --- COMPILING SYMBOLIC THEANO FUNCTIONS ---')
-    print('[model] creating Theano primitives...')
-    theano_predict = model.build_predict_func()
+    # Reuse the warm model (and its compiled predict function) if loaded
+    model = registry.get_plugin_model(models.Classifier2Model, weights_path, data_shape)
+    category_list = model.category_list
 
     print('[wbia_cnn] Performing inference...')
-    test_results = model.process_batch(theano_predict, np.array(thumbnail_list))
+    test_results = inference_service.predict_outputs(model, np.array(thumbnail_list))
 
     confidences_list = test_results['confidences']
     confidences_list[confidences_list > 1.0] = 1.0
@@ -299,7 +269,6 @@ def generate_thumbnail_aoi2_list(
 ):
     # Load chips and resize to the target
     data_shape = (192, 192, 4)
-    batch_size = None
     # Define model and load weights
     print('\n[wbia_cnn] Loading model...')
     if nInput is None:
@@ -312,8 +281,6 @@ def generate_thumbnail_aoi2_list(
             thumbnail_list = list(thumbnail_list)
             nInput = len(thumbnail_list)
 
-    model = models.AoI2Model(batch_size=batch_size, data_shape=data_shape)
-
     if aoi_two_weight_filepath in [None, 'candidacy']:
         weights_path = grabmodels.ensure_model('aoi2_candidacy', redownload=False)
     elif aoi_two_weight_filepath in ['ggr2']:
@@ -327,26 +294,8 @@ def generate_thumbnail_aoi2_list(
     else:
         raise ValueError('AoI2 does not have a valid trained model')
 
-    model_state_fpath = model.get_model_state_fpath(fpath=weights_path)
-    print('[model] loading model state from: %s' % (model_state_fpath,))
-    model_state = ut.load_cPkl(model_state_fpath)
-
-    model.encoder = model_state.get('encoder', None)
-    model.output_dims = model_state['output_dims']
-    model.data_params = model_state['data_params']
-    model._fix_center_mean_std()
-
-    model.init_arch()
-    model.batch_size = 128
-    model.hyperparams['whiten_on'] = True
-    model.best_results = model_state['best_results']
-    model.set_all_param_values(model.best_results['weights'])
-
-    # Create the Theano primitives
-    # create theano symbolic expressions that define the network
-    print('\n[wbia_cnn] --- COMPILING SYMBOLIC THEANO FUNCTIONS ---')
-    print('[model] creating Theano primitives...')
-    theano_predict = model.build_predict_func()
+    # Reuse the warm model (and its compiled predict function) if loaded
+    model = registry.get_plugin_model(models.AoI2Model, weights_path, data_shape)
 
     mask = np.zeros((192, 192, 1), dtype=np.uint8)
     data_list = []
@@ -367,7 +316,7 @@ def generate_thumbnail_aoi2_list(
         data_list.append(data)
 
     print('[wbia_cnn] Performing inference...')
-    test_results = model.process_batch(theano_predict, np.array(data_list))
+    test_results = inference_service.predict_outputs(model, np.array(data_list))
 
     confidence_list = test_results['confidences']
     prediction_list = test_results['predictions']
@@ -386,7 +335,6 @@ def generate_chip_label_list(
 
     # Load chips and resize to the target
     data_shape = (128, 128, 3)
-    batch_size = None
     # Define model and load weights
     print('\n[wbia_cnn] Loading model...')
     if nInput is None:
@@ -399,8 +347,6 @@ def generate_chip_label_list(
             chip_list = list(chip_list)
             nInput = len(chip_list)
 
-    model = models.LabelerModel(batch_size=batch_size, data_shape=data_shape)
-
     if labeler_weight_filepath in [None, 'v3']:
         weights_path = grabmodels.ensure_model('labeler_v3', redownload=False)
     elif labeler_weight_filepath in ['v1']:
@@ -424,30 +370,11 @@ def generate_chip_label_list(
     else:
         raise ValueError('Labeler does not have a valid trained model')
 
-    model_state_fpath = model.get_model_state_fpath(fpath=weights_path)
-    print('[model] loading model state from: %s' % (model_state_fpath,))
-    model_state = ut.load_cPkl(model_state_fpath)
-
-    model.encoder = model_state.get('encoder', None)
-    model.output_dims = model_state['output_dims']
-    model.data_params = model_state['data_params']
-    model._fix_center_mean_std()
-
-    model.best_results = model_state['best_results']
-
-    model.init_arch()
-    model.batch_size = 128
-    model.hyperparams['whiten_on'] = True
-    model.set_all_param_values(model.best_results['weights'])
-
-    # Create the Theano primitives
-    # create theano symbolic expressions that define the network
-    print('\n[wbia_cnn] --- COMPILING SYMBOLIC THEANO FUNCTIONS ---')
-    print('[model] creating Theano primitives...')
-    theano_predict = model.build_predict_func()
+    # Reuse the warm model (and its compiled predict function) if loaded
+    model = registry.get_plugin_model(models.LabelerModel, weights_path, data_shape)
 
     print('[wbia_cnn] Performing inference...')
-    test_results = model.process_batch(theano_predict, np.array(chip_list))
+    test_results = inference_service.predict_outputs(model, np.array(chip_list))
 
     class_list = list(model.encoder.classes_)
     prediction_list = model.encoder.inverse_transform(test_results['predictions'])
@@ -540,14 +467,30 @@ def detect_annot_whale_fluke_background_mask(
 
 
 @register_ibs_method
-def generate_species_background_mask(ibs, chip_fpath_list, species=None):
+def generate_species_background_mask(
+    ibs,
+    chip_fpath_list,
+    species=None,
+    num_workers=None,
+    max_prefetch=None,
+    use_processes=False,
+):
     r"""
+    Chips are decoded by a pool of background workers while the network runs,
+    at most max_prefetch decoded chips wait in memory at any time, and masks
+    are lazily generated in input order.
+
     Args:
         ibs (IBEISController):  ibeis controller object
-        aid_list (int):  list of annotation ids
+        chip_fpath_list (list):  list of chip file paths
+        species (str):  species of the background model
+        num_workers (int): number of decode workers (default = 4)
+        max_prefetch (int): maximum number of decoded chips waiting for
+            inference (default = 64)
+        use_processes (bool): decode in processes instead of threads
 
     Returns:
-        list: species_viewpoint_list
+        generator: mask_gen
 
     CommandLine:
         python -m wbia_cnn._plugin --exec-generate_species_background_mask --show --db PZ_Master1
@@ -580,27 +523,44 @@ def generate_species_background_mask(ibs, chip_fpath_list, species=None):
     # Read the data
     print('\n[wbia_cnn] Loading chips...')
     import vtool as vt
+    from wbia_cnn import utils
 
-    nInput = len(chip_fpath_list)
-
-    def bufgen2(_iter, size=64, nInput=None, **kwargs):
-        nTotal = None if nInput is None else int(np.ceil(nInput / size))
-        chunk_iter = ut.ichunks(_iter, size)
-        chunk_iter_ = ut.ProgressIter(chunk_iter, nTotal=nTotal, **kwargs)
-        for chunk in chunk_iter_:
-            for item in chunk:
-                yield item
+    if num_workers is None:
+        num_workers = ut.get_argval('--decode-workers', type_=int, default=4)
+    if max_prefetch is None:
+        max_prefetch = ut.get_argval('--decode-prefetch', type_=int, default=64)
 
-    chip_list = bufgen2(
-        (vt.imread(fpath) for fpath in chip_fpath_list),
-        lbl='loading chip chunk',
-        nInput=nInput,
-        adjust=True,
-        time_thresh=30.0,
+    nInput = len(chip_fpath_list)
+    chip_iter = utils.PrefetchIter(
+        vt.imread,
+        chip_fpath_list,
+        num_workers=num_workers,
+        max_prefetch=max_prefetch,
+        use_processes=use_processes,
     )
     # mask_list = list(generate_species_background(ibs, chip_list, species=species, nInput=nInput))
-    mask_gen = generate_species_background(ibs, chip_list, species=species, nInput=nInput)
-    return mask_gen
+    mask_gen = generate_species_background(ibs, chip_iter, species=species, nInput=nInput)
+
+    def _timed_mask_gen():
+        # Time spent inside mask_gen is inference plus waiting on decode
+        import time
+
+        total_time = 0.0
+        while True:
+            start = time.time()
+            try:
+                mask = six.next(mask_gen)
+            except StopIteration:
+                break
+            finally:
+                total_time += time.time() - start
+            yield mask
+        infer_time = total_time - chip_iter.wait_time
+        print('[wbia_cnn] background mask timings:')
+        print('[wbia_cnn]     decode: %s' % (chip_iter.timing_str(),))
+        print('[wbia_cnn]     inference: %.2fs' % (infer_time,))
+
+    return _timed_mask_gen()
 
 
 @register_ibs_method
@@ -667,12 +627,10 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
             chip_list = list(chip_list)
             nInput = len(chip_list)
 
-    # batch_size = int(min(128, 2 ** np.floor(np.log2(nInput))))
-    batch_size = None
-
     LEGACY = True
     NEW = True
     confidence_thresh = 0.5
+    model_kw = {}
     print(species)
 
     candidacy_species_list = [
@@ -709,7 +667,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
 
         LEGACY = False
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_candidacy_' + species, redownload=False
         )
@@ -722,16 +679,13 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
                 'zebra_grevys',
                 'equus_grevyi',
             ]
-            model = models.BackgroundModel(
-                batch_size=batch_size, data_shape=data_shape, num_output=3
-            )
+            model_kw = {'num_output': 3}
             weights_path = grabmodels.ensure_model(
                 'background_zebra_plains_grevys', redownload=False
             )
             canvas_key = species
         else:
             assert species in ['zebra_plains', 'equus_quagga']
-            model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
             weights_path = grabmodels.ensure_model(
                 'background_zebra_plains', redownload=False
             )
@@ -740,13 +694,11 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'zebra_mountain'  # Misspelled from zebra_mountain during training
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_zebra_mountain_v0', redownload=False
         )
         canvas_key = 1
     elif species in ['giraffe_masai', 'giraffa_tippelskirchi']:
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_giraffe_masai', redownload=False
         )
@@ -760,7 +712,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'whale_fluke'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_candidacy_whale_fluke', redownload=False
         )
@@ -773,21 +724,18 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'lynx'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model('background_lynx_v3', redownload=False)
         canvas_key = 1
     elif species in ['cheetah', 'acinonyx_jubatus']:
         LEGACY = False
         species = 'cheetah'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model('background_cheetah_v1', redownload=False)
         canvas_key = 1
     elif species in ['jaguar', 'panthera_onca']:
         LEGACY = False
         species = 'jaguar'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model('background_jaguar_v2', redownload=False)
         canvas_key = 1
     elif species in [
@@ -799,14 +747,12 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'manta'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model('background_manta', redownload=False)
         canvas_key = 1
     elif species in ['skunk_spotted', 'spilogale_gracilis']:
         LEGACY = False
         species = 'skunk_spotted'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_skunk_spotted_v1', redownload=False
         )
@@ -815,7 +761,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'right_whale_head'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_right_whale_head_v0', redownload=False
         )
@@ -829,14 +774,12 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'whale_orca'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model('background_orca_v0', redownload=False)
         canvas_key = 1
     elif species in ['seadragon_leafy', 'phycodurus_eques']:
         LEGACY = False
         species = 'seadragon_leafy'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_seadragon_leafy_v1', redownload=False
         )
@@ -845,7 +788,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'seadragon_weedy'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_seadragon_weedy_v1', redownload=False
         )
@@ -854,7 +796,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'seadragon_leafy+head'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_seadragon_leafy_head_v1', redownload=False
         )
@@ -863,7 +804,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'seadragon_weedy+head'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_seadragon_weedy_head_v1', redownload=False
         )
@@ -926,14 +866,12 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'turtle_sea'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model('background_iot_v0', redownload=False)
         canvas_key = 1
     elif species in ['dolphin_spotted', 'stenella_frontalis']:
         LEGACY = False
         species = 'dolphin_spotted'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_dolphin_spotted', redownload=False
         )
@@ -942,7 +880,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'leopard'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model('background_leopard_v0', redownload=False)
         canvas_key = 1
     elif species in [
@@ -957,7 +894,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'wild_dog'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model('background_wilddog_v0', redownload=False)
         canvas_key = 1
     elif species in [
@@ -969,7 +905,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'dolphin_spotted+fin_dorsal'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_dolphin_spotted_fin_dorsal', redownload=False
         )
@@ -978,7 +913,6 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         LEGACY = False
         species = 'whale_humpback+fin_dorsal'
         confidence_thresh = 0.2
-        model = models.BackgroundModel(batch_size=batch_size, data_shape=data_shape)
         weights_path = grabmodels.ensure_model(
             'background_humpback_dorsal', redownload=False
         )
@@ -986,32 +920,15 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
     else:
         raise ValueError('species %r key does not have a trained model' % (species,))
 
-    if LEGACY:
-        old_weights_fpath = weights_path
-        model.load_old_weights_kw2(old_weights_fpath)
-    else:
-        model_state_fpath = model.get_model_state_fpath(fpath=weights_path)
-        print('[model] loading model state from: %s' % (model_state_fpath,))
-        model_state = ut.load_cPkl(model_state_fpath)
-
-        model.output_dims = model_state['output_dims']
-        model.data_params = model_state['data_params']
-        model._fix_center_mean_std()
-
-        model.best_results = model_state['best_results']
-
-        model.init_arch()
-        model.batch_size = 128
-        model.data_params['center_mean'] = np.mean(model.data_params['center_mean'])
-        model.data_params['center_std'] = np.mean(model.data_params['center_std'])
-        model.hyperparams['whiten_on'] = True
-        model.set_all_param_values(model.best_results['weights'])
-
-    # Create the Theano primitives
-    # create theano symbolic expressions that define the network
-    print('\n[wbia_cnn] --- COMPILING SYMBOLIC THEANO FUNCTIONS ---')
-    print('[model] creating Theano primitives...')
-    model.build_predict_func()
+    # Reuse the warm model (and its compiled predict function) if loaded
+    model = registry.get_plugin_model(
+        models.BackgroundModel,
+        weights_path,
+        data_shape,
+        loader='legacy2' if LEGACY else 'state',
+        mean_center=not LEGACY,
+        **model_kw
+    )
 
     print('[wbia_cnn] Performing inference...')
 
@@ -1023,28 +940,294 @@ def generate_species_background(ibs, chip_list, species=None, nInput=None):
         freq=10,
         time_thresh=30.0,
     )
-    for chip in _iter:
-        try:
-            if LEGACY:
-                samples, canvas_dict = test_convolutional(
-                    model, chip, padding=24, confidence_thresh=confidence_thresh
-                )
-            else:
-                samples, canvas_dict = test_convolutional(
-                    model, chip, padding=25, confidence_thresh=confidence_thresh
-                )
+    padding = 24 if LEGACY else 25
+    if USE_FCN_BACKGROUND:
+        result_iter = (
+            test_fully_convolutional(
+                model, chip, padding=padding, confidence_thresh=confidence_thresh
+            )
+            for chip in _iter
+        )
+    else:
+        # Patches from consecutive chips are packed into full batches
+        result_iter = test_convolutional_batched(
+            model,
+            _iter,
+            padding=padding,
+            confidence_thresh=confidence_thresh,
+        )
+    try:
+        for samples, canvas_dict in result_iter:
             if NEW and LEGACY:
                 mask = np.maximum(255 - canvas_dict['negative'], canvas_dict[canvas_key])
             else:
                 mask = canvas_dict[canvas_key]
-        except Exception as ex:
-            ut.printex(
-                ex,
-                ('Error running convnet with ' 'chip.shape=%r, chip.dtype=%r')
-                % (chip.shape, chip.dtype),
+            yield mask
+    except Exception as ex:
+        ut.printex(ex, 'Error running convnet on chip batch')
+        raise
+
+
+def _resize_target(image, target_height=None, target_width=None):
+    import cv2
+
+    assert target_height is not None or target_width is not None
+    height, width = image.shape[:2]
+    if target_height is not None and target_width is not None:
+        h = target_height
+        w = target_width
+    elif target_height is not None:
+        h = target_height
+        w = (width / height) * h
+    elif target_width is not None:
+        w = target_width
+        h = (height / width) * w
+    w, h = int(w), int(h)
+    return cv2.resize(image, (w, h), interpolation=cv2.INTER_LANCZOS4)
+
+
+def _convolutional_resize(image):
+    """
+    Upsizes images whose short side is below 256. Returns the image and its
+    original shape (None if it was not resized).
+    """
+    h, w = image.shape[:2]
+    original_shape = None
+    if h < w and h < 256:
+        original_shape = image.shape
+        image = _resize_target(image, target_height=256)
+    if w < h and w < 256:
+        original_shape = image.shape
+        image = _resize_target(image, target_width=256)
+    return image, original_shape
+
+
+def _convolutional_prepare(model, image, patch_size='auto', stride='auto', padding=32):
+    """
+    Extracts the mirror-padded patches of an image for convolutional
+    inference.
+
+    Returns:
+        dict: record with the keys shape (the working height and width),
+            original_shape (None if the image was not resized), coord_list, and
+            patches (an N x H x W x C array of padded patches)
+    """
+    from wbia_cnn import utils
+
+    image, original_shape = _convolutional_resize(image)
+    h, w = image.shape[:2]
+
+    # GLOBAL_LIMIT = min(256, w, h)
+    # HACK, this only works for square data shapes
+    GLOBAL_LIMIT = model.data_shape[0]
+    # Inference
+    if patch_size == 'auto':
+        patch_size = (GLOBAL_LIMIT - 2 * padding, GLOBAL_LIMIT - 2 * padding)
+    if stride == 'auto':
+        psx, psy = patch_size
+        stride = (psx - padding, psy - padding)
+    data_list, coord_list = utils.extract_patches_stride(image, patch_size, stride)
+
+    # Augment the data_list by adding a reflected pad to every patch at once
+    patches = np.array(data_list)
+    pad_width = [(0, 0), (padding, padding), (padding, padding)]
+    pad_width += [(0, 0)] * (patches.ndim - 3)
+    patches = np.pad(patches, pad_width, 'reflect', reflect_type='even')
+
+    record = {
+        'shape': (h, w),
+        'original_shape': original_shape,
+        'coord_list': coord_list,
+        'patches': patches,
+    }
+    return record
+
+
+def _convolutional_labels(model):
+    """ Get all of the labels for the data, inheritted from the model """
+    if model.encoder is not None:
+        # python2 backwards compatibility
+        if isinstance(model.encoder.classes_, np.ndarray):
+            label_list_ = model.encoder.classes_.tolist()
+        else:
+            label_list_ = list(model.encoder.classes_)
+        label_list_ = list(
+            map(
+                lambda x: x if isinstance(x, six.text_type) else x.decode('utf-8'),
+                label_list_,
+            )
+        )
+    else:
+        label_list_ = list(range(model.output_dims))
+    return label_list_
+
+
+def _convolutional_decode(model, test_results):
+    """ Returns the per-patch labels and confidences of a predict batch """
+    if model.encoder is not None:
+        labeled_predictions = model.encoder.inverse_transform(test_results['predictions'])
+    else:
+        labeled_predictions = test_results['predictions']
+    return list(labeled_predictions), list(test_results['confidences'])
+
+
+def _convolutional_fresh_corners(coord_list):
+    """
+    For every patch, returns the top left corner (x, y) of the part of the
+    patch that no earlier patch covers. Patches from
+    :func:`utils.extract_patches_stride` are in row-major order, so earlier
+    patches only overlap a strip along the top (previous rows) and a strip
+    along the left (same row). Patches that break this layout get their own
+    top left corner, i.e. the whole patch is treated as overlapped.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn._plugin import *  # NOQA
+        >>> coord_list = [(0, 0, 4, 4), (3, 0, 7, 4), (0, 3, 4, 7), (3, 3, 7, 7)]
+        >>> print(_convolutional_fresh_corners(coord_list).tolist())
+        [[0, 0], [4, 0], [0, 4], [4, 4]]
+    """
+    coords = np.asarray(coord_list).reshape(-1, 4)
+    x1, y1, x2, y2 = coords.T
+    overlap = (
+        (x1[:, None] < x2[None, :])
+        & (x1[None, :] < x2[:, None])
+        & (y1[:, None] < y2[None, :])
+        & (y1[None, :] < y2[:, None])
+    )
+    # Only consider earlier patches
+    overlap &= np.tri(len(coords), k=-1, dtype=bool)
+    above = overlap & (y1[None, :] < y1[:, None])
+    left = overlap & (y1[None, :] == y1[:, None]) & (x1[None, :] < x1[:, None])
+    is_regular = np.all(overlap == (above | left), axis=1)
+    ytop = np.where(above, y2[None, :], y1[:, None]).max(axis=1)
+    xleft = np.where(left, x2[None, :], x1[:, None]).max(axis=1)
+    ytop = np.where(is_regular, np.minimum(ytop, y2), y1)
+    xleft = np.where(is_regular, np.minimum(xleft, x2), x1)
+    corners = np.vstack([xleft, ytop]).T
+    # Irregular patches are blended everywhere
+    corners[~is_regular] = coords[~is_regular, 0:2]
+    return corners
+
+
+def _convolutional_reconstruct(
+    model, record, label_list, confidence_list, confidence_thresh=0.5
+):
+    """
+    Builds the response map canvases of an image from its patch predictions
+
+    The responses of every patch for every label are flipped, thresholded and
+    scaled in a single array operation. The canvases of all labels live in one
+    preallocated (h, w, num_labels) buffer, so each patch is resized and
+    written once for all labels (instead of once per label), and the blur and
+    uint8 cast run once over the whole buffer.
+
+    Blending is unchanged: a patch response is copied where the canvas is
+    still zero and averaged 50/50 with the canvas elsewhere, in patch order.
+    Only the strips that earlier patches overlap (see
+    :func:`_convolutional_fresh_corners`) need the blend; the rest of a patch
+    is a plain copy.
+
+    Tolerance:
+        The buffer is float32 (the former per-label canvases were float64), so
+        a pixel whose value lands on a rounding boundary may differ by 1 from
+        the former per-label, per-patch loop. Every other pixel is identical
+        (on random 3-label responses about 2 pixels per million differed).
+    """
+    import cv2
+
+    h, w = record['shape']
+    coord_list = record['coord_list']
+    responses = _convolutional_responses(
+        model, label_list, confidence_list, confidence_thresh=confidence_thresh
+    )
+    num_labels = responses.shape[-1]
+
+    def _blend(current, mask):
+        # Where the current canvas is zero, make it mask, otherwise average
+        # the current with the mask, which address overlapping areas
+        flags = current == 0
+        current *= 0.5
+        current += 0.5 * mask
+        current[flags] = mask[flags]
+
+    # We want float precision
+    canvas = np.zeros((h, w, num_labels), dtype=np.float32)
+    corners = _convolutional_fresh_corners(coord_list)
+    # Construct the canvases using the forward inference results
+    for response, coord, corner in zip(responses, coord_list, corners):
+        x1, y1, x2, y2 = coord
+        fx, fy = corner
+        # Blow up canvas (cv2 resizes each label channel independently)
+        mask = cv2.resize(response, (x2 - x1, y2 - y1))
+        mask = mask.reshape(y2 - y1, x2 - x1, num_labels)
+        # Overlapped top and left strips
+        _blend(canvas[y1:fy, x1:x2], mask[: fy - y1])
+        _blend(canvas[fy:y2, x1:fx], mask[fy - y1 :, : fx - x1])
+        # Nothing has been written to the rest yet
+        canvas[fy:y2, fx:x2] = mask[fy - y1 :, fx - x1 :]
+    return _convolutional_finalize(model, record, canvas)
+
+
+def _convolutional_responses(model, label_list, confidence_list, confidence_thresh=0.5):
+    """
+    Returns the thresholded 0-255 response of every patch for every label as
+    a num x h' x w' x num_labels array
+    """
+    label_list_ = _convolutional_labels(model)
+    confidences = np.asarray(confidence_list)
+    labels = np.asarray(label_list)
+    if labels.ndim < confidences.ndim:
+        labels = labels.reshape(labels.shape + (1,) * (confidences.ndim - labels.ndim))
+
+    # Responses of every patch for every label: num x h' x w' x num_labels
+    response_list = []
+    for label in label_list_:
+        if isinstance(label, six.text_type):
+            # fix for python3, can't compare numpy byte arrays with
+            # unicode.
+            label2_ = label.encode('utf-8')
+        else:
+            label2_ = label
+        # Get label and apply to confidence
+        flip_index = labels != label2_
+        response = np.where(flip_index, 1.0 - confidences, confidences)
+        response = response.astype(confidences.dtype, copy=False)
+        response[response <= confidence_thresh] = 0
+        response *= 255.0
+        response_list.append(response)
+    responses = np.stack(response_list, axis=-1)
+    return responses
+
+
+def _convolutional_finalize(model, record, canvas):
+    """
+    Blurs the float (h, w, num_labels) canvas, casts it to uint8, and splits
+    it into per-label canvases at the original image size
+    """
+    import cv2
+
+    h, w = record['shape']
+    label_list_ = _convolutional_labels(model)
+    num_labels = len(label_list_)
+    # Blur
+    # FIXME: Should this postprocessing step applied here?
+    # There is postprocessing in ibeis/algos/preproc/preproc_probchip.py
+    ksize = 3
+    kernel = (ksize, ksize)
+    canvas = cv2.blur(canvas, kernel).reshape(h, w, num_labels)
+    # Cast all images to uint8
+    canvas = np.rint(canvas, out=canvas).astype(np.uint8)
+    original_shape = record['original_shape']
+    canvas_dict = {}
+    for index, label in enumerate(label_list_):
+        canvas_ = np.ascontiguousarray(canvas[:, :, index])
+        if original_shape is not None:
+            canvas_ = _resize_target(
+                canvas_, target_height=original_shape[0], target_width=original_shape[1]
             )
-            raise
-        yield mask
+        canvas_dict[label] = canvas_
+    return canvas_dict
 
 
 def test_convolutional(
@@ -1073,7 +1256,8 @@ def test_convolutional(
     border of each patch and add an additional amount of padding to cater to the
     architecture's receptive field reduction.
 
-    See :func:`utils.extract_patches_stride` for patch extraction behavior.
+    See :func:`utils.extract_patches_stride` for patch extraction behavior and
+    :func:`test_convolutional_batched` to process many images at once.
 
     Args:
         model (Model): the network to use to perform feedforward inference
@@ -1096,68 +1280,15 @@ def test_convolutional(
             maps themselves as a dictionary.  The dictionary uses the class
             labels as the strings and the numpy array image as the values.
     """
-    from wbia_cnn import utils
-    import cv2
-
-    def _add_pad(data_):
-        if len(data_.shape) == 2:
-            data_padded = np.pad(data_, padding, 'reflect', reflect_type='even')
-        else:
-            h, w, c = data_.shape
-            data_padded = np.dstack(
-                [
-                    np.pad(data_[:, :, _], padding, 'reflect', reflect_type='even')
-                    for _ in range(c)
-                ]
-            )
-        return data_padded
-
-    def _resize_target(image, target_height=None, target_width=None):
-        import cv2
-
-        assert target_height is not None or target_width is not None
-        height, width = image.shape[:2]
-        if target_height is not None and target_width is not None:
-            h = target_height
-            w = target_width
-        elif target_height is not None:
-            h = target_height
-            w = (width / height) * h
-        elif target_width is not None:
-            w = target_width
-            h = (height / width) * w
-        w, h = int(w), int(h)
-        return cv2.resize(image, (w, h), interpolation=cv2.INTER_LANCZOS4)
-
     if verbose:
         # Start timer
         tt = ut.tic()
         print('[harness] Loading the testing data (convolutional)...')
-    # Try to get the image's shape
-    h, w = image.shape[:2]
-
-    original_shape = None
-    if h < w and h < 256:
-        original_shape = image.shape
-        image = _resize_target(image, target_height=256)
-    if w < h and w < 256:
-        original_shape = image.shape
-        image = _resize_target(image, target_width=256)
-
-    h, w = image.shape[:2]
-
-    # GLOBAL_LIMIT = min(256, w, h)
-    # HACK, this only works for square data shapes
-    GLOBAL_LIMIT = model.data_shape[0]
-    # Inference
-    if patch_size == 'auto':
-        patch_size = (GLOBAL_LIMIT - 2 * padding, GLOBAL_LIMIT - 2 * padding)
-    if stride == 'auto':
-        psx, psy = patch_size
-        stride = (psx - padding, psy - padding)
-    _tup = utils.extract_patches_stride(image, patch_size, stride)
-    data_list, coord_list = _tup
-    samples = len(data_list)
+    record = _convolutional_prepare(
+        model, image, patch_size=patch_size, stride=stride, padding=padding
+    )
+    data_list_ = record['patches']
+    samples = len(data_list_)
     if batch_size is None:
         batch_size = samples
     start = 0
@@ -1167,107 +1298,18 @@ def test_convolutional(
     theano_predict = model.build_predict_func()
     while start < samples:
         end = min(samples, start + batch_size)
-        data_list_segment = data_list[start:end]
-        # coord_list_segment = coord_list[start: end]
-
-        # Augment the data_list by adding a reflected pad
-        data_list_ = np.array([_add_pad(data_) for data_ in data_list_segment])
-
-        # batchiter_kw = dict(
-        #    fix_output=False,
-        #    showprog=True,
-        #    spatial=True
-        # )
-        # test_results = model._predict(data_list_)
-        test_results = model.process_batch(theano_predict, data_list_, unwrap=False)
-        # test_results2 = batch.process_batch(model, data_list_, None,
-        #                                   theano_predict, **batchiter_kw)
-        # label_list.extend(test_results['labeled_predictions'])
-        if model.encoder is not None:
-            labeled_predictions = model.encoder.inverse_transform(
-                test_results['predictions']
-            )
-        else:
-            labeled_predictions = test_results['predictions']
+        data_list_segment = data_list_[start:end]
+        test_results = model.process_batch(
+            theano_predict, data_list_segment, unwrap=False
+        )
+        labeled_predictions, confidences = _convolutional_decode(model, test_results)
         label_list.extend(labeled_predictions)
-        confidence_list.extend(test_results['confidences'])
+        confidence_list.extend(confidences)
         start += batch_size
 
-    # Get all of the labels for the data, inheritted from the model
-    if model.encoder is not None:
-        # python2 backwards compatibility
-        if isinstance(model.encoder.classes_, np.ndarray):
-            label_list_ = model.encoder.classes_.tolist()
-        else:
-            label_list_ = list(model.encoder.classes_)
-        label_list_ = list(
-            map(
-                lambda x: x if isinstance(x, six.text_type) else x.decode('utf-8'),
-                label_list_,
-            )
-        )
-    else:
-        label_list_ = list(range(model.output_dims))
-    # Create a dictionary of canvases
-    canvas_dict = {}
-    for label in label_list_:
-        canvas_dict[label] = np.zeros((h, w))  # We want float precision
-    # Construct the canvases using the forward inference results
-    label_list_ = label_list_[::-1]
-    # print('[harness] Labels: %r' %(label_list_, ))
-    zipped = list(zip(data_list, coord_list, label_list, confidence_list))
-    for label in label_list_:
-        for data, coord, label_, confidence in zipped:
-            x1, y1, x2, y2 = coord
-            # Get label and apply to confidence
-            confidence_ = np.copy(confidence)
-
-            # OLD
-            # confidence_[label_ != label] = 0
-
-            # NEW
-            # if isinstance(label_, np.ndarray):
-            #     flip_index = (label_ != label).astype(np.int)
-            # else:
-            #     flip_index = int(label_ != label)
-            if isinstance(label, six.text_type):
-                # fix for python3, can't compare numpy byte arrays with
-                # unicode.
-                label2_ = label.encode('utf-8')
-            else:
-                label2_ = label
-            flip_index = label_ != label2_
-            confidence_[flip_index] = 1.0 - confidence_[flip_index]
-            confidence_[confidence_ <= confidence_thresh] = 0
-
-            confidence_ *= 255.0
-
-            # Blow up canvas
-            mask = cv2.resize(confidence_, data.shape[0:2])
-            # Get the current values
-            current = canvas_dict[label][y1:y2, x1:x2]
-            # Where the current canvas is zero (most of it), make it mask
-            flags = current == 0
-            current[flags] = mask[flags]
-            # Average the current with the mask, which address overlapping areas
-            mask = 0.5 * mask + 0.5 * current
-            # Aggregate
-            canvas_dict[label][y1:y2, x1:x2] = mask
-        # Blur
-        # FIXME: Should this postprocessing step applied here?
-        # There is postprocessing in ibeis/algos/preproc/preproc_probchip.py
-        ksize = 3
-        kernel = (ksize, ksize)
-        canvas_dict[label] = cv2.blur(canvas_dict[label], kernel)
-    # Cast all images to uint8
-    for label in label_list_:
-        canvas = np.around(canvas_dict[label])
-        canvas = canvas.astype(np.uint8)
-        if original_shape is not None:
-            canvas = _resize_target(
-                canvas, target_height=original_shape[0], target_width=original_shape[1]
-            )
-        canvas_dict[label] = canvas
+    canvas_dict = _convolutional_reconstruct(
+        model, record, label_list, confidence_list, confidence_thresh=confidence_thresh
+    )
     if verbose:
         # End timer
         duration = ut.toc(tt, verbose=False)
@@ -1276,6 +1318,255 @@ def test_convolutional(
     return samples, canvas_dict
 
 
+def test_convolutional_batched(
+    model,
+    image_iter,
+    patch_size='auto',
+    stride='auto',
+    padding=32,
+    batch_size=None,
+    confidence_thresh=0.5,
+):
+    """
+    Batched version of :func:`test_convolutional` over many images.
+
+    Patches from consecutive images are packed together so every call to the
+    predict function (except the last) receives a full batch, instead of one
+    short batch per image. Predictions are scattered back to their images and
+    the results are yielded lazily in input order.
+
+    Args:
+        model (Model): the network to use to perform feedforward inference
+        image_iter (iterable): images to test
+        batch_size (int): number of patches per predict call. Defaults to
+            model.batch_size.
+
+    Yields:
+        samples, canvas_dict (tuple of int and dict): as returned by
+            :func:`test_convolutional` for each image
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn._plugin import *  # NOQA
+        >>> from wbia_cnn import _plugin_registry
+        >>> import vtool as vt
+        >>> model = _plugin_registry.get_pretrained_model('background_candidacy_zebra_plains')
+        >>> image_list = [vt.imread(ut.grab_test_imgpath('zebra.png'))] * 3
+        >>> result_list = list(test_convolutional_batched(model, image_list, padding=25))
+        >>> samples, canvas_dict = test_convolutional(model, image_list[0], padding=25)
+        >>> assert np.all(result_list[-1][1][1] == canvas_dict[1])
+    """
+    import collections
+
+    if batch_size is None:
+        batch_size = model.batch_size
+    theano_predict = model.build_predict_func()
+
+    # Images in input order whose canvases have not been yielded yet
+    record_queue = collections.deque()
+    # Padded patches (in input order) that still need to be predicted
+    patch_buffer = []
+
+    def _predict_buffered(num):
+        data_list_ = np.array(patch_buffer[:num])
+        del patch_buffer[:num]
+        test_results = model.process_batch(theano_predict, data_list_, unwrap=False)
+        labeled_predictions, confidences = _convolutional_decode(model, test_results)
+        # Scatter the results back to the images they came from
+        offset = 0
+        for record in record_queue:
+            need = len(record['patches']) - len(record['label_list'])
+            if need == 0:
+                continue
+            take = min(need, num - offset)
+            record['label_list'].extend(labeled_predictions[offset : offset + take])
+            record['confidence_list'].extend(confidences[offset : offset + take])
+            offset += take
+            if offset == num:
+                break
+
+    def _pop_finished():
+        while len(record_queue) > 0:
+            record = record_queue[0]
+            if len(record['label_list']) < len(record['patches']):
+                break
+            record_queue.popleft()
+            canvas_dict = _convolutional_reconstruct(
+                model,
+                record,
+                record['label_list'],
+                record['confidence_list'],
+                confidence_thresh=confidence_thresh,
+            )
+            yield len(record['patches']), canvas_dict
+
+    for image in image_iter:
+        record = _convolutional_prepare(
+            model, image, patch_size=patch_size, stride=stride, padding=padding
+        )
+        record['label_list'] = []
+        record['confidence_list'] = []
+        record_queue.append(record)
+        patch_buffer.extend(record['patches'])
+        num_full = (len(patch_buffer) // batch_size) * batch_size
+        if num_full > 0:
+            _predict_buffered(num_full)
+        for result in _pop_finished():
+            yield result
+    if len(patch_buffer) > 0:
+        _predict_buffered(len(patch_buffer))
+    for result in _pop_finished():
+        yield result
+
+
+def get_fcn_predict_func(model, padded_shape):
+    """
+    Returns a predict function of a fully convolutional model for (b, c, h, w)
+    inputs with (h, w) == padded_shape. The network is rebuilt for that input
+    shape with a copy of the model weights, because the layers bake their
+    input shapes into the graph. Functions are cached on the model, least
+    recently used first out.
+
+    Thread safe: the cache of each model is guarded by its own lock, so
+    concurrent requests compile each shape once.
+    """
+    import collections
+    import theano
+    import lasagne
+    from theano import tensor as T
+
+    with _FCN_LOCK:
+        fcn_lock = getattr(model, '_fcn_lock', None)
+        if fcn_lock is None:
+            fcn_lock = model._fcn_lock = threading.Lock()
+            model._fcn_predict_funcs = collections.OrderedDict()
+    padded_shape = tuple(padded_shape)
+    with fcn_lock:
+        fcn_funcs = model._fcn_predict_funcs
+        if padded_shape in fcn_funcs:
+            theano_fn = fcn_funcs.pop(padded_shape)
+            fcn_funcs[padded_shape] = theano_fn
+            return theano_fn
+        print('[model.build] request_predict_fcn %r' % (padded_shape,))
+        num_channels = model.input_shape[1]
+        # Never shares mutable configuration with the model (see _rebuild_copy)
+        fcn_model = model._rebuild_copy()
+        fcn_model.input_shape = (None, num_channels) + padded_shape
+        fcn_model.data_shape = padded_shape + (num_channels,)
+        output_layer = fcn_model.init_arch(verbose=False)
+        lasagne.layers.set_all_param_values(output_layer, model.get_all_param_values())
+        X_batch = T.tensor4('X_batch')
+        network_output = lasagne.layers.get_output(
+            output_layer, X_batch, deterministic=True
+        )
+        theano_fn = theano.function(
+            inputs=[theano.In(X_batch)],
+            outputs=model.custom_unlabeled_outputs(network_output),
+            mode=model._theano_mode,
+            name=':predict_fcn_%dx%d' % padded_shape,
+        )
+        fcn_funcs[padded_shape] = theano_fn
+        while len(fcn_funcs) > FCN_MAX_FUNCS:
+            fcn_funcs.popitem(last=False)
+    return theano_fn
+    print('[model.build] request_predict_fcn %r' % (padded_shape,))
+    num_channels = model.input_shape[1]
+    fcn_model = copy.copy(model)
+    fcn_model.input_shape = (None, num_channels) + padded_shape
+    fcn_model.data_shape = padded_shape + (num_channels,)
+    output_layer = fcn_model.init_arch(verbose=False)
+    lasagne.layers.set_all_param_values(output_layer, model.get_all_param_values())
+    X_batch = T.tensor4('X_batch')
+    network_output = lasagne.layers.get_output(output_layer, X_batch, deterministic=True)
+    theano_fn = theano.function(
+        inputs=[theano.In(X_batch)],
+        outputs=model.custom_unlabeled_outputs(network_output),
+        mode=model._theano_mode,
+        name=':predict_fcn_%dx%d' % padded_shape,
+    )
+    fcn_funcs[padded_shape] = theano_fn
+    while len(fcn_funcs) > FCN_MAX_FUNCS:
+        fcn_funcs.popitem(last=False)
+    return theano_fn
+
+
+def test_fully_convolutional(
+    model, image, padding=32, confidence_thresh=0.5, bucket_size=None
+):
+    """
+    Like :func:`test_convolutional`, but runs the network once on the whole
+    (resized) image instead of on overlapping patches.
+
+    The image is mirror padded by ``padding`` (which offsets the receptive
+    field reduction, as it does for every patch) and then on the bottom and
+    right up to a multiple of bucket_size, so images of similar size share a
+    compiled function (see :func:`get_fcn_predict_func`). The spatial output
+    covers the unpadded image plus the bucket padding; it is upsampled to
+    that size and cropped.
+
+    Returns:
+        samples, canvas_dict (tuple of int and dict): as returned by
+            :func:`test_convolutional` (samples is always 1)
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn._plugin import *  # NOQA
+        >>> from wbia_cnn import _plugin_registry
+        >>> import vtool as vt
+        >>> model = _plugin_registry.get_pretrained_model('background_candidacy_zebra_plains')
+        >>> image = vt.imread(ut.grab_test_imgpath('zebra.png'))
+        >>> samples, canvas_dict = test_fully_convolutional(model, image, padding=25)
+        >>> samples_, canvas_dict_ = test_convolutional(model, image, padding=25)
+        >>> diff = np.abs(canvas_dict[1].astype(np.float32) - canvas_dict_[1])
+        >>> print('mean abs diff = %.2f' % (diff.mean(),))
+    """
+    import cv2
+    from wbia_cnn import patch_pipeline
+
+    if bucket_size is None:
+        bucket_size = FCN_BUCKET_SIZE
+    image, original_shape = _convolutional_resize(image)
+    h, w = image.shape[:2]
+    # Bucket padding added past the bottom and right edges
+    extra_h = -(h + 2 * padding) % bucket_size
+    extra_w = -(w + 2 * padding) % bucket_size
+    pad_width = [(padding, padding + extra_h), (padding, padding + extra_w)]
+    pad_width += [(0, 0)] * (image.ndim - 2)
+    padded = np.pad(image, pad_width, 'reflect', reflect_type='even')
+    if padded.ndim == 2:
+        padded = padded[:, :, None]
+
+    scale, mean, std = patch_pipeline.get_input_transform(model)
+    # Per-pixel whitening params only fit the training size
+    if np.ndim(mean) == 3:
+        mean = mean.mean(axis=(1, 2), keepdims=True)
+    if np.ndim(std) == 3:
+        std = std.mean(axis=(1, 2), keepdims=True)
+    Xb = padded.transpose((2, 0, 1))[None, ...].astype(np.float32)
+    np.multiply(Xb, scale, out=Xb)
+    np.subtract(Xb, mean, out=Xb)
+    np.divide(Xb, std, out=Xb)
+
+    theano_fn = get_fcn_predict_func(model, padded.shape[0:2])
+    predictions, confidences = theano_fn(Xb)[0:2]
+    if model.encoder is not None:
+        labels = model.encoder.inverse_transform(predictions.ravel())
+        labels = np.asarray(labels).reshape(predictions.shape)
+    else:
+        labels = predictions
+    responses = _convolutional_responses(
+        model, labels, confidences, confidence_thresh=confidence_thresh
+    )
+    num_labels = responses.shape[-1]
+    # The output map covers the image and the bucket padding
+    canvas = cv2.resize(responses[0], (w + extra_w, h + extra_h))
+    canvas = canvas.reshape(h + extra_h, w + extra_w, num_labels)
+    canvas = np.ascontiguousarray(canvas[0:h, 0:w])
+    record = {'shape': (h, w), 'original_shape': original_shape}
+    canvas_dict = _convolutional_finalize(model, record, canvas)
+    return 1, canvas_dict
+
+
 @register_ibs_method
 def fix_annot_species_viewpoint_quality_cnn(ibs, aid_list, min_conf=0.8):
     r"""
@@ -1289,11 +1580,12 @@ def fix_annot_species_viewpoint_quality_cnn(ibs, aid_list, min_conf=0.8):
     data_shape = (96, 96, 3)
     # Define model and load weights
     print('Loading model...')
-    batch_size = int(min(128, 2 ** np.floor(np.log2(len(aid_list)))))
-    model = models.ViewpointModel(batch_size=batch_size, data_shape=data_shape)
     weights_path = grabmodels.ensure_model('viewpoint', redownload=False)
-    old_weights_fpath = weights_path
-    model.load_old_weights_kw(old_weights_fpath)
+    # The batch dimension is symbolic, so one warm model serves any number of
+    # annotations (the last batch is just shorter)
+    model = registry.get_plugin_model(
+        models.ViewpointModel, weights_path, data_shape, loader='legacy'
+    )
     # Read the data
     target = data_shape[0:2]
     print('Loading chips...')
@@ -1359,11 +1651,12 @@ def detect_annot_species_viewpoint_cnn(ibs, aid_list):
     data_shape = (96, 96, 3)
     # Define model and load weights
     print('Loading model...')
-    batch_size = int(min(128, 2 ** np.floor(np.log2(len(aid_list)))))
-    model = models.ViewpointModel(batch_size=batch_size, data_shape=data_shape)
     weights_path = grabmodels.ensure_model('viewpoint', redownload=False)
-    old_weights_fpath = weights_path
-    model.load_old_weights_kw(old_weights_fpath)
+    # The batch dimension is symbolic, so one warm model serves any number of
+    # annotations (the last batch is just shorter)
+    model = registry.get_plugin_model(
+        models.ViewpointModel, weights_path, data_shape, loader='legacy'
+    )
     # Read the data
     target = data_shape[0:2]
     print('Loading chips...')
@@ -1446,26 +1739,51 @@ def validate_annot_species_viewpoint_cnn(ibs, aid_list, verbose=False):
     return bad_species_list, bad_viewpoint_list
 
 
-def _suggest_random_candidate_regions(ibs, image, min_size, num_candidates=2000):
-    h, w, c = image.shape
+def _suggest_random_candidate_regions(
+    ibs, image, min_size, num_candidates=2000, rng=np.random
+):
+    """
+    Samples random (x0, y0, x1, y1) boxes that are at least min_size large.
+    Boxes are drawn in oversampled blocks and filtered instead of being
+    rejection sampled one at a time.
+
+    Returns:
+        ndarray: (num_candidates, 4) int array
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn._plugin import *  # NOQA
+        >>> from wbia_cnn._plugin import _suggest_random_candidate_regions  # NOQA
+        >>> image = np.zeros((100, 200, 3), dtype=np.uint8)
+        >>> rng = np.random.RandomState(0)
+        >>> boxes = _suggest_random_candidate_regions(None, image, (32, 16), 500, rng)
+        >>> assert boxes.shape == (500, 4)
+        >>> assert np.all(boxes[:, 2] - boxes[:, 0] >= 32)
+        >>> assert np.all(boxes[:, 3] - boxes[:, 1] >= 16)
+        >>> assert boxes[:, 2].max() < 200 and boxes[:, 3].max() < 100
+    """
+    h, w = image.shape[0:2]
     h -= 1
     w -= 1
     min_x, min_y = min_size
-
-    def _candidate():
-        x0, y0, x1, y1 = 0, 0, 0, 0
-        while x1 - x0 < min_x or y1 - y0 < min_y:
-            x0 = int(random.uniform(0, w))
-            y0 = int(random.uniform(0, h))
-            x1 = int(random.uniform(0, w))
-            y1 = int(random.uniform(0, h))
-            if x0 > x1:
-                x0, x1 = x1, x0
-            if y0 > y1:
-                y0, y1 = y1, y0
-        return x0, y0, x1, y1
-
-    candidate_list = [_candidate() for _ in range(num_candidates)]
+    if w < min_x or h < min_y:
+        return np.empty((0, 4), dtype=np.int64)
+    block_list = []
+    num_needed = num_candidates
+    while num_needed > 0:
+        num = 2 * num_needed + 16
+        xs = rng.uniform(0, w, size=(num, 2)).astype(np.int64)
+        ys = rng.uniform(0, h, size=(num, 2)).astype(np.int64)
+        block = np.stack(
+            [xs.min(axis=1), ys.min(axis=1), xs.max(axis=1), ys.max(axis=1)], axis=1
+        )
+        isvalid = (block[:, 2] - block[:, 0] >= min_x) & (
+            block[:, 3] - block[:, 1] >= min_y
+        )
+        block = block[isvalid][:num_needed]
+        block_list.append(block)
+        num_needed -= len(block)
+    candidate_list = np.vstack(block_list)
     return candidate_list
 
 
@@ -1481,89 +1799,255 @@ def _suggest_bing_candidate_regions(ibs, image_path_list):
     return result_list
 
 
+def _box_overlaps(boxes1, boxes2, use_iou=True):
+    """
+    Returns the (len(boxes1), len(boxes2)) matrix of overlaps between
+    inclusive (x0, y0, x1, y1) boxes. If use_iou is False the intersection is
+    divided by the area of the boxes2 box instead of the union.
+    """
+    xx1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    yy1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    xx2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    yy2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    inter = np.maximum(0, xx2 - xx1 + 1) * np.maximum(0, yy2 - yy1 + 1)
+    area1 = (boxes1[:, 2] - boxes1[:, 0] + 1) * (boxes1[:, 3] - boxes1[:, 1] + 1)
+    area2 = (boxes2[:, 2] - boxes2[:, 0] + 1) * (boxes2[:, 3] - boxes2[:, 1] + 1)
+    if use_iou:
+        return inter / (area1[:, None] + area2[None, :] - inter)
+    return inter / area2[None, :]
+
+
+def non_max_suppression_blocked(
+    box_list, conf_list, overlap_thresh=0.5, use_iou=True, block_size=64
+):
+    """
+    Greedy non-maximum suppression over boxes sorted by confidence.
+
+    Boxes are processed in blocks of block_size. Suppression inside a block is
+    resolved with the block's overlap matrix, then the boxes kept in the block
+    suppress all later boxes with one (kept x remaining) overlap matrix. This
+    avoids rebuilding the index list after every pick.
+
+    Args:
+        box_list (ndarray): (N, 4) inclusive (x0, y0, x1, y1) boxes
+        conf_list (ndarray): (N,) confidences
+        overlap_thresh (float): boxes overlapping a kept box by more than this
+            are suppressed
+        use_iou (bool): measure overlap by intersection over union, otherwise
+            by intersection over the area of the suppressed box (the measure
+            of non_max_suppression_fast)
+        block_size (int): number of boxes per block
+
+    Returns:
+        list: indices of the kept boxes from most to least confident
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn._plugin import *  # NOQA
+        >>> box_list = np.array([[0, 0, 9, 9], [1, 1, 10, 10], [20, 20, 29, 29],
+        >>>                      [0, 0, 4, 9]])
+        >>> conf_list = np.array([0.9, 0.95, 0.5, 0.3])
+        >>> print(non_max_suppression_blocked(box_list, conf_list, 0.5))
+        [1, 2, 3]
+        >>> print(non_max_suppression_blocked(box_list, conf_list, 0.5, use_iou=False))
+        [1, 2]
+        >>> print(non_max_suppression_blocked(box_list, conf_list, 0.5, block_size=1))
+        [1, 2, 3]
+    """
+    if len(box_list) == 0:
+        return []
+    box_list = np.asarray(box_list, dtype=np.float64)
+    conf_list = np.asarray(conf_list)
+    # Ties are broken like non_max_suppression_fast (last index first)
+    sortx = np.argsort(conf_list, kind='mergesort')[::-1]
+    boxes = box_list[sortx]
+    num = len(boxes)
+    keep = np.ones(num, dtype=np.bool_)
+    for start in range(0, num, block_size):
+        stop = min(start + block_size, num)
+        # Only boxes that survived the previous blocks take part
+        alive = start + np.flatnonzero(keep[start:stop])
+        if len(alive) == 0:
+            continue
+        block = boxes[alive]
+        issuppressor = _box_overlaps(block, block, use_iou) > overlap_thresh
+        keep_block = np.ones(len(alive), dtype=np.bool_)
+        for index in range(len(alive)):
+            if keep_block[index]:
+                keep_block[index + 1 :] &= ~issuppressor[index, index + 1 :]
+        keep[alive[~keep_block]] = False
+        rest = stop + np.flatnonzero(keep[stop:])
+        if len(rest) > 0:
+            rest_overlaps = _box_overlaps(block[keep_block], boxes[rest], use_iou)
+            keep[rest[np.any(rest_overlaps > overlap_thresh, axis=0)]] = False
+    pick = sortx[keep].tolist()
+    return pick
+
+
 def non_max_suppression_fast(box_list, conf_list, overlapThresh=0.5):
     """
     Python version of Malisiewicz's Matlab code:
     https://github.com/quantombone/exemplarsvm
 
-    NOTE: This is adapted from Pedro Felzenszwalb's version (nms.m),
-    but an inner loop has been eliminated to significantly speed it
-    up in the case of a large number of boxes
+    The overlap of a box is its intersection with a kept box divided by its
+    own area. Implemented by non_max_suppression_blocked.
 
     Reference: https://github.com/rbgirshick/rcnn/blob/master/nms/nms.m
     Reference: http://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
     """
-    # if there are no boxes, return an empty list
-    if len(box_list) == 0:
-        return []
+    return non_max_suppression_blocked(
+        box_list, conf_list, overlap_thresh=overlapThresh, use_iou=False
+    )
+
+
+def resample_candidate_regions(image, candidate_list, target=(96, 96), out=None):
+    """
+    Resizes every candidate region of an image into rows of a preallocated
+    (N, h, w, c) uint8 buffer.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn._plugin import *  # NOQA
+        >>> image = np.random.randint(0, 255, (60, 80, 3)).astype(np.uint8)
+        >>> candidate_list = np.array([[0, 0, 40, 30], [10, 5, 79, 59]])
+        >>> out = np.empty((4, 16, 16, 3), dtype=np.uint8)
+        >>> X = resample_candidate_regions(image, candidate_list, (16, 16), out)
+        >>> assert X.shape == (2, 16, 16, 3) and X.base is out
+    """
+    import cv2
 
-    # Convert to Numpy
-    box_list = np.array(box_list)
-    conf_list = np.array(conf_list)
-
-    # if the bounding boxes integers, convert them to floats --
-    # this is important since we'll be doing a bunch of divisions
-    if box_list.dtype.kind == 'i':
-        box_list = box_list.astype('float')
-
-    # initialize the list of picked indexes
-    pick = []
-
-    # grab the coordinates of the bounding boxes
-    # Our boxes are stored as y1, y2, x1, x2 to be in-line with OpenCV indexing
-    x1 = box_list[:, 0]
-    y1 = box_list[:, 1]
-    x2 = box_list[:, 2]
-    y2 = box_list[:, 3]
-    s = conf_list
-
-    # compute the area of the bounding boxes and sort the bounding
-    # boxes by the bottom-right y-coordinate of the bounding box
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    idxs = np.argsort(s)
-
-    # keep looping while some indexes still remain in the indexes
-    # list
-    while len(idxs) > 0:
-        # grab the last index in the indexes list and add the
-        # index value to the list of picked indexes
-        last = len(idxs) - 1
-        i = idxs[last]
-        pick.append(i)
-
-        # find the largest (x, y) coordinates for the start of
-        # the bounding box and the smallest (x, y) coordinates
-        # for the end of the bounding box
-        xx1 = np.maximum(x1[i], x1[idxs[:last]])
-        yy1 = np.maximum(y1[i], y1[idxs[:last]])
-        xx2 = np.minimum(x2[i], x2[idxs[:last]])
-        yy2 = np.minimum(y2[i], y2[idxs[:last]])
-
-        # compute the width and height of the bounding box
-        w = np.maximum(0, xx2 - xx1 + 1)
-        h = np.maximum(0, yy2 - yy1 + 1)
-
-        # compute the ratio of overlap
-        overlap = (w * h) / area[idxs[:last]]
-
-        # delete all indexes from the index list that have
-        idxs = np.delete(
-            idxs, np.concatenate(([last], np.where(overlap > overlapThresh)[0]))
+    num = len(candidate_list)
+    shape = (num, target[1], target[0]) + image.shape[2:]
+    if out is None:
+        out = np.empty(shape, dtype=image.dtype)
+    X = out[0:num]
+    assert X.shape == shape, 'out is too small'
+    for index, (x0, y0, x1, y1) in enumerate(candidate_list):
+        cv2.resize(
+            image[y0:y1, x0:x1], target, dst=X[index], interpolation=cv2.INTER_LANCZOS4
         )
+    return X
 
-    # return only the bounding boxes that were picked using the
-    # integer data type
-    return pick
+
+@register_ibs_method
+def detect_images_cnn(
+    ibs,
+    gid_list,
+    confidence=0.90,
+    extraction='bing',
+    nms_thresh=0.5,
+    num_candidates=2000,
+    images_per_batch=8,
+    rng=np.random,
+):
+    r"""
+    Detects species / viewpoint boxes in many images.
+
+    Candidate regions of images_per_batch images are resampled into one reused
+    buffer and classified together. Non-maximum suppression (by IoU) runs per
+    image. Nothing is drawn or shown.
+
+    Args:
+        ibs (IBEISController):  ibeis controller object
+        gid_list (list): image ids
+        confidence (float): minimum confidence of a returned box
+        extraction (str): 'bing' or 'random' candidate regions
+        nms_thresh (float): IoU above which less confident boxes are removed
+        num_candidates (int): number of random candidates per image
+        images_per_batch (int): images whose candidates are classified at once
+
+    Returns:
+        list: for each image a list of (bbox, species, viewpoint, confidence)
+            tuples with bbox as (x0, y0, x1, y1), from most to least confident
+
+    CommandLine:
+        python -m wbia_cnn._plugin --exec-detect_images_cnn
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn._plugin import *  # NOQA
+        >>> import wbia
+        >>> ibs = wbia.opendb(defaultdb='testdb1')
+        >>> gid_list = ibs.get_valid_gids()[0:4]
+        >>> results_list = detect_images_cnn(ibs, gid_list, extraction='random')
+        >>> print(ut.repr2(ut.lmap(len, results_list)))
+    """
+    data_shape = (96, 96, 3)
+    target = data_shape[0:2]
+    print('Loading model...')
+    weights_path = grabmodels.ensure_model('viewpoint', redownload=False)
+    model = registry.get_plugin_model(
+        models.ViewpointModel, weights_path, data_shape, batch_size=128, loader='legacy'
+    )
+
+    # Reused between batches, grown if a batch has more candidates
+    buf = np.empty((0,) + data_shape, dtype=np.uint8)
+    results_list = []
+    for gid_batch in ut.ProgIter(
+        list(ut.ichunks(gid_list, images_per_batch)), lbl='detect image batch'
+    ):
+        image_list = ibs.get_images(gid_batch)
+        if extraction == 'random':
+            candidates_list = [
+                _suggest_random_candidate_regions(
+                    ibs, image, (32, 32), num_candidates, rng=rng
+                )
+                for image in image_list
+            ]
+        else:
+            image_path_list = ibs.get_image_paths(gid_batch)
+            candidates_list = [
+                np.array(candidate_list, dtype=np.int64).reshape(-1, 4)
+                for candidate_list in _suggest_bing_candidate_regions(
+                    ibs, image_path_list
+                )
+            ]
+        num_list = [len(candidate_list) for candidate_list in candidates_list]
+        total = sum(num_list)
+        if total > len(buf):
+            buf = np.empty((total,) + data_shape, dtype=np.uint8)
+        offset = 0
+        for image, candidate_list in zip(image_list, candidates_list):
+            resample_candidate_regions(
+                image, candidate_list, target, out=buf[offset : offset + len(candidate_list)]
+            )
+            offset += len(candidate_list)
+        if total > 0:
+            test_outputs = model._predict(buf[0:total])
+            label_list = model.encoder.inverse_transform(test_outputs['predictions'])
+            conf_list = test_outputs['confidences']
+        offset = 0
+        for candidate_list, num in zip(candidates_list, num_list):
+            confs = conf_list[offset : offset + num] if num > 0 else []
+            labels = label_list[offset : offset + num] if num > 0 else []
+            offset += num
+            index_list = non_max_suppression_blocked(
+                candidate_list, confs, overlap_thresh=nms_thresh
+            )
+            result_list = []
+            for index in index_list:
+                if confs[index] < confidence:
+                    continue
+                species, viewpoint = convert_label(labels[index])
+                bbox = tuple(int(x) for x in candidate_list[index])
+                result_list.append((bbox, species, viewpoint, float(confs[index])))
+            results_list.append(result_list)
+    return results_list
 
 
 @register_ibs_method
-def detect_image_cnn(ibs, gid, confidence=0.90, extraction='bing'):
+def detect_image_cnn(ibs, gid, confidence=0.90, extraction='bing', show=False):
     r"""
     Args:
         ibs (IBEISController):  ibeis controller object
-        gid (?):
+        gid (int): image id
         confidence (float): (default = 0.9)
         extraction (str): (default = 'bing')
+        show (bool): draw the detections in an OpenCV window
+
+    Returns:
+        list: (bbox, species, viewpoint, confidence) tuples, see
+            detect_images_cnn
 
     CommandLine:
         python -m wbia_cnn._plugin --exec-detect_image_cnn
@@ -1571,7 +2055,6 @@ def detect_image_cnn(ibs, gid, confidence=0.90, extraction='bing'):
     Example:
         >>> # DISABLE_DOCTEST
         >>> from wbia_cnn._plugin import *  # NOQA
-        >>> from wbia_cnn._plugin import _suggest_random_candidate_regions, _suggest_bing_candidate_regions  # NOQA
         >>> import wbia
         >>> ibs = wbia.opendb(defaultdb='testdb1')
         >>> gid = 1
@@ -1580,117 +2063,30 @@ def detect_image_cnn(ibs, gid, confidence=0.90, extraction='bing'):
         >>> result = detect_image_cnn(ibs, gid, confidence, extraction)
         >>> print(result)
     """
-    import cv2
-
-    # Load chips and resize to the target
-    target = (96, 96)
-    targetx, targety = target
-    # gid = gid_list[random.randint(0, len(gid_list))]
-    # gid = gid_list[0]
     print('Detecting with gid=%r...' % (gid,))
-    image = ibs.get_images(gid)
-    rects = np.copy(image)
-    h, w, c = image.shape
-
-    print('Querrying for candidate regions...')
-    image_path = ibs.get_image_paths(gid)
-    if extraction == 'random':
-        candidate_list = _suggest_random_candidate_regions(ibs, image, (32, 32))
-    else:
-        candidate_list = _suggest_bing_candidate_regions(ibs, [image_path])[0]
-
-    print('Num candidates: %r' % (len(candidate_list),))
-    chip_list_resized = []
-    print('Extracting candidate regions...')
-    for candidate in candidate_list:
-        x0, y0, x1, y1 = candidate
-        chip = image[y0:y1, x0:x1]
-        chip = cv2.resize(chip, target, interpolation=cv2.INTER_LANCZOS4)
-        chip_list_resized.append(chip)
-        color = (255, 0, 0)
-        # cv2.rectangle(rects, (x0, y0), (x1, y1), color)
-        mx = int((x1 - x0) * 0.5)
-        my = int((y1 - y0) * 0.5)
-        cv2.circle(rects, (x0 + mx, y0 + my), 5, color, -1)
-    # cv2.imshow('', rects)
-    # cv2.waitKey(0)
-    # cv2.destroyAllWindows()
-
-    # Build data for network
-    X_test = np.array(chip_list_resized, dtype=np.uint8)
-    # Define model and load weights
-    print('Loading model...')
-    data_shape = (96, 96, 3)
-    # Define model and load weights
-    print('Loading model...')
-    # batch_size = int(min(128, 2 ** np.floor(np.log2(len(chip_list_resized)))))
-    batch_size = None
-    model = models.ViewpointModel(batch_size=batch_size, data_shape=data_shape)
-    weights_path = grabmodels.ensure_model('viewpoint', redownload=False)
-    old_weights_fpath = weights_path
-    model.load_old_weights_kw(old_weights_fpath)
-
-    # Predict on the data and convert labels to IBEIS namespace
-    test_outputs = model.predict2(X_test)
-    conf_list = test_outputs['confidences']
-    label_list = test_outputs['labeled_predictions']
-    pred_list = test_outputs['predictions']
-    # pred_list, label_list, conf_list = test.test_data(X_test, y_test, model, weights_path)
-    species_viewpoint_list = [convert_label(label) for label in label_list]
-
-    num_all_candidates = len(conf_list)
-    index_list = non_max_suppression_fast(candidate_list, conf_list)
-    print('Surviving candidates: %r' % (index_list,))
-    num_supressed_candidates = num_all_candidates - len(index_list)
-    print('Supressed: %d candidates' % (num_supressed_candidates,))
-
-    candidate_list = np.take(candidate_list, index_list, axis=0)
-    pred_list = np.take(pred_list, index_list, axis=0)
-    species_viewpoint_list = np.take(species_viewpoint_list, index_list, axis=0)
-    conf_list = np.take(conf_list, index_list, axis=0)
-
-    values = zip(candidate_list, pred_list, species_viewpoint_list, conf_list)
-    rects = np.copy(image)
-    color_dict = {
-        'giraffe': (255, 0, 0),
-        'giraffe_masai': (255, 255, 0),
-        'zebra_plains': (0, 0, 255),
-        'zebra_grevys': (0, 255, 0),
-        'elephant_savanna': (0, 0, 0),
-    }
-    skipped = 0
-    for candidate, pred, species_viewpoint, conf in values:
-        x0, y0, x1, y1 = tuple(candidate)
-        species, viewpoint = species_viewpoint
-        if conf < confidence:
-            skipped += 1
-            continue
-        print(
-            '%r Found %s (%s, %s) at %s'
-            % (
-                candidate,
-                pred,
-                species,
-                viewpoint,
-                conf,
-            )
-        )
-        color = color_dict[species]
-        cv2.rectangle(rects, (x0, y0), (x1, y1), color)
-        # mx = int((x1 - x0) * 0.5)
-        # my = int((y1 - y0) * 0.5)
-        # cv2.circle(rects, (x0 + mx, y0 + my), 5, color, -1)
-    print(
-        'Skipped [ %d / %d ]'
-        % (
-            skipped,
-            len(values),
-        )
-    )
+    result_list = detect_images_cnn(
+        ibs, [gid], confidence=confidence, extraction=extraction, images_per_batch=1
+    )[0]
+    for bbox, species, viewpoint, conf in result_list:
+        print('%r Found (%s, %s) at %s' % (bbox, species, viewpoint, conf))
+    if show:
+        import cv2
 
-    cv2.imshow('', rects)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
+        color_dict = {
+            'giraffe': (255, 0, 0),
+            'giraffe_masai': (255, 255, 0),
+            'zebra_plains': (0, 0, 255),
+            'zebra_grevys': (0, 255, 0),
+            'elephant_savanna': (0, 0, 0),
+        }
+        rects = np.copy(ibs.get_images(gid))
+        for (x0, y0, x1, y1), species, viewpoint, conf in result_list:
+            color = color_dict.get(species, (255, 255, 255))
+            cv2.rectangle(rects, (x0, y0), (x1, y1), color)
+        cv2.imshow('', rects)
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+    return result_list
 
 
 def get_siam_l2_model():
@@ -1746,11 +2142,10 @@ def generate_siam_l2_128_feats(ibs, cid_list, config2_=None):
         >>> print(result)
     """
     # hack because we need the old features
-    import vtool as vt
+    from wbia_cnn import patch_pipeline
 
     model = get_siam_l2_model()
     colorspace = 'gray' if model.input_shape[1] else None  # 'bgr'
-    patch_size = model.input_shape[-1]
     if config2_ is not None:
         # Get config from config2_ object
         # print('id(config2_) = ' + str(id(config2_)))
@@ -1766,86 +2161,49 @@ def generate_siam_l2_128_feats(ibs, cid_list, config2_=None):
         hesaff_params=hesaff_params,
     )
     print('Generating siam128 features for %d chips' % (len(cid_list),))
-    BATCHED = True
-    if BATCHED:
-        ibs.get_chip_feat_rowid(cid_list, config2_=hack_config2_, ensure=True)
-        for cid_batch in ut.ProgressIter(
-            list(ut.ichunks(cid_list, 128)), lbl='siam128 chip chunk'
-        ):
+    ibs.get_chip_feat_rowid(cid_list, config2_=hack_config2_, ensure=True)
+
+    def _iter_chip_items():
+        # The controller is only used from this thread. Chips are read in
+        # chunks while the pipeline warps and predicts the previous ones.
+        for cid_batch in ut.ichunks(cid_list, 32):
             sift_fid_list = ibs.get_chip_feat_rowid(cid_batch, config2_=hack_config2_)
-            print('Reading keypoints')
             kpts_list = ibs.get_feat_kpts(sift_fid_list)
-            print('Reading chips')
-            chip_list = vt.convert_image_list_colorspace(
-                ibs.get_chips(cid_batch, ensure=True), colorspace
-            )
-            print('Warping patches')
-            warped_patches_list = [
-                vt.get_warped_patches(chip, kpts, patch_size=patch_size)[0]
-                for chip, kpts in zip(chip_list, kpts_list)
-            ]
-            flat_list, cumlen_list = ut.invertible_flatten2(warped_patches_list)
-            stacked_patches = np.transpose(np.array(flat_list)[None, :], (1, 2, 3, 0))
-
-            test_outputs = model.predict2(X_test=stacked_patches)
-            network_output_determ = test_outputs['network_output_determ']
-            # network_output_determ.min()
-            # network_output_determ.max()
-            siam128_vecs_list = ut.unflatten2(network_output_determ, cumlen_list)
-
-            for cid, kpts, vecs in zip(cid_batch, kpts_list, siam128_vecs_list):
-                yield cid, len(kpts), kpts, vecs
-    else:
-        sift_fid_list = ibs.get_chip_feat_rowid(
-            cid_list, config2_=hack_config2_, ensure=True
-        )  # NOQA
-        print('Reading keypoints')
-        kpts_list = ibs.get_feat_kpts(sift_fid_list)
-        print('Reading chips')
-        chip_list = vt.convert_image_list_colorspace(
-            ibs.get_chips(cid_list, ensure=True), colorspace
-        )
-        print('Warping patches')
-        warped_patches_list = [
-            vt.get_warped_patches(chip, kpts, patch_size=patch_size)[0]
-            for chip, kpts in zip(chip_list, kpts_list)
-        ]
-        flat_list, cumlen_list = ut.invertible_flatten2(warped_patches_list)
-        stacked_patches = np.transpose(np.array(flat_list)[None, :], (1, 2, 3, 0))
-
-        test_outputs = model.predict2(X_test=stacked_patches)
-        network_output_determ = test_outputs['network_output_determ']
-        # network_output_determ.min()
-        # network_output_determ.max()
-        siam128_vecs_list = ut.unflatten2(network_output_determ, cumlen_list)
+            chip_list = ibs.get_chips(cid_batch, ensure=True)
+            for item in zip(cid_batch, chip_list, kpts_list):
+                yield item
 
-        for cid, kpts, vecs in zip(cid_list, kpts_list, siam128_vecs_list):
-            yield cid, len(kpts), kpts, vecs
+    pipeline = patch_pipeline.PatchDescriptorPipeline(model, colorspace=colorspace)
+    result_iter = ut.ProgressIter(
+        pipeline.extract(_iter_chip_items()),
+        nTotal=len(cid_list),
+        lbl='siam128 chip',
+        freq=10,
+        adjust=True,
+    )
+    for cid, kpts, vecs in result_iter:
+        yield cid, len(kpts), kpts, vecs
+    print('[siam128] %s' % (pipeline.timing_str(),))
 
 
-def extract_siam128_vecs(chip_list, kpts_list):
+def extract_siam128_vecs(chip_list, kpts_list, use_patch_store=True):
     """
     Duplicate testing func for vtool
+
+    If use_patch_store is True, warped patches are reused from (and added to)
+    the persistent patch store (see wbia_cnn.patch_store).
     """
-    import vtool as vt
+    from wbia_cnn import patch_pipeline
+    from wbia_cnn import patch_store
 
     model = get_siam_l2_model()
     colorspace = 'gray' if model.input_shape[1] else None  # 'bgr'
-    patch_size = model.input_shape[-1]
-    chip_list_ = vt.convert_image_list_colorspace(chip_list, colorspace)
-
-    warped_patches_list = [
-        vt.get_warped_patches(chip, kpts, patch_size=patch_size)[0]
-        for chip, kpts in zip(chip_list_, kpts_list)
-    ]
-    flat_list, cumlen_list = ut.invertible_flatten2(warped_patches_list)
-    stacked_patches = np.transpose(np.array(flat_list)[None, :], (1, 2, 3, 0))
-    X_test = stacked_patches
-    test_outputs = model.predict2(X_test)
-    network_output_determ = test_outputs['network_output_determ']
-    # network_output_determ.min()
-    # network_output_determ.max()
-    siam128_vecs_list = ut.unflatten2(network_output_determ, cumlen_list)
+    store = patch_store.get_patch_store() if use_patch_store else None
+    pipeline = patch_pipeline.PatchDescriptorPipeline(
+        model, colorspace=colorspace, patch_store=store
+    )
+    item_iter = zip(range(len(chip_list)), chip_list, kpts_list)
+    siam128_vecs_list = [vecs for _, kpts, vecs in pipeline.extract(item_iter)]
     return siam128_vecs_list
 
 
@@ -90,6 +90,58 @@ MODEL_URLS = {
     'vggnet_full': 'pretrained.caffe.vgg.pkl',
 }
 
+# How each published model is rebuilt for inference. Keyed by MODEL_URLS
+# prefix, the longest matching prefix wins. Values are the model class name in
+# wbia_cnn.models, the data_shape, the weight loader ('state' for model_state
+# pickles, 'legacy' / 'legacy2' for the old weight dumps), and whether the
+# whitening mean / std are collapsed to scalars.
+MODEL_SPECS = {
+    'classifier_': ('ClassifierModel', (192, 192, 3), 'state', False),
+    'classifier2_': ('Classifier2Model', (192, 192, 3), 'state', False),
+    'labeler_': ('LabelerModel', (128, 128, 3), 'state', False),
+    'background_': ('BackgroundModel', (256, 256, 3), 'state', True),
+    'aoi2_': ('AoI2Model', (192, 192, 4), 'state', False),
+    'viewpoint': ('ViewpointModel', (96, 96, 3), 'legacy', False),
+}
+
+# Extra constructor kwargs needed by specific published models
+MODEL_SPEC_KWARGS = {
+    'background_zebra_plains_grevys': {'num_output': 3},
+}
+
+
+def get_model_spec(model):
+    """
+    Returns the inference spec of a published model tag
+
+    Returns:
+        dict: with keys model_class, data_shape, loader, mean_center, and model_kw
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn._plugin_grabmodels import *  # NOQA
+        >>> spec = get_model_spec('background_zebra_plains_grevys')
+        >>> result = ut.repr2(spec, sorted_=True)
+        >>> print(result)
+        {'data_shape': (256, 256, 3), 'loader': 'legacy2', 'mean_center': True, 'model_class': 'BackgroundModel', 'model_kw': {'num_output': 3}}
+    """
+    prefix_list = [prefix for prefix in MODEL_SPECS if model.startswith(prefix)]
+    if len(prefix_list) == 0:
+        raise ValueError('model %r does not have an inference spec' % (model,))
+    prefix = max(prefix_list, key=len)
+    model_class, data_shape, loader, mean_center = MODEL_SPECS[prefix]
+    if loader == 'state' and MODEL_URLS.get(model, '').endswith('.npy'):
+        # The first background models were saved in the old weight format
+        loader = 'legacy2'
+    spec = {
+        'model_class': model_class,
+        'data_shape': data_shape,
+        'loader': loader,
+        'mean_center': mean_center,
+        'model_kw': MODEL_SPEC_KWARGS.get(model, {}),
+    }
+    return spec
+
 
 def ensure_model(model, redownload=False):
     try:
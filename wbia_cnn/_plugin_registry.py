@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of loaded inference models.
+
+The _plugin entry points used to build a model, unpickle its weights, and
+compile its theano predict function on every call. The registry keeps those
+models (and their compiled ``_theano_predict``) warm between calls. Entries are
+keyed by (model class, weights, data_shape, batch_size) and evicted in least
+recently used order once the approximate memory budget is exceeded.
+
+CommandLine:
+    python -m wbia_cnn._plugin_registry --allexamples
+    python -m wbia_cnn._plugin_registry warmup_models --models=labeler_v3,classifier2_v3
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import threading
+import functools
+from concurrent import futures
+import six
+import utool as ut
+import numpy as np
+from os.path import exists
+from wbia_cnn import _plugin_grabmodels as grabmodels
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+# Load weights artifacts converted from the weight pickles when they exist
+USE_WEIGHTS_ARTIFACTS = not ut.get_argflag('--no-weights-artifacts')
+
+# Approximate memory budget (in megabytes) for all registered models
+DEFAULT_BUDGET_MB = ut.get_argval('--cnn-model-budget', type_=float, default=2048.0)
+
+
+def estimate_model_nbytes(model):
+    """
+    Approximates the resident size of a model by the size of its parameters.
+    """
+    try:
+        weights_list = model.get_all_param_values()
+    except Exception:
+        return 0
+    nbytes = sum(np.asarray(weights).nbytes for weights in weights_list)
+    return int(nbytes)
+
+
+@ut.reloadable_class
+class ModelRegistry(ut.NiceRepr):
+    """
+    LRU cache of loaded models bounded by an approximate memory budget.
+
+    A model is loaded outside of the registry lock, so one cold load only
+    blocks the other requests for the same key.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn._plugin_registry import *  # NOQA
+        >>> registry = ModelRegistry(budget_mb=1.0)
+        >>> class Dummy(object):
+        >>>     def __init__(self, n):
+        >>>         self.weights = [np.zeros(n, dtype=np.uint8)]
+        >>>     def get_all_param_values(self):
+        >>>         return self.weights
+        >>> a = registry.get('a', lambda: Dummy(2 ** 19))
+        >>> b = registry.get('b', lambda: Dummy(2 ** 19))
+        >>> assert registry.get('a', None) is a
+        >>> c = registry.get('c', lambda: Dummy(2 ** 19))
+        >>> result = ut.repr2(registry.keys())
+        >>> print(result)
+        ['a', 'c']
+    """
+
+    def __init__(registry, budget_mb=None):
+        if budget_mb is None:
+            budget_mb = DEFAULT_BUDGET_MB
+        registry.budget_mb = budget_mb
+        registry._entries = ut.odict()
+        registry._nbytes = {}
+        registry._lock = threading.RLock()
+        # Futures of the models that are being loaded
+        registry._loading = {}
+        registry.num_hits = 0
+        registry.num_misses = 0
+        registry.num_evictions = 0
+
+    def __nice__(registry):
+        return 'n=%d, %.1f/%.1fMB' % (
+            len(registry),
+            registry.total_nbytes() / 2.0 ** 20,
+            registry.budget_mb,
+        )
+
+    def __len__(registry):
+        return len(registry._entries)
+
+    def __contains__(registry, key):
+        return key in registry._entries
+
+    def keys(registry):
+        """ Returns keys ordered from least to most recently used """
+        return list(registry._entries.keys())
+
+    def total_nbytes(registry):
+        return sum(registry._nbytes.values())
+
+    def get(registry, key, loader):
+        """
+        Returns the model registered under key, calling loader() to build it
+        if it is not loaded yet.
+        """
+        with registry._lock:
+            if key in registry._entries:
+                registry.num_hits += 1
+                # Move to the most recently used position
+                model = registry._entries.pop(key)
+                registry._entries[key] = model
+                return model
+            pending = registry._loading.get(key, None)
+            is_owner = pending is None
+            if is_owner:
+                registry.num_misses += 1
+                pending = registry._loading[key] = futures.Future()
+        if not is_owner:
+            # Another thread is loading this model
+            return pending.result()
+        try:
+            model = loader()
+            nbytes = estimate_model_nbytes(model)
+        except Exception as ex:
+            with registry._lock:
+                del registry._loading[key]
+            pending.set_exception(ex)
+            raise
+        with registry._lock:
+            registry._entries[key] = model
+            registry._nbytes[key] = nbytes
+            del registry._loading[key]
+        pending.set_result(model)
+        registry._shrink(keep=key)
+        return model
+
+    def warmup(registry, key, loader):
+        """ Loads a model ahead of time so the first request is not slow """
+        registry.get(key, loader)
+
+    def evict(registry, key=None):
+        """
+        Removes a single model (or all models if key is None) from the registry
+
+        Returns:
+            int: number of evicted models
+        """
+        from wbia_cnn import inference_service
+
+        with registry._lock:
+            key_list = registry.keys() if key is None else [key]
+            evicted_list = []
+            for key_ in key_list:
+                if key_ in registry._entries:
+                    evicted_list.append(registry._entries.pop(key_))
+                    del registry._nbytes[key_]
+            registry.num_evictions += len(evicted_list)
+        # Stop the micro-batching and augmentation workers of each model so it
+        # is released
+        for model in evicted_list:
+            inference_service.discard_model(model)
+            if hasattr(model, '_close_augment_pool'):
+                model._close_augment_pool()
+        return len(evicted_list)
+
+    def _shrink(registry, keep=None):
+        budget_nbytes = registry.budget_mb * 2.0 ** 20
+        for key in registry.keys():
+            if registry.total_nbytes() <= budget_nbytes:
+                break
+            if key == keep:
+                continue
+            print('[registry] evicting model %r' % (key,))
+            registry.evict(key)
+
+    def stats(registry):
+        return ut.odict(
+            [
+                ('num_models', len(registry)),
+                ('total_mb', registry.total_nbytes() / 2.0 ** 20),
+                ('budget_mb', registry.budget_mb),
+                ('num_hits', registry.num_hits),
+                ('num_misses', registry.num_misses),
+                ('num_evictions', registry.num_evictions),
+            ]
+        )
+
+
+# The process-wide registry used by the _plugin entry points
+REGISTRY = ModelRegistry()
+
+
+def make_model_key(
+    model_class, weights_path, data_shape, batch_size, mean_center=False, **model_kw
+):
+    """
+    mean_center is part of the key because it changes the whitening of the
+    loaded model.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn._plugin_registry import *  # NOQA
+        >>> key = make_model_key('BackgroundModel', 'w.pkl', [256, 256, 3], 128, num_output=3)
+        >>> print(ut.repr2(key))
+        ('BackgroundModel', 'w.pkl', (256, 256, 3), 128, False, (('num_output', 3),))
+    """
+    class_name = getattr(model_class, '__name__', model_class)
+    model_kw_ = tuple(sorted(model_kw.items()))
+    return (
+        class_name,
+        weights_path,
+        tuple(data_shape),
+        batch_size,
+        bool(mean_center),
+        model_kw_,
+    )
+
+
+def _applies_mean_center(loader, mean_center):
+    """ The old style weight dumps are never mean centered """
+    return bool(mean_center) and loader == 'state'
+
+
+def load_plugin_model(
+    model_class,
+    weights_path,
+    data_shape,
+    batch_size=128,
+    loader='state',
+    mean_center=False,
+    **model_kw
+):
+    """
+    Builds a model, loads its pretrained weights, and compiles its predict
+    function.
+
+    Args:
+        model_class (type): class (or class name) in wbia_cnn.models
+        weights_path (str): path to the weights on disk
+        data_shape (tuple): (h, w, c) input shape
+        batch_size (int): inference batch size
+        loader (str): 'state' for model state pickles, 'legacy' or 'legacy2'
+            for the old style weight dumps, 'weights' for weights artifacts.
+            If a weights artifact converted from the pickle exists next to it
+            (see wbia_cnn.weights_io) it is loaded instead of the pickle.
+        mean_center (bool): collapse the per-pixel center mean / std to a
+            scalar (needed by the background models). Only applies to the
+            'state' loader, also when a converted artifact is loaded.
+    """
+    from wbia_cnn import models
+    from wbia_cnn import weights_io
+
+    mean_center = _applies_mean_center(loader, mean_center)
+    if isinstance(model_class, six.string_types):
+        model_class = getattr(models, model_class)
+    model = model_class(batch_size=None, data_shape=data_shape, **model_kw)
+
+    weights_fpath = weights_io.get_weights_fpath(weights_path)
+    if loader == 'weights' or (USE_WEIGHTS_ARTIFACTS and exists(weights_fpath)):
+        model.batch_size = batch_size
+        artifact = model.load_model_weights(fpath=weights_fpath)
+        if loader == 'legacy2':
+            model.batch_size = artifact.get('batch_size', batch_size)
+        if mean_center:
+            model.data_params['center_mean'] = np.mean(model.data_params['center_mean'])
+            model.data_params['center_std'] = np.mean(model.data_params['center_std'])
+        if loader not in ['legacy', 'legacy2']:
+            model.hyperparams['whiten_on'] = True
+    elif loader == 'legacy':
+        model.batch_size = batch_size
+        model.load_old_weights_kw(weights_path)
+    elif loader == 'legacy2':
+        model.load_old_weights_kw2(weights_path)
+    elif loader == 'state':
+        model_state_fpath = model.get_model_state_fpath(fpath=weights_path)
+        print('[model] loading model state from: %s' % (model_state_fpath,))
+        model_state = ut.load_cPkl(model_state_fpath)
+
+        model.encoder = model_state.get('encoder', None)
+        model.output_dims = model_state['output_dims']
+        model.data_params = model_state['data_params']
+        model._fix_center_mean_std()
+        model.best_results = model_state['best_results']
+        # Classifier2 models ship their multi-label category list
+        model.category_list = model_state.get('category_list', None)
+
+        model.init_arch()
+        model.batch_size = batch_size
+        if mean_center:
+            model.data_params['center_mean'] = np.mean(model.data_params['center_mean'])
+            model.data_params['center_std'] = np.mean(model.data_params['center_std'])
+        model.hyperparams['whiten_on'] = True
+        model.set_all_param_values(model.best_results['weights'])
+    else:
+        raise ValueError('Unknown weight loader %r' % (loader,))
+
+    # Create the Theano primitives
+    print('\n[wbia_cnn] --- COMPILING SYMBOLIC THEANO FUNCTIONS ---')
+    print('[model] creating Theano primitives...')
+    model.build_predict_func()
+    return model
+
+
+def get_plugin_model(
+    model_class, weights_path, data_shape, batch_size=128, registry=None, **kwargs
+):
+    """
+    Returns a warm model from the registry, loading it on the first request.
+
+    Keyword arguments are forwarded to load_plugin_model. The loader is not
+    part of the key because it is determined by the weights themselves, but
+    the effective mean_center is.
+    """
+    if registry is None:
+        registry = REGISTRY
+    model_kw = kwargs.copy()
+    loader_kw = {
+        key: model_kw.pop(key) for key in ['loader', 'mean_center'] if key in model_kw
+    }
+    mean_center = _applies_mean_center(
+        loader_kw.get('loader', 'state'), loader_kw.get('mean_center', False)
+    )
+    key = make_model_key(
+        model_class,
+        weights_path,
+        data_shape,
+        batch_size,
+        mean_center=mean_center,
+        **model_kw
+    )
+    loader = functools.partial(
+        load_plugin_model,
+        model_class,
+        weights_path,
+        data_shape,
+        batch_size=batch_size,
+        **ut.dict_union(loader_kw, model_kw)
+    )
+    return registry.get(key, loader)
+
+
+def get_pretrained_model(model_tag, batch_size=128, registry=None, **kwargs):
+    """
+    Returns a warm model for a published model tag (see
+    _plugin_grabmodels.MODEL_URLS), downloading the weights if necessary.
+    """
+    spec = grabmodels.get_model_spec(model_tag)
+    weights_path = grabmodels.ensure_model(model_tag, redownload=False)
+    model_kw = ut.dict_union(spec['model_kw'], kwargs)
+    return get_plugin_model(
+        spec['model_class'],
+        weights_path,
+        spec['data_shape'],
+        batch_size=batch_size,
+        registry=registry,
+        loader=spec['loader'],
+        mean_center=spec['mean_center'],
+        **model_kw
+    )
+
+
+def warmup_models(model_tag_list=None, registry=None, **kwargs):
+    """
+    Loads and compiles published models ahead of time.
+
+    CommandLine:
+        python -m wbia_cnn._plugin_registry warmup_models --models=labeler_v3
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn._plugin_registry import *  # NOQA
+        >>> model_tag_list = ut.get_argval('--models', type_=list, default=['labeler_v3'])
+        >>> warmup_models(model_tag_list)
+        >>> print(REGISTRY)
+    """
+    if registry is None:
+        registry = REGISTRY
+    if model_tag_list is None:
+        model_tag_list = ut.get_argval('--models', type_=list, default=[])
+    for model_tag in ut.ProgIter(model_tag_list, lbl='warmup models'):
+        get_pretrained_model(model_tag, registry=registry, **kwargs)
+    return registry
+
+
+def evict_models(model_tag_list=None, registry=None):
+    """
+    Evicts published models from the registry. Evicts everything if
+    model_tag_list is None.
+    """
+    if registry is None:
+        registry = REGISTRY
+    if model_tag_list is None:
+        return registry.evict()
+    weights_path_set = set()
+    for model_tag in model_tag_list:
+        weights_path_set.add(grabmodels.ensure_model(model_tag, redownload=False))
+    num = 0
+    for key in registry.keys():
+        if key[1] in weights_path_set:
+            num += registry.evict(key)
+    return num
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn._plugin_registry
+        python -m wbia_cnn._plugin_registry --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
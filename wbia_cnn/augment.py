@@ -10,6 +10,7 @@ from __future__ import absolute_import, division, print_function
 import functools
 import numpy as np
 import utool as ut
+from os.path import join, exists
 
 print, rrr, profile = ut.inject2(__name__)
 
@@ -121,6 +122,154 @@ def random_affine_kwargs(*args, **kwargs):
     return affine_kw
 
 
+def random_affine_args_batch(
+    num,
+    zoom_range=(1 / 1.1, 1.1),
+    max_tx=1.0,
+    max_ty=1.0,
+    max_shear=TAU / 16,
+    max_theta=TAU / 32,
+    enable_flip=False,
+    enable_stretch=False,
+    rng=np.random,
+):
+    r"""
+    Vectorized random_affine_args. Samples the parameters of num transforms
+    from the same distributions.
+
+    Returns:
+        tuple: (sx, sy, theta, shear, tx, ty) arrays of length num
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.augment import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> affine_args = random_affine_args_batch(5, enable_flip=True, rng=rng)
+        >>> result = ut.depth_profile(affine_args)
+        >>> print(result)
+        [5, 5, 5, 5, 5, 5]
+    """
+    if zoom_range is None:
+        sx = sy = np.ones(num)
+    else:
+        log_zoom_range = [np.log(z) for z in zoom_range]
+        if enable_stretch:
+            sx = sy = np.exp(rng.uniform(*log_zoom_range, size=num))
+        else:
+            sx = np.exp(rng.uniform(*log_zoom_range, size=num))
+            sy = np.exp(rng.uniform(*log_zoom_range, size=num))
+
+    def _uniform(max_val):
+        if max_val is None:
+            return np.zeros(num)
+        return rng.uniform(-max_val, max_val, size=num)
+
+    theta = _uniform(max_theta)
+    shear = _uniform(max_shear)
+    tx = _uniform(max_tx)
+    ty = _uniform(max_ty)
+    if enable_flip:
+        # shear 180 degrees + rotate 180 == flip
+        flip = rng.randint(2, size=num) > 0
+        theta = theta + np.pi * flip
+        shear = shear + np.pi * flip
+    return sx, sy, theta, shear, tx, ty
+
+
+def affine_around_mats(x, y, sx, sy, theta, shear, tx, ty):
+    r"""
+    Vectorized vt.affine_around_mat3x3. Builds the (N, 2, 3) matrices that
+    scale, rotate, and shear around (x, y) and then translate.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.augment import *  # NOQA
+        >>> import vtool as vt
+        >>> rng = np.random.RandomState(0)
+        >>> affine_args = random_affine_args_batch(3, enable_flip=True, rng=rng)
+        >>> Aff_list = affine_around_mats(14.0, 14.0, *affine_args)
+        >>> Aff_list2 = [vt.affine_around_mat3x3(14.0, 14.0, *args)[0:2]
+        >>>              for args in zip(*affine_args)]
+        >>> assert np.allclose(Aff_list, Aff_list2)
+    """
+    sx, sy, theta, shear, tx, ty = map(np.asarray, (sx, sy, theta, shear, tx, ty))
+    sx_cos1 = sx * np.cos(theta)
+    sx_sin1 = sx * np.sin(theta)
+    sy_sin2 = sy * np.sin(theta + shear)
+    sy_cos2 = sy * np.cos(theta + shear)
+    Aff_list = np.empty((len(sx_cos1), 2, 3))
+    Aff_list[:, 0, 0] = sx_cos1
+    Aff_list[:, 0, 1] = -sy_sin2
+    Aff_list[:, 0, 2] = tx + x - (sx_cos1 * x) + (sy_sin2 * y)
+    Aff_list[:, 1, 0] = sx_sin1
+    Aff_list[:, 1, 1] = sy_cos2
+    Aff_list[:, 1, 2] = ty + y - (sx_sin1 * x) - (sy_cos2 * y)
+    return Aff_list
+
+
+def warp_affine_batch(
+    Xb, Aff_list, flags=None, borderMode=None, borderValue=0, out=None
+):
+    r"""
+    Warps every image of an (N, H, W[, C]) batch by its own (2, 3) matrix.
+
+    All channels of an image are warped by a single cv2.warpAffine call
+    (channels are grouped by four, the most cv2 handles at once), directly
+    into the output batch.
+
+    Note:
+        Warping a mosaic of the whole batch with a single cv2.remap was
+        measured to be slower than this. The interpolation work is the same
+        and the mosaic needs padding and explicit coordinate maps.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.augment import *  # NOQA
+        >>> import cv2
+        >>> rng = np.random.RandomState(0)
+        >>> Xb = rng.rand(4, 16, 16, 6).astype(np.float32)
+        >>> Aff_list = affine_around_mats(8.0, 8.0, *random_affine_args_batch(4, rng=rng))
+        >>> Xb_ = warp_affine_batch(Xb, Aff_list)
+        >>> Xref = cv2.warpAffine(Xb[1, :, :, 4], Aff_list[1], (16, 16),
+        >>>                       flags=cv2.INTER_LANCZOS4)
+        >>> assert np.allclose(Xb_[1, :, :, 4], Xref)
+    """
+    import cv2
+
+    if flags is None:
+        flags = cv2.INTER_LANCZOS4
+    if borderMode is None:
+        borderMode = cv2.BORDER_CONSTANT
+    if out is None:
+        out = np.empty_like(Xb)
+    h, w = Xb.shape[1:3]
+    num_channels = 1 if Xb.ndim == 3 else Xb.shape[3]
+    channel_groups = [slice(c, c + 4) for c in range(0, num_channels, 4)]
+    for index, Aff in enumerate(Aff_list):
+        if Xb.ndim == 3:
+            out[index] = cv2.warpAffine(
+                Xb[index],
+                Aff,
+                (w, h),
+                flags=flags,
+                borderMode=borderMode,
+                borderValue=borderValue,
+            )
+            continue
+        for sl in channel_groups:
+            img = np.ascontiguousarray(Xb[index, :, :, sl])
+            warped = cv2.warpAffine(
+                img,
+                Aff,
+                (w, h),
+                flags=flags,
+                borderMode=borderMode,
+                borderValue=borderValue,
+            )
+            out[index, :, :, sl] = warped.reshape(img.shape)
+    return out
+
+
 def affine_perterb(img, rng=np.random):
     r"""
     Args:
@@ -391,6 +540,12 @@ def augment_affine(
     aug_prop=0.5,
 ):
     """
+    Randomly warps groups of data_per_label images. All images of a group
+    (e.g. the two patches of a siamese pair) get the same transform.
+
+    The parameters of all groups are sampled at once and the selected
+    images are warped in a single warp_affine_batch call.
+
     CommandLine:
         python -m wbia_cnn.augment --test-augment_affine --show
         utprof.py -m wbia_cnn.augment --test-augment_affine
@@ -423,6 +578,81 @@ def augment_affine(
         >>> pt.qt4ensure()
         >>> show_augmented_patches(Xb, Xb_, yb, yb_, data_per_label=data_per_label)
         >>> ut.show_if_requested()
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.augment import *  # NOQA
+        >>> # Both images of a pair are warped the same way
+        >>> rng = np.random.RandomState(0)
+        >>> Xb = np.tile(rng.rand(8, 1, 12, 12, 1), (1, 2, 1, 1, 1)).reshape(16, 12, 12, 1)
+        >>> Xb = Xb.astype(np.float32)
+        >>> Xb_, _ = augment_affine(Xb, rng=rng, data_per_label=2, aug_prop=1.0,
+        >>>                         affperterb_ranges=dict(max_theta=TAU / 8))
+        >>> assert np.all(Xb_[0::2] == Xb_[1::2])
+        >>> assert not np.all(Xb_ == Xb)
+    """
+    import cv2
+
+    assert Xb.max() <= 1.0, 'max/min = %r, %r' % (Xb.min(), Xb.max())
+    assert Xb.min() >= 0.0, 'max/min = %r, %r' % (Xb.min(), Xb.max())
+
+    Xb_ = Xb if inplace else Xb.copy()
+    yb_ = yb if inplace or yb is None else yb.copy()
+
+    nGroups = len(Xb_) // data_per_label
+
+    # Determine which groups will be augmented
+    affperterb_flags = rng.uniform(0.0, 1.0, size=nGroups) <= aug_prop
+    # Build augmentation params for each group
+    if affperterb_ranges is None:
+        affperterb_ranges = dict(
+            zoom_range=None,
+            max_tx=None,
+            max_ty=None,
+            max_shear=None,
+            max_theta=None,
+            enable_flip=False,
+            enable_stretch=False,
+        )
+    group_list = np.where(affperterb_flags)[0]
+    affine_args = random_affine_args_batch(len(group_list), rng=rng, **affperterb_ranges)
+    h, w = Xb_.shape[1:3]
+    Aff_list = affine_around_mats(w / 2.0, h / 2.0, *affine_args)
+
+    # Every image of a group is modified with the same params
+    index_list = (
+        group_list[:, None] * data_per_label + np.arange(data_per_label)[None, :]
+    ).ravel()
+    Aff_list = np.repeat(Aff_list, data_per_label, axis=0)
+
+    num_channels = 1 if Xb_.ndim == 3 else Xb_.shape[-1]
+    borderValue = [0.5] * num_channels
+    warped = warp_affine_batch(
+        Xb_.take(index_list, axis=0),
+        Aff_list,
+        flags=cv2.INTER_LANCZOS4,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=borderValue,
+    )
+    np.clip(warped, 0, 1, out=warped)
+    # Modify the batch
+    Xb_[index_list] = warped
+    return Xb_, yb_
+
+
+@profile
+def augment_affine_loop(
+    Xb,
+    yb=None,
+    rng=np.random,
+    data_per_label=1,
+    inplace=False,
+    affperterb_ranges=None,
+    aug_prop=0.5,
+):
+    """
+    Reference implementation of augment_affine that warps one image at a time
+    with vt.affine_warp_around_center (see benchmark_augment).
     """
     import vtool as vt
     import cv2
@@ -474,7 +704,7 @@ def augment_affine(
     grouped_idxs = [np.arange(n, len(Xb_), data_per_label) for n in range(data_per_label)]
 
     # Take only the groups that were augmented
-    aug_grouped = ut.take(zip(*grouped_idxs), index_list)
+    aug_grouped = ut.take(list(zip(*grouped_idxs)), index_list)
 
     borderMode = cv2.BORDER_CONSTANT
     # borderMode = cv2.BORDER_REPLICATE
@@ -619,9 +849,182 @@ def augment_affine_siam(Xb, yb=None, rng=np.random):
     return Xb, yb
 
 
+def _shadow_transform_lut():
+    """
+    Maps uint8 Perlin noise to shadow maps. This is the transform
+    augment_shadow applies to the noise, evaluated for every noise value.
+    """
+    noise = np.arange(256, dtype=np.float32) / 255.0
+    return np.clip((noise ** 0.7 - 0.15) / 0.75, 0.1, 1).astype(np.float32)
+
+
+@ut.reloadable_class
+class ShadowBank(ut.NiceRepr):
+    """
+    Memory-mapped bank of precomputed Perlin noise tiles for augment_shadow.
+
+    The bank is built once per patch shape and stored as a .npy file in the
+    cache directory. Several training processes memory map the same file.
+    Shadow maps are sampled as random crops of the tiles that are then
+    randomly flipped and rotated by multiples of 90 degrees. The tiles are
+    twice the patch size and are generated with the same Perlin scale as
+    augment_shadow uses. Therefore the noise has the same frequency content
+    and the same shadow statistics.
+
+    Args:
+        patch_shape (tuple): (h, w) of the patches
+        num_tiles (int): size of the bank (--shadow-bank-size)
+        regen_freq (int): regenerate regen_num tiles every regen_freq sample
+            calls (--shadow-bank-regen). 0 never regenerates. Regenerated
+            tiles are private to the process (the memmap is copy-on-write).
+        regen_num (int): number of tiles to regenerate at a time
+        dpath (str): directory of the bank files
+        seed (int): seed used to build the bank
+
+    CommandLine:
+        python -m wbia_cnn.augment ShadowBank
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.augment import *  # NOQA
+        >>> dpath = ut.ensure_app_cache_dir('wbia_cnn', 'test_shadow_bank')
+        >>> bank = ShadowBank((16, 16), num_tiles=4, dpath=dpath)
+        >>> shadows = bank.sample(10, rng=np.random.RandomState(0))
+        >>> assert shadows.shape == (10, 16, 16, 1)
+        >>> assert shadows.min() >= 0.1 and shadows.max() <= 1.0
+    """
+
+    def __init__(
+        bank,
+        patch_shape,
+        num_tiles=None,
+        regen_freq=None,
+        regen_num=None,
+        dpath=None,
+        seed=0,
+    ):
+        if num_tiles is None:
+            num_tiles = ut.get_argval('--shadow-bank-size', type_=int, default=1024)
+        if regen_freq is None:
+            regen_freq = ut.get_argval('--shadow-bank-regen', type_=int, default=0)
+        if regen_num is None:
+            regen_num = max(1, num_tiles // 64)
+        if dpath is None:
+            dpath = ut.ensure_app_cache_dir('wbia_cnn', 'shadow_bank')
+        bank.patch_shape = tuple(patch_shape[0:2])
+        bank.tile_dim = 2 * max(bank.patch_shape)
+        bank.num_tiles = num_tiles
+        bank.regen_freq = regen_freq
+        bank.regen_num = regen_num
+        bank.dpath = dpath
+        bank.seed = seed
+        bank.num_samples = 0
+        bank._lut = _shadow_transform_lut()
+        bank._tiles = None
+
+    def __nice__(bank):
+        return '%dx%d, n=%d' % (bank.patch_shape + (bank.num_tiles,))
+
+    @property
+    def fpath(bank):
+        fname = 'shadow_bank_%dx%d_n%d_seed%d.npy' % (
+            bank.patch_shape + (bank.num_tiles, bank.seed)
+        )
+        return join(bank.dpath, fname)
+
+    def _make_tile(bank, rng):
+        import vtool as vt
+
+        # Same Perlin scale as augment_shadow uses for a patch
+        scale = bank.patch_shape[0] * 1.5
+        size = (bank.tile_dim, bank.tile_dim)
+        noise = vt.perlin_noise(size, scale=scale, rng=rng)
+        return np.clip(noise, 0, 255).astype(np.uint8)
+
+    def ensure(bank):
+        """ Builds the bank on the first use and memory maps it """
+        import os
+
+        if bank._tiles is not None:
+            return bank._tiles
+        if not exists(bank.fpath):
+            print('[augment] building shadow bank %s' % (bank.fpath,))
+            rng = np.random.RandomState(bank.seed)
+            tiles = np.empty((bank.num_tiles, bank.tile_dim, bank.tile_dim), np.uint8)
+            for index in ut.ProgIter(range(bank.num_tiles), lbl='shadow tiles'):
+                tiles[index] = bank._make_tile(rng)
+            # Write to a temporary file first so readers never see partial data
+            tmp_fpath = bank.fpath + '.tmp%d.npy' % (os.getpid(),)
+            np.save(tmp_fpath, tiles)
+            os.rename(tmp_fpath, bank.fpath)
+        bank._tiles = np.load(bank.fpath, mmap_mode='c')
+        return bank._tiles
+
+    def regenerate(bank, num=None, rng=np.random):
+        """ Replaces random tiles with new noise (only in this process) """
+        tiles = bank.ensure()
+        num = bank.regen_num if num is None else num
+        for index in rng.randint(0, len(tiles), size=num):
+            tiles[index] = bank._make_tile(rng)
+
+    def sample(bank, num, rng=np.random):
+        """
+        Returns:
+            ndarray: (num, h, w, 1) float32 shadow maps
+        """
+        tiles = bank.ensure()
+        bank.num_samples += 1
+        if bank.regen_freq > 0 and bank.num_samples % bank.regen_freq == 0:
+            bank.regenerate(rng=rng)
+        h, w = bank.patch_shape
+        rot_k = rng.randint(0, 4, size=num)
+        if h != w:
+            # Quarter turns would change the shape of the crop
+            rot_k = 2 * (rot_k // 2)
+        flip_flags = rng.randint(0, 2, size=num) > 0
+        tile_idxs = rng.randint(0, len(tiles), size=num)
+        # Quarter turned crops are cut out with transposed dimensions
+        crop_h = np.where(rot_k % 2 == 1, w, h)
+        crop_w = np.where(rot_k % 2 == 1, h, w)
+        y0 = rng.randint(0, bank.tile_dim - crop_h + 1)
+        x0 = rng.randint(0, bank.tile_dim - crop_w + 1)
+        noise = np.empty((num, h, w), dtype=np.uint8)
+        for k in range(4):
+            idxs = np.where(rot_k == k)[0]
+            if len(idxs) == 0:
+                continue
+            ch, cw = (w, h) if k % 2 == 1 else (h, w)
+            # Gather all crops of this rotation from the memmap at once
+            rows = y0[idxs, None, None] + np.arange(ch)[None, :, None]
+            cols = x0[idxs, None, None] + np.arange(cw)[None, None, :]
+            crops = tiles[tile_idxs[idxs, None, None], rows, cols]
+            noise[idxs] = np.rot90(crops, k=k, axes=(1, 2))
+        flip_idxs = np.where(flip_flags)[0]
+        noise[flip_idxs] = noise[flip_idxs, :, ::-1]
+        shadows = bank._lut[noise]
+        return shadows[:, :, :, None]
+
+
+# Process-wide shadow banks keyed by patch shape
+_SHADOW_BANKS = {}
+
+
+def get_shadow_bank(patch_shape):
+    key = tuple(patch_shape[0:2])
+    if key not in _SHADOW_BANKS:
+        _SHADOW_BANKS[key] = ShadowBank(key)
+    return _SHADOW_BANKS[key]
+
+
 @profile
-def augment_shadow(Xb, yb=None, rng=np.random, return_shadowmaps=False):
+def augment_shadow(
+    Xb, yb=None, rng=np.random, return_shadowmaps=False, shadow_bank=None
+):
     """
+    Multiplies random pairs with Perlin noise shadow maps. The maps come from
+    a precomputed ShadowBank (one is created per patch shape if shadow_bank
+    is None). Pass shadow_bank=False to generate new noise for every pair.
+
     CommandLine:
         python -m wbia_cnn.augment --test-augment_shadow --show --db PZ_MTEST
 
@@ -662,17 +1065,28 @@ def augment_shadow(Xb, yb=None, rng=np.random, return_shadowmaps=False):
         shadows = np.empty(Xb.shape, dtype=Xb.dtype)
         shadows1, shadows2 = shadows[::2], shadows[1::2]
 
-    for index in np.where(perlinperterb_flags)[0]:
+    index_list = np.where(perlinperterb_flags)[0]
+    if shadow_bank is None:
+        shadow_bank = get_shadow_bank(Xb.shape[1:3])
+    if shadow_bank is not False:
+        bank_noise1 = shadow_bank.sample(len(index_list), rng=rng)
+        bank_noise2 = shadow_bank.sample(len(index_list), rng=rng)
+
+    for count, index in enumerate(index_list):
         img1 = Xb1[index]
         img2 = Xb2[index]
-        # TODO: TAKE IN NORMALIZED POINTS
-        noise1 = perlin_noise01(img1.shape[0:2])
-        noise2 = perlin_noise01(img2.shape[0:2])
+        if shadow_bank is not False:
+            noise1 = bank_noise1[count]
+            noise2 = bank_noise2[count]
+        else:
+            # TODO: TAKE IN NORMALIZED POINTS
+            noise1 = perlin_noise01(img1.shape[0:2])
+            noise2 = perlin_noise01(img2.shape[0:2])
 
-        # noise1 = np.clip(noise1 / .7, 0, 1)
-        # noise2 = np.clip(noise2 / .7, 0, 1)
-        noise1 = np.clip((noise1 ** 0.7 - 0.15) / 0.75, 0.1, 1)
-        noise2 = np.clip((noise2 ** 0.7 - 0.15) / 0.75, 0.1, 1)
+            # noise1 = np.clip(noise1 / .7, 0, 1)
+            # noise2 = np.clip(noise2 / .7, 0, 1)
+            noise1 = np.clip((noise1 ** 0.7 - 0.15) / 0.75, 0.1, 1)
+            noise2 = np.clip((noise2 ** 0.7 - 0.15) / 0.75, 0.1, 1)
 
         if return_shadowmaps:
             shadows1[index] = noise1
@@ -754,6 +1168,284 @@ def augment_gamma(Xb, yb=None, rng=np.random):
     return Xb, yb
 
 
+def random_exposure_affine_params(num, exposure_margin=32.0, blur_prob=0.1, rng=np.random):
+    """
+    Samples the exposure / rotate-scale-skew / flip / blur parameters used to
+    augment the Labeler and Classifier chips, for num images at once.
+    """
+    params = {
+        'exposure': rng.uniform(-exposure_margin, exposure_margin, size=num),
+        'degree': rng.randint(-15, 16, size=num),
+        'scale': rng.uniform(0.90, 1.10, size=num),
+        'skew_x': rng.uniform(0.90, 1.10, size=num),
+        'skew_y': rng.uniform(0.90, 1.10, size=num),
+        'flip': rng.uniform(0.0, 1.0, size=num) <= 0.5,
+        'blur': rng.uniform(0.0, 1.0, size=num) <= blur_prob,
+    }
+    return params
+
+
+def _exposure_affine_padding(params, w):
+    """ Reflection padding the per-image implementation warps in """
+    skew_x_offset = np.abs(1.0 - params['skew_x'])
+    skew_y_offset = np.abs(1.0 - params['skew_y'])
+    skew_offset = np.sqrt(skew_x_offset ** skew_x_offset + skew_y_offset ** skew_y_offset)
+    skew_scale = 1.0 + skew_offset
+    padding = np.sqrt((w) ** 2 / 4 - 2 * (w) ** 2 / 16)
+    padding = padding / params['scale'] * skew_scale
+    return np.ceil(padding).astype(int)
+
+
+def exposure_affine_mats(params, h, w):
+    """
+    Returns the (N, 2, 3) warps of the per-image implementation, which rotates
+    and scales around the center of a reflection padded canvas (with
+    cv2.getRotationMatrix2D) and then skews, expressed in unpadded image
+    coordinates.
+    """
+    padding = _exposure_affine_padding(params, w)
+    cx = (w + 2 * padding) // 2
+    cy = (h + 2 * padding) // 2
+    radians = params['degree'] * (np.pi / 180.0)
+    alpha = params['scale'] * np.cos(radians)
+    beta = params['scale'] * np.sin(radians)
+    Aff_list = np.empty((len(padding), 2, 3))
+    Aff_list[:, 0, 0] = alpha * params['skew_x']
+    Aff_list[:, 0, 1] = beta * params['skew_y']
+    Aff_list[:, 1, 0] = -beta * params['skew_x']
+    Aff_list[:, 1, 1] = alpha * params['skew_y']
+    Aff_list[:, 0, 2] = (1 - alpha) * cx - beta * cy
+    Aff_list[:, 1, 2] = beta * cx + (1 - alpha) * cy
+    # Move the padded canvas coordinates back onto the image
+    # x' = A (x + p) + t - p
+    Aff_list[:, :, 2] += (Aff_list[:, :, 0] + Aff_list[:, :, 1] - 1) * padding[:, None]
+    return Aff_list
+
+
+def _flip_viewpoint_label(y):
+    if y is not None and ':' in y:
+        species, viewpoint = y.split(':')
+        if 'left' in viewpoint:
+            viewpoint = viewpoint.replace('left', 'right')
+        elif 'right' in viewpoint:
+            viewpoint = viewpoint.replace('right', 'left')
+        y = '%s:%s' % (species, viewpoint)
+    return y
+
+
+@profile
+def augment_exposure_affine(
+    Xb,
+    yb=None,
+    rng=np.random,
+    exposure_margin=32.0,
+    blur_prob=0.1,
+    flip_viewpoint=False,
+    params=None,
+):
+    """
+    Batched augmentation of uint8 BGR chips (used by the Labeler and
+    Classifier models). Shifts the exposure, rotates / scales / skews, flips
+    horizontally, and blurs.
+
+    The parameters of all images are sampled as arrays, the exposure is
+    adjusted with one color conversion of the whole batch, and every image is
+    warped once over all channels with a reflected border. The per-image
+    implementation (augment_exposure_affine_loop) instead warps each channel
+    separately over a large reflection padded canvas.
+
+    Args:
+        Xb (ndarray): (N, H, W, 3) uint8 batch, modified in place
+        yb (list): labels, flipped viewpoints are swapped if flip_viewpoint
+        exposure_margin (float): maximum shift of the L channel
+        blur_prob (float): probability of a 3x3 blur
+        flip_viewpoint (bool): swap left / right in 'species:viewpoint' labels
+            of flipped images
+        params (dict): precomputed random_exposure_affine_params
+
+    CommandLine:
+        python -m wbia_cnn.augment augment_exposure_affine
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.augment import *  # NOQA
+        >>> import vtool as vt
+        >>> img = vt.imread(ut.grab_test_imgpath('carl.jpg'))
+        >>> Xb = np.array([vt.resize(img, (64, 64))] * 8)
+        >>> yb = ['zebra:left'] * 8
+        >>> params = random_exposure_affine_params(8, rng=np.random.RandomState(0))
+        >>> Xb1, yb1 = augment_exposure_affine(Xb.copy(), list(yb), params=params,
+        >>>                                    flip_viewpoint=True)
+        >>> Xb2, yb2 = augment_exposure_affine_loop(Xb.copy(), list(yb), params=params,
+        >>>                                         flip_viewpoint=True)
+        >>> assert yb1 == yb2
+        >>> diff = np.abs(Xb1.astype(np.int32) - Xb2.astype(np.int32))
+        >>> assert np.mean(diff > 1) < 0.01
+    """
+    import cv2
+
+    X = np.asarray(Xb)
+    num, h, w = X.shape[0:3]
+    if params is None:
+        params = random_exposure_affine_params(num, exposure_margin, blur_prob, rng=rng)
+    # Adjust the exposure of the whole batch at once
+    X_Lab = cv2.cvtColor(X.reshape(num * h, w, 3), cv2.COLOR_BGR2LAB).reshape(X.shape)
+    X_L = X_Lab[:, :, :, 0].astype(dtype=np.float32)
+    X_L += params['exposure'].astype(np.float32)[:, None, None]
+    np.around(X_L, out=X_L)
+    np.clip(X_L, 0.0, 255.0, out=X_L)
+    X_Lab[:, :, :, 0] = X_L.astype(dtype=X_Lab.dtype)
+    X_ = cv2.cvtColor(X_Lab.reshape(num * h, w, 3), cv2.COLOR_LAB2BGR).reshape(X.shape)
+    # Rotate, Scale, Skew
+    Aff_list = exposure_affine_mats(params, h, w)
+    X_ = warp_affine_batch(
+        X_, Aff_list, flags=cv2.INTER_LANCZOS4, borderMode=cv2.BORDER_REFLECT_101
+    )
+    # Horizontal flip
+    flip_idxs = np.where(params['flip'])[0]
+    X_[flip_idxs] = X_[flip_idxs, :, ::-1]
+    if flip_viewpoint and yb is not None:
+        for index in flip_idxs:
+            yb[index] = _flip_viewpoint_label(yb[index])
+    # Blur
+    for index in np.where(params['blur'])[0]:
+        X_[index] = cv2.blur(X_[index], (3, 3))
+    if isinstance(Xb, np.ndarray):
+        Xb[...] = X_
+        return Xb, yb
+    return X_, yb
+
+
+def augment_exposure_affine_loop(
+    Xb,
+    yb=None,
+    rng=np.random,
+    exposure_margin=32.0,
+    blur_prob=0.1,
+    flip_viewpoint=False,
+    params=None,
+):
+    """
+    Reference per-image, per-channel implementation of augment_exposure_affine
+    (see benchmark_augment).
+    """
+    import cv2
+
+    if params is None:
+        params = random_exposure_affine_params(len(Xb), exposure_margin, blur_prob, rng=rng)
+    padding_list = _exposure_affine_padding(params, Xb[0].shape[1])
+    for index in range(len(Xb)):
+        X = np.copy(Xb[index])
+        y = None if yb is None else yb[index]
+        # Adjust the exposure
+        X_Lab = cv2.cvtColor(X, cv2.COLOR_BGR2LAB)
+        X_L = X_Lab[:, :, 0].astype(dtype=np.float32)
+        X_L += params['exposure'][index]
+        X_L = np.around(X_L)
+        X_L[X_L < 0.0] = 0.0
+        X_L[X_L > 255.0] = 255.0
+        X_Lab[:, :, 0] = X_L.astype(dtype=X_Lab.dtype)
+        X = cv2.cvtColor(X_Lab, cv2.COLOR_LAB2BGR)
+        # Rotate, Scale, Skew
+        h, w, c = X.shape
+        degree = params['degree'][index]
+        scale = params['scale'][index]
+        skew_x = params['skew_x'][index]
+        skew_y = params['skew_y'][index]
+        padding = padding_list[index]
+        for channel in range(c):
+            X_ = X[:, :, channel]
+            X_ = np.pad(X_, padding, 'reflect', reflect_type='even')
+            h_, w_ = X_.shape
+            # Calculate Affine transform
+            center = (w_ // 2, h_ // 2)
+            A = cv2.getRotationMatrix2D(center, float(degree), float(scale))
+            # Add skew
+            A[0][0] *= skew_x
+            A[1][0] *= skew_x
+            A[0][1] *= skew_y
+            A[1][1] *= skew_y
+            # Apply Affine
+            X_ = cv2.warpAffine(X_, A, (w_, h_), flags=cv2.INTER_LANCZOS4, borderValue=0)
+            X_ = X_[padding : -1 * padding, padding : -1 * padding]
+            X[:, :, channel] = X_
+        # Horizontal flip
+        if params['flip'][index]:
+            X = cv2.flip(X, 1)
+            if flip_viewpoint:
+                y = _flip_viewpoint_label(y)
+        # Blur
+        if params['blur'][index]:
+            X = cv2.blur(X, (3, 3))
+        # Save
+        Xb[index] = X.reshape(Xb[index].shape).astype(Xb[index].dtype)
+        if yb is not None:
+            yb[index] = y
+    return Xb, yb
+
+
+def benchmark_augment(num=128, dim=128, num_iters=3):
+    """
+    Measures the throughput (images per second) of the batched augmentation
+    functions against their per-image reference implementations.
+
+    CommandLine:
+        python -m wbia_cnn.augment benchmark_augment
+        python -m wbia_cnn.augment benchmark_augment --num=128 --dim=192
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn.augment import *  # NOQA
+        >>> num = ut.get_argval('--num', type_=int, default=128)
+        >>> dim = ut.get_argval('--dim', type_=int, default=128)
+        >>> result = benchmark_augment(num, dim)
+        >>> print(ut.repr2(result, precision=1))
+    """
+    import time
+
+    rng = np.random.RandomState(0)
+    chips = rng.randint(0, 256, size=(num, dim, dim, 3)).astype(np.uint8)
+    patches = rng.rand(num, dim // 2, dim // 2, 1).astype(np.float32)
+    affperterb_ranges = dict(
+        zoom_range=(1.0, 1.3),
+        max_tx=2,
+        max_ty=2,
+        max_shear=TAU / 32,
+        max_theta=TAU,
+        enable_stretch=True,
+        enable_flip=True,
+    )
+
+    def _exposure(func):
+        params = random_exposure_affine_params(num, rng=np.random.RandomState(0))
+        func(chips.copy(), ['zebra:left'] * num, params=params, flip_viewpoint=True)
+
+    def _affine(func):
+        func(
+            patches.copy(),
+            rng=np.random.RandomState(0),
+            data_per_label=2,
+            affperterb_ranges=affperterb_ranges,
+            aug_prop=1.0,
+        )
+
+    bench_list = [
+        ('exposure_affine_loop', _exposure, augment_exposure_affine_loop),
+        ('exposure_affine_batch', _exposure, augment_exposure_affine),
+        ('affine_loop', _affine, augment_affine_loop),
+        ('affine_batch', _affine, augment_affine),
+    ]
+    result = ut.odict()
+    for key, runner, func in bench_list:
+        start = time.time()
+        for _ in range(num_iters):
+            runner(func)
+        duration = (time.time() - start) / num_iters
+        result[key] = num / duration
+        print('[augment] %s: %.1f images / second' % (key, result[key]))
+    return result
+
+
 @profile
 def augment_siamese_patches2(Xb, yb=None, rng=np.random):
     """
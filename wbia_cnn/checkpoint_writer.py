@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous, atomic, deduplicated checkpoint writer.
+
+At every checkpoint _ModelFitter.fit used to pickle the full model state (best
+and current weights plus the whole history) four times on the training thread:
+the checkpoint state and info, and the current state and info. Training
+stalled for the duration, an interrupted write left a truncated pickle behind,
+and every checkpoint directory held its own copy of the best weights even when
+they had not changed since the previous checkpoint.
+
+A checkpoint is now split in two steps:
+
+    * ``snapshot_model`` runs on the training thread. It pickles the small
+      metadata (results, data params, history) to bytes and keeps references
+      to the parameter arrays (get_all_param_values returns copies and the
+      best weights are replaced, never modified, so neither can change under
+      the writer). While the history is appended to its log (see
+      wbia_cnn.history_log) only a HistoryLogRef is kept, so the cost does
+      not grow with the length of the run. The checkpoint-tag pickles keep
+      the reference (the logs live in ``<arch_dpath>/history_logs``, which
+      renaming old sessions never touches); the current state and info are
+      written with the resolved History so they stay self-contained.
+    * ``write_checkpoint`` runs on the CheckpointWriter thread. Every file is
+      written to a temporary path and renamed into place. In the checkpoint
+      directories each weight tensor is stored once by content hash in
+      ``<arch_dpath>/weight_blobs`` and the state pickle holds a WeightBlobRef
+      instead of the array, so an unchanged best model costs no extra disk.
+
+The writer queue is bounded (``--checkpoint-queue``, default 2) so training
+only blocks when it produces checkpoints faster than they can be written.
+Disable it with ``--no-async-checkpoint``.
+
+CommandLine:
+    python -m wbia_cnn.checkpoint_writer --allexamples
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import hashlib
+import threading
+import numpy as np
+import utool as ut
+from os.path import join, dirname, exists, relpath, normpath
+from six.moves import cPickle as pickle
+from six.moves import queue
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+# Number of checkpoints that may wait for the writer before fit blocks
+DEFAULT_QUEUE_SIZE = ut.get_argval('--checkpoint-queue', type_=int, default=2)
+
+_PICKLE_PROTOCOL = 2
+
+
+def _tmp_fpath(fpath):
+    return '%s.tmp%d.%d' % (fpath, os.getpid(), threading.current_thread().ident)
+
+
+def atomic_save_cPkl(fpath, data):
+    """ Pickles data to a temporary file and renames it to fpath """
+    tmp_fpath = _tmp_fpath(fpath)
+    with open(tmp_fpath, 'wb') as file_:
+        pickle.dump(data, file_, protocol=_PICKLE_PROTOCOL)
+    os.rename(tmp_fpath, fpath)
+    return fpath
+
+
+class WeightBlobRef(object):
+    """
+    Stands in for a weight array in a checkpoint state pickle.  relpath is
+    relative to the directory of the pickle.
+    """
+
+    def __init__(self, relpath):
+        self.relpath = relpath
+
+    def __repr__(self):
+        return 'WeightBlobRef(%r)' % (self.relpath,)
+
+
+@ut.reloadable_class
+class WeightBlobStore(ut.NiceRepr):
+    """
+    Content addressed store of weight arrays.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.checkpoint_writer import *  # NOQA
+        >>> dpath = ut.ensure_app_resource_dir('wbia_cnn', 'test_checkpoint_writer')
+        >>> ut.delete(join(dpath, 'weight_blobs'))
+        >>> store = WeightBlobStore(join(dpath, 'weight_blobs'))
+        >>> arr = np.arange(6, dtype=np.float32).reshape(2, 3)
+        >>> name1 = store.add(arr)
+        >>> name2 = store.add(arr.copy())
+        >>> name3 = store.add(arr.reshape(3, 2))
+        >>> assert name1 == name2 and name1 != name3
+        >>> assert np.all(store.load(name1) == arr)
+        >>> print(len(os.listdir(store.dpath)))
+        2
+    """
+
+    def __init__(store, dpath):
+        store.dpath = dpath
+
+    def __nice__(store):
+        return store.dpath
+
+    def blob_fpath(store, name):
+        return join(store.dpath, name)
+
+    def add(store, arr):
+        """ Stores arr unless an identical array is stored. Returns its name """
+        arr = np.ascontiguousarray(arr)
+        hasher = hashlib.sha1()
+        hasher.update(('%s%r' % (arr.dtype.str, arr.shape)).encode('utf8'))
+        hasher.update(arr.data if arr.flags.c_contiguous else arr.tobytes())
+        name = hasher.hexdigest() + '.npy'
+        fpath = store.blob_fpath(name)
+        if not exists(fpath):
+            ut.ensuredir(store.dpath)
+            tmp_fpath = _tmp_fpath(fpath)
+            with open(tmp_fpath, 'wb') as file_:
+                np.save(file_, arr)
+            os.rename(tmp_fpath, fpath)
+        return name
+
+    def load(store, name, mmap=False):
+        return np.load(store.blob_fpath(name), mmap_mode='r' if mmap else None)
+
+
+def _dedup_weights(weights_list, store, fpath):
+    if weights_list is None:
+        return None
+    state_dpath = dirname(fpath)
+    return [
+        WeightBlobRef(relpath(store.blob_fpath(store.add(arr)), state_dpath))
+        for arr in weights_list
+    ]
+
+
+def _prepare_history(meta, fpath, history_ref):
+    """
+    Keeps a HistoryLogRef of the snapshot (relative to fpath) if history_ref
+    is True and otherwise replaces it with the History it refers to
+    """
+    from wbia_cnn import history_log
+
+    history = meta.get('era_history', None)
+    if isinstance(history, history_log.HistoryLogRef):
+        if history_ref:
+            meta['era_history'] = history.relative_to(dirname(fpath))
+        else:
+            meta['era_history'] = history.resolve()
+
+
+def resolve_model_state(model_state, fpath):
+    """
+    Replaces the WeightBlobRefs of a state pickle loaded from fpath with the
+    stored arrays and a HistoryLogRef with the history it refers to. States
+    without references are returned unchanged.
+    """
+    from wbia_cnn import history_log
+
+    state_dpath = dirname(fpath)
+    history = model_state.get('era_history', None)
+    if isinstance(history, history_log.HistoryLogRef):
+        model_state['era_history'] = history.resolve(state_dpath)
+
+    def _resolve(weights_list):
+        if weights_list is None:
+            return None
+        return [
+            np.load(normpath(join(state_dpath, ref.relpath)))
+            if isinstance(ref, WeightBlobRef)
+            else ref
+            for ref in weights_list
+        ]
+
+    if 'current_weights' in model_state:
+        model_state['current_weights'] = _resolve(model_state['current_weights'])
+    best_results = model_state.get('best_results', {})
+    if 'weights' in best_results:
+        best_results['weights'] = _resolve(best_results['weights'])
+    return model_state
+
+
+def snapshot_model(model):
+    """
+    Captures everything a checkpoint writes. Runs on the training thread, so
+    later epochs can not change what is written.
+    """
+    best_results = model.best_results
+    meta = {
+        'best_results': {
+            key: val for key, val in best_results.items() if key != 'weights'
+        },
+        'data_params': model.data_params,
+        'encoder': getattr(model, 'encoder', None),
+        'input_shape': model.input_shape,
+        'data_shape': model.data_shape,
+        'batch_size': model.data_shape,
+        'output_dims': model.output_dims,
+        'era_history': model.history,
+    }
+    history_ref = model.history.log_ref()
+    if history_ref is not None:
+        meta['era_history'] = history_ref
+    snapshot = {
+        'meta': pickle.dumps(meta, protocol=_PICKLE_PROTOCOL),
+        'current_weights': model.get_all_param_values(),
+        'best_weights': best_results.get('weights', None),
+        'arch_hashid': model.get_arch_hashid(),
+        'model_class': model.__class__.__name__,
+        'category_list': getattr(model, 'category_list', None),
+    }
+    return snapshot
+
+
+def _load_meta(snapshot):
+    # Each write gets its own copy of the metadata
+    return pickle.loads(snapshot['meta'])
+
+
+def write_model_state(fpath, snapshot, store=None, history_ref=False):
+    """
+    Writes a model state pickle. With a WeightBlobStore the weights are
+    stored in it and referenced from the pickle. With history_ref the
+    history is referenced from its log instead of pickled.
+    """
+    model_state = _load_meta(snapshot)
+    _prepare_history(model_state, fpath, history_ref)
+    current_weights = snapshot['current_weights']
+    best_weights = snapshot['best_weights']
+    if store is not None:
+        current_weights = _dedup_weights(current_weights, store, fpath)
+        best_weights = _dedup_weights(best_weights, store, fpath)
+    model_state['current_weights'] = current_weights
+    if best_weights is not None:
+        model_state['best_results']['weights'] = best_weights
+    ut.ensuredir(dirname(fpath))
+    atomic_save_cPkl(fpath, model_state)
+    return fpath
+
+
+def write_model_info(fpath, snapshot, history_ref=False):
+    """ Writes the history and results but no weights """
+    meta = _load_meta(snapshot)
+    _prepare_history(meta, fpath, history_ref)
+    model_info = ut.dict_subset(
+        meta, ['best_results', 'input_shape', 'output_dims', 'era_history']
+    )
+    ut.ensuredir(dirname(fpath))
+    atomic_save_cPkl(fpath, model_info)
+    return fpath
+
+
+def write_model_weights(fpath, snapshot):
+    """ Writes the inference-only weights artifact (see wbia_cnn.weights_io) """
+    from wbia_cnn import weights_io
+
+    meta = _load_meta(snapshot)
+    weights_list = snapshot['best_weights']
+    if weights_list is None:
+        weights_list = snapshot['current_weights']
+    ut.ensuredir(dirname(fpath))
+    weights_io.save_weights(
+        fpath,
+        weights_list,
+        data_params=meta['data_params'],
+        encoder=meta['encoder'],
+        input_shape=meta['input_shape'],
+        output_dims=meta['output_dims'],
+        arch_hashid=snapshot['arch_hashid'],
+        model_class=snapshot['model_class'],
+        data_shape=meta['data_shape'],
+        category_list=snapshot['category_list'],
+        best_results=meta['best_results'],
+    )
+    return fpath
+
+
+def write_checkpoint(snapshot, fpath_dict, store):
+    """
+    Writes the checkpoint state and info, then the current state, info, and
+    weights. Only the checkpoint states use the blob store and reference the
+    history log; the current state stays a self-contained pickle.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.checkpoint_writer import *  # NOQA
+        >>> from wbia_cnn import history_log
+        >>> from wbia_cnn.models.abstract_models import History
+        >>> arch_dpath = ut.ensure_app_resource_dir('wbia_cnn', 'test_checkpoint_history')
+        >>> ut.delete(arch_dpath)
+        >>> session_dpath = ut.ensuredir(join(arch_dpath, 'saved_sessions', 'fit_session_0'))
+        >>> history = History()
+        >>> history.era_list.append({'num_learn': 10})
+        >>> history.attach_log(history_log.session_log_fpath(arch_dpath, session_dpath))
+        >>> history._record_epoch({'learn_loss': 1.0, 'valid_loss': 2.0})
+        >>> meta = {'best_results': {}, 'era_history': history.log_ref()}
+        >>> snapshot = {'meta': pickle.dumps(meta), 'current_weights': [np.ones(2)],
+        >>>             'best_weights': None}
+        >>> ckpt_fpath = join(arch_dpath, 'checkpoints', 'tag', 'model_state.pkl')
+        >>> state_fpath = join(arch_dpath, 'model_state.pkl')
+        >>> _ = write_model_state(ckpt_fpath, snapshot, history_ref=True)
+        >>> _ = write_model_state(state_fpath, snapshot)
+        >>> history._record_epoch({'learn_loss': 0.5, 'valid_loss': 1.0})
+        >>> history.close_log()
+        >>> # The next fit session renames the old session directories
+        >>> _ = ut.move(session_dpath, session_dpath + '_nEpochs_0002')
+        >>> for fpath in [ckpt_fpath, state_fpath]:
+        >>>     model_state = resolve_model_state(ut.load_cPkl(fpath), fpath)
+        >>>     print(model_state['era_history'].get_column('valid_loss'))
+        [2.]
+        [2.]
+    """
+    write_model_info(fpath_dict['checkpoint_info'], snapshot, history_ref=True)
+    write_model_state(
+        fpath_dict['checkpoint_state'], snapshot, store=store, history_ref=True
+    )
+    write_model_info(fpath_dict['info'], snapshot)
+    write_model_state(fpath_dict['state'], snapshot)
+    write_model_weights(fpath_dict['weights'], snapshot)
+    print('[checkpoint] saved checkpoint to %r' % (dirname(fpath_dict['checkpoint_state']),))
+
+
+@ut.reloadable_class
+class CheckpointWriter(ut.NiceRepr):
+    """
+    Runs checkpoint writes on a background thread.
+
+    submit only blocks when max_pending writes are already queued. An error
+    in a write is raised by the next submit or flush.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.checkpoint_writer import *  # NOQA
+        >>> writer = CheckpointWriter(max_pending=1)
+        >>> done = []
+        >>> for count in range(3):
+        >>>     writer.submit(done.append, count)
+        >>> writer.flush()
+        >>> print(done)
+        [0, 1, 2]
+        >>> def fail():
+        >>>     raise IOError('disk full')
+        >>> writer.submit(fail)
+        >>> try:
+        >>>     writer.flush()
+        >>> except IOError as ex:
+        >>>     print(ex)
+        disk full
+        >>> writer.close()
+    """
+
+    def __init__(writer, max_pending=None):
+        if max_pending is None:
+            max_pending = DEFAULT_QUEUE_SIZE
+        writer.max_pending = max_pending
+        writer._queue = queue.Queue(maxsize=max(max_pending, 1))
+        writer._error = None
+        writer.num_written = 0
+        writer._thread = threading.Thread(target=writer._run)
+        writer._thread.daemon = True
+        writer._thread.start()
+
+    def __nice__(writer):
+        return 'pending=%d, written=%d' % (writer._queue.qsize(), writer.num_written)
+
+    def _run(writer):
+        while True:
+            job = writer._queue.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                func(*args)
+                writer.num_written += 1
+            except Exception as ex:
+                ut.printex(ex, '[checkpoint] write failed', iswarning=True)
+                writer._error = ex
+            finally:
+                writer._queue.task_done()
+
+    def _raise_error(writer):
+        if writer._error is not None:
+            ex, writer._error = writer._error, None
+            raise ex
+
+    def submit(writer, func, *args):
+        """ Queues func(*args) """
+        writer._raise_error()
+        writer._queue.put((func, args))
+
+    def flush(writer):
+        """ Waits for all queued writes """
+        writer._queue.join()
+        writer._raise_error()
+
+    def close(writer):
+        writer._queue.put(None)
+        writer._thread.join()
+        writer._raise_error()
+
+
+# The process-wide writer used by _ModelIO.save_checkpoint
+_WRITER_STATE = {'writer': None}
+
+
+def get_writer():
+    writer = _WRITER_STATE['writer']
+    if writer is None or not writer._thread.is_alive():
+        writer = CheckpointWriter()
+        _WRITER_STATE['writer'] = writer
+    return writer
+
+
+def flush():
+    """ Waits for the queued checkpoints of the process-wide writer """
+    if _WRITER_STATE['writer'] is not None:
+        _WRITER_STATE['writer'].flush()
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.checkpoint_writer
+        python -m wbia_cnn.checkpoint_writer --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of compiled theano functions.
+
+Compiling the predict / forward / backprop functions of a network takes tens of
+seconds and used to be repeated in every new process. Compiled functions are
+pickled here keyed by the architecture hash, input shape and dtype, and the
+theano version / config. A later process unpickles the optimized graph (without
+re-optimizing it) and rebinds its shared variables to the parameters of the
+requesting model, so weights set on the model are seen by the function.
+
+Entries become unreachable whenever the architecture or theano setup changes,
+and ``clear_compile_cache`` removes entries written by other theano versions.
+
+CommandLine:
+    # Pre-warm the cache for every published model
+    python -m wbia_cnn.compile_cache --prewarm
+    python -m wbia_cnn.compile_cache --prewarm --models=labeler_v3,classifier2_v3
+    python -m wbia_cnn.compile_cache --clear
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import sys
+import json
+import platform
+import utool as ut
+from os.path import join, exists
+from six.moves import cPickle as pickle
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+FN_KINDS = ['predict', 'forward', 'backprop']
+
+
+def get_compile_cache_dpath():
+    dpath = ut.get_argval('--compile-cache-dir', type_=str, default=None)
+    if dpath is None:
+        dpath = ut.ensure_app_cache_dir('wbia_cnn', 'compiled_funcs')
+    return ut.ensuredir(dpath)
+
+
+def get_theano_cfgdict():
+    """ The parts of the theano setup that change the compiled code """
+    import theano
+
+    cfgdict = ut.odict(
+        [
+            ('theano_version', theano.__version__),
+            ('python', '%d.%d' % sys.version_info[0:2]),
+            ('machine', platform.machine()),
+            ('device', str(theano.config.device)),
+            ('floatX', str(theano.config.floatX)),
+            ('mode', str(theano.config.mode)),
+            ('optimizer', str(theano.config.optimizer)),
+            ('linker', str(theano.config.linker)),
+        ]
+    )
+    return cfgdict
+
+
+def get_compile_cfgdict(model, fn_kind):
+    """
+    Returns all information identifying a compiled function of a model.
+    """
+    X_batch = model._theano_fn_inputs['X_batch']
+    if fn_kind == 'predict':
+        arch_hashid = model.get_arch_hashid()
+    else:
+        # The stochastic graphs contain the dropout and noise layers that
+        # get_arch_hashid leaves out
+        arch_str = model.get_arch_str(with_noise=True)
+        arch_hashid = ut.hashstr27(arch_str, hashlen=8)
+    cfgdict = ut.odict(
+        [
+            ('fn_kind', fn_kind),
+            ('model_class', model.__class__.__name__),
+            ('arch_hashid', arch_hashid),
+            ('input_shape', list(model.input_shape)),
+            ('X_dtype', str(X_batch.dtype)),
+            ('X_ndim', X_batch.ndim),
+            ('graph_prep', model._graph_prep_mode()),
+            ('theano_mode', str(model._theano_mode)),
+        ]
+    )
+    cfgdict.update(get_theano_cfgdict())
+    return cfgdict
+
+
+def get_compile_cachekey(cfgdict):
+    cfgstr = ut.repr2(cfgdict, sorted_=True)
+    return ut.hashstr27(cfgstr, hashlen=16)
+
+
+def _shared_var_labels(model, theano_fn):
+    """
+    Labels each shared variable of a compiled function with how to find its
+    counterpart in a model. Parameters are labeled by their position in
+    get_all_params, learning state and graph_prep whitening params by their
+    key, and internal state (e.g. update velocities) by None.
+    """
+    param_list = model.get_all_params()
+    param_index = {id(param): index for index, param in enumerate(param_list)}
+    learn_shared = {}
+    if model.learn_state._isinit:
+        learn_shared = {
+            id(shared): key for key, shared in model.learn_state.shared.items()
+        }
+    prep_shared = {}
+    if model._theano_exprs['prep_shared'] is not None:
+        prep_shared = {
+            id(shared): key for key, shared in model._theano_exprs['prep_shared'].items()
+        }
+    label_list = []
+    for shared in theano_fn.get_shared():
+        if id(shared) in param_index:
+            label_list.append(('param', param_index[id(shared)]))
+        elif id(shared) in learn_shared:
+            label_list.append(('learn_state', learn_shared[id(shared)]))
+        elif id(shared) in prep_shared:
+            label_list.append(('graph_prep', prep_shared[id(shared)]))
+        else:
+            label_list.append(None)
+    return label_list
+
+
+def save_compiled_func(model, fn_kind, theano_fn, dpath=None):
+    """
+    Writes a compiled function to the cache. Failures are reported and
+    otherwise ignored since the cache is only an optimization.
+    """
+    if dpath is None:
+        dpath = get_compile_cache_dpath()
+    try:
+        cfgdict = get_compile_cfgdict(model, fn_kind)
+        cachekey = get_compile_cachekey(cfgdict)
+        fpath = join(dpath, 'theano_fn_%s_%s.pkl' % (fn_kind, cachekey))
+        header = ut.odict(
+            [('cfgdict', cfgdict), ('labels', _shared_var_labels(model, theano_fn))]
+        )
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(old_limit, 50000))
+        try:
+            # Write to a temporary file first so readers never see partial data
+            tmp_fpath = fpath + '.tmp%d' % (os.getpid(),)
+            with open(tmp_fpath, 'wb') as file_:
+                pickle.dump(header, file_, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(theano_fn, file_, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_fpath, fpath)
+        finally:
+            sys.setrecursionlimit(old_limit)
+        ut.save_text(fpath.replace('.pkl', '.json'), json.dumps(cfgdict, indent=4))
+        print('[model.build] cached compiled %s function to %s' % (fn_kind, fpath))
+    except Exception as ex:
+        ut.printex(ex, 'unable to cache compiled %s function' % (fn_kind,), iswarning=True)
+
+
+def load_compiled_func(model, fn_kind, dpath=None):
+    """
+    Returns a cached compiled function bound to the model's shared variables,
+    or None if it is not cached (or could not be loaded).
+    """
+    import theano
+
+    if dpath is None:
+        dpath = get_compile_cache_dpath()
+    cfgdict = get_compile_cfgdict(model, fn_kind)
+    cachekey = get_compile_cachekey(cfgdict)
+    fpath = join(dpath, 'theano_fn_%s_%s.pkl' % (fn_kind, cachekey))
+    if not exists(fpath):
+        return None
+    try:
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(old_limit, 50000))
+        try:
+            with theano.change_flags(reoptimize_unpickled_function=False):
+                with open(fpath, 'rb') as file_:
+                    header = pickle.load(file_)
+                    cached_fn = pickle.load(file_)
+        finally:
+            sys.setrecursionlimit(old_limit)
+        if header['cfgdict'] != cfgdict:
+            # Hash collision or a corrupted entry
+            return None
+        param_list = model.get_all_params()
+        swap = {}
+        for shared, label in zip(cached_fn.get_shared(), header['labels']):
+            if label is None:
+                continue
+            kind, index = label
+            if kind == 'param':
+                swap[shared] = param_list[index]
+            elif kind == 'learn_state':
+                swap[shared] = model.learn_state.shared[index]
+            elif kind == 'graph_prep':
+                swap[shared] = model._get_graph_prep_shared()[index]
+        theano_fn = cached_fn.copy(swap=swap)
+    except Exception as ex:
+        ut.printex(ex, 'unable to load cached %s function' % (fn_kind,), iswarning=True)
+        return None
+    print('[model.build] loaded compiled %s function from %s' % (fn_kind, fpath))
+    return theano_fn
+
+
+def clear_compile_cache(dpath=None, stale_only=True):
+    """
+    Removes cached functions. If stale_only is True only the functions compiled
+    under a different theano setup are removed.
+
+    Returns:
+        int: number of removed entries
+    """
+    if dpath is None:
+        dpath = get_compile_cache_dpath()
+    current = get_theano_cfgdict() if stale_only else None
+    num = 0
+    for json_fpath in ut.glob(dpath, 'theano_fn_*.json'):
+        fpath = json_fpath.replace('.json', '.pkl')
+        if stale_only:
+            cfgdict = json.loads(ut.read_from(json_fpath))
+            is_stale = any(cfgdict.get(key) != val for key, val in current.items())
+            if not is_stale:
+                continue
+        ut.delete(fpath, verbose=False)
+        ut.delete(json_fpath, verbose=False)
+        num += 1
+    print('[compile_cache] removed %d cached functions' % (num,))
+    return num
+
+
+def prewarm_compile_cache(model_tag_list=None, fn_kinds=['predict']):
+    """
+    Compiles (or validates the cache of) the functions of published models so
+    later processes start warm.
+
+    CommandLine:
+        python -m wbia_cnn.compile_cache --exec-prewarm_compile_cache --models=labeler_v3
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn.compile_cache import *  # NOQA
+        >>> model_tag_list = ut.get_argval('--models', type_=list, default=['labeler_v3'])
+        >>> prewarm_compile_cache(model_tag_list)
+    """
+    from wbia_cnn import _plugin_grabmodels as grabmodels
+    from wbia_cnn import _plugin_registry
+
+    if model_tag_list is None:
+        model_tag_list = sorted(grabmodels.MODEL_URLS.keys())
+    failed_list = []
+    for model_tag in ut.ProgIter(model_tag_list, lbl='prewarm compile cache'):
+        try:
+            spec = grabmodels.get_model_spec(model_tag)
+        except ValueError:
+            # Pretrained weight slices are not complete networks
+            print('[compile_cache] skipping %r' % (model_tag,))
+            continue
+        try:
+            weights_path = grabmodels.ensure_model(model_tag, redownload=False)
+            model = _plugin_registry.load_plugin_model(
+                spec['model_class'],
+                weights_path,
+                spec['data_shape'],
+                loader=spec['loader'],
+                mean_center=spec['mean_center'],
+                **spec['model_kw']
+            )
+            if 'forward' in fn_kinds:
+                model.build_forward_func()
+            if 'backprop' in fn_kinds:
+                model.build_backprop_func()
+        except Exception as ex:
+            ut.printex(ex, 'failed to prewarm %r' % (model_tag,), iswarning=True)
+            failed_list.append(model_tag)
+    return failed_list
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.compile_cache --prewarm
+        python -m wbia_cnn.compile_cache --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    if ut.get_argflag('--clear'):
+        clear_compile_cache(stale_only=not ut.get_argflag('--all'))
+    elif ut.get_argflag('--prewarm'):
+        model_tag_list = ut.get_argval('--models', type_=list, default=None)
+        fn_kinds = ut.get_argval('--fn-kinds', type_=list, default=['predict'])
+        prewarm_compile_cache(model_tag_list, fn_kinds=fn_kinds)
+    else:
+        ut.doctest_funcs()
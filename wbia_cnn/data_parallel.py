@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Data-parallel CPU training with parameter averaging.
+
+_ModelFitter.fit calls the backprop function serially over the batches of an
+epoch, which leaves most cores of a CPU training box idle. With the
+``train_workers`` behavior (``--train-workers=N``) each learning epoch is
+split over N forked worker processes instead:
+
+    * The parent shuffles the epoch with model._rng (the same draw a
+      single-process epoch makes) and writes the permutation and its current
+      parameters to shared memory.
+    * Worker i learns on batches i, i + N, i + 2N, ... with its own copy of
+      the compiled backprop function (inherited through the fork, so it is
+      compiled once).
+    * Every ``sync_freq`` batches (and at the end of the epoch) the workers
+      write their parameters to shared memory, each averages a disjoint slice
+      of the parameter vector, and all of them continue from the average.
+    * The parent collects the per-batch outputs in batch order and computes
+      the learn_info, History, and checkpoints from them as usual.
+
+This is local SGD, not a faster way to run the same epoch: between averages
+each worker takes up to sync_freq steps from the last average using only its
+own batches, so the batch losses and the final parameters differ from those
+of a single-process epoch (see the example of process_epoch). A sync_freq of
+1 stays closest to serial training. Momentum velocities stay local to each
+worker. Validation, checkpoints, and monitoring run in the parent as before.
+
+CommandLine:
+    python -m wbia_cnn.data_parallel benchmark_data_parallel
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import sys
+import time
+import traceback
+import numpy as np
+import utool as ut
+from six.moves import range, queue
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+def _worker_init(model):
+    try:
+        import cv2
+
+        # The OpenCV thread pool of the parent does not survive the fork
+        cv2.setNumThreads(0)
+    except ImportError:
+        pass
+    if 'parallel' in ut.get_func_argspec(model.augment).args:
+        # Daemonic workers cannot start process pools of their own
+        model.augment = ut.partial(model.augment, parallel=False)
+
+
+def _worker_main(learner, worker_index):
+    _worker_init(learner.model)
+    task_queue = learner._task_queues[worker_index]
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        try:
+            result = ('done', learner._learn_shard(worker_index, task))
+        except Exception:
+            # Release the workers that wait for this one at a barrier
+            learner._barrier.abort()
+            result = ('error', traceback.format_exc())
+        learner._result_queue.put((worker_index, result))
+
+
+@ut.reloadable_class
+class DataParallelLearner(ut.NiceRepr):
+    """
+    Worker processes that learn on the shards of each epoch.
+
+    The workers are forked with the learning data, so a learner only serves
+    the X, y, and w it was created with (see process_epoch).
+
+    Args:
+        model (BaseModel): model with an initialized architecture
+        theano_fn (theano.function): compiled backprop function
+        X, y, w (ndarray): learning data, labels, and weights
+        num_workers (int): number of worker processes
+        sync_freq (int): number of batches each worker learns between
+            parameter averages
+    """
+
+    def __init__(learner, model, theano_fn, X, y, w, num_workers=2, sync_freq=8):
+        import multiprocessing
+
+        ctx = multiprocessing.get_context('fork')
+        learner.model = model
+        learner.theano_fn = theano_fn
+        learner.X, learner.y, learner.w = X, y, w
+        learner.num_workers = num_workers
+        learner.sync_freq = max(1, sync_freq)
+
+        learner.param_list = model.get_all_params()
+        shapes = [param.get_value(borrow=True).shape for param in learner.param_list]
+        learner._shapes = shapes
+        learner._offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes])
+        num_values = int(learner._offsets[-1])
+        num_labels = X.shape[0] // model.data_per_label_input
+        # Shared memory: averaged params, one param slot per worker, and the
+        # epoch permutation
+        learner._params_raw = ctx.RawArray('f', num_values)
+        learner._slots_raw = ctx.RawArray('f', num_values * num_workers)
+        learner._perm_raw = ctx.RawArray('q', max(num_labels, 1))
+        learner._barrier = ctx.Barrier(num_workers)
+        learner._task_queues = [ctx.Queue() for _ in range(num_workers)]
+        learner._result_queue = ctx.Queue()
+        learner._setup_cache = {}
+        learner._processes = []
+        for worker_index in range(num_workers):
+            proc = ctx.Process(target=_worker_main, args=(learner, worker_index))
+            proc.daemon = True
+            proc.start()
+            learner._processes.append(proc)
+        print('[data_parallel] started %d learning workers' % (num_workers,))
+
+    def __nice__(learner):
+        return 'workers=%d, sync_freq=%d' % (learner.num_workers, learner.sync_freq)
+
+    @property
+    def _params(learner):
+        return np.frombuffer(learner._params_raw, dtype=np.float32)
+
+    @property
+    def _slots(learner):
+        slots = np.frombuffer(learner._slots_raw, dtype=np.float32)
+        return slots.reshape(learner.num_workers, -1)
+
+    @property
+    def _perm(learner):
+        return np.frombuffer(learner._perm_raw, dtype=np.int64)
+
+    def serves(learner, theano_fn, X, y, w):
+        """
+        True if the workers were forked with this function and data and are
+        all still running (a closed learner has no workers)
+        """
+        return (
+            learner.theano_fn is theano_fn
+            and learner.X is X
+            and learner.y is y
+            and learner.w is w
+            and len(learner._processes) == learner.num_workers
+            and all(proc.is_alive() for proc in learner._processes)
+        )
+
+    def _dump_params(learner, flat):
+        offsets = learner._offsets
+        for index, param in enumerate(learner.param_list):
+            value = param.get_value(borrow=True)
+            flat[offsets[index] : offsets[index + 1]] = value.ravel()
+
+    def _load_params(learner, flat):
+        offsets = learner._offsets
+        for index, param in enumerate(learner.param_list):
+            value = flat[offsets[index] : offsets[index + 1]]
+            value = value.reshape(learner._shapes[index]).astype(param.dtype)
+            param.set_value(value)
+
+    def _sync(learner, worker_index):
+        """ Averages the parameters of all workers (runs in every worker) """
+        slots = learner._slots
+        learner._dump_params(slots[worker_index])
+        learner._barrier.wait()
+        # Each worker averages its own slice of the parameter vector
+        num_values = slots.shape[1]
+        start = num_values * worker_index // learner.num_workers
+        stop = num_values * (worker_index + 1) // learner.num_workers
+        np.mean(slots[:, start:stop], axis=0, out=learner._params[start:stop])
+        learner._barrier.wait()
+        learner._load_params(learner._params)
+
+    def _setup(learner, augment_on):
+        if augment_on not in learner._setup_cache:
+            setup = learner.model._setup_batches(
+                learner.X, learner.y, learner.w, augment_on=augment_on
+            )
+            learner._setup_cache[augment_on] = setup[3:6]
+        return learner._setup_cache[augment_on]
+
+    def _get_batch(learner, batch_index, slice_kw, prep_kw):
+        from wbia_cnn.models import abstract_models
+
+        model = learner.model
+        data_per_label = slice_kw['data_per_label']
+        num_labels = slice_kw['batch_size'] // data_per_label
+        label_idx = learner._perm[batch_index * num_labels : (batch_index + 1) * num_labels]
+        data_idx = model.expand_data_indicies(label_idx, data_per_label)
+        Xb_ = abstract_models._gather_rows(learner.X, data_idx)
+        yb_ = None if learner.y is None else learner.y.take(label_idx, axis=0)
+        wb_ = None if learner.w is None else learner.w.take(label_idx, axis=0)
+        # Pads a short final batch when the batch size is fixed
+        Xb_, yb_, wb_ = model.slice_batch(Xb_, yb_, wb_, batch_index=0, **slice_kw)
+        return model._prepare_batch(Xb_, yb_, wb_, **prep_kw)
+
+    def _learn_shard(learner, worker_index, task):
+        """ Runs in a worker. Returns (batch_index, outputs, yb) tuples """
+        import random
+
+        model = learner.model
+        # Start from the parameters and learning state of the parent
+        learner._load_params(learner._params)
+        for key, value in task['learn_state'].items():
+            shared = model.learn_state.shared.get(key, None)
+            if shared is not None and value is not None:
+                shared.set_value(np.float32(value))
+        num_batches, slice_kw, prep_kw = learner._setup(task['augment_on'])
+        seed_list = task['seed_list']
+        num_rounds = (num_batches + learner.num_workers - 1) // learner.num_workers
+        result_list = []
+        for round_index in range(num_rounds):
+            batch_index = round_index * learner.num_workers + worker_index
+            if batch_index < num_batches:
+                seed = int(seed_list[batch_index])
+                random.seed(seed)
+                np.random.seed(seed)
+                model._rng = np.random.RandomState(seed)
+                Xb, yb, wb = learner._get_batch(batch_index, slice_kw, prep_kw)
+                batch_output = learner.theano_fn(Xb, yb, wb)
+                result_list.append((batch_index, batch_output, yb))
+            is_last = round_index == num_rounds - 1
+            if (round_index + 1) % learner.sync_freq == 0 or is_last:
+                learner._sync(worker_index)
+        return result_list
+
+    def learn_epoch(learner, augment_on=False, accumulate=False):
+        """
+        Learns one epoch over all workers. Returns the outputs in the format of
+        process_batch (an EpochMetrics with accumulate=True), and leaves the
+        averaged parameters in the model.
+        """
+        model = learner.model
+        num_labels = learner.X.shape[0] // model.data_per_label_input
+        num_batches = learner._setup(augment_on)[0]
+        # Same draw as the shuffle of a single-process epoch
+        learner._perm[0:num_labels] = ut.random_indexes(num_labels, rng=model._rng)
+        seed_list = model._rng.randint(0, 2 ** 31 - 1, size=num_batches)
+        learner._dump_params(learner._params)
+        learn_state = {
+            key: None if value is None else float(value)
+            for key, value in model.learn_state.asdict().items()
+        }
+        task = {'augment_on': augment_on, 'learn_state': learn_state, 'seed_list': seed_list}
+        for task_queue in learner._task_queues:
+            task_queue.put(task)
+
+        all_results = []
+        error_list = []
+        num_pending = learner.num_workers
+        while num_pending > 0:
+            try:
+                worker_index, (status, result) = learner._result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not all(proc.is_alive() for proc in learner._processes):
+                    learner.close()
+                    raise RuntimeError('A data-parallel learning worker died')
+                continue
+            num_pending -= 1
+            if status == 'error':
+                error_list.append(result)
+            else:
+                all_results.extend(result)
+        if error_list:
+            learner.close()
+            # Aborted barriers fail the other workers too, show the cause first
+            error_list = sorted(error_list, key=lambda msg: 'BrokenBarrierError' in msg)
+            raise RuntimeError('Data-parallel learning failed:\n' + error_list[0])
+
+        # The workers finished with identical averaged parameters
+        learner._load_params(learner._params)
+        all_results = sorted(all_results, key=lambda tup: tup[0])
+        if accumulate:
+            epoch_metrics = model._new_epoch_metrics(learner.theano_fn, learner.X)
+            for _, batch_output, yb in all_results:
+                epoch_metrics.update(batch_output, None if learner.y is None else yb)
+            return epoch_metrics
+        output_list = [batch_output for _, batch_output, _ in all_results]
+        aug_yb_list = [yb for _, _, yb in all_results]
+        if learner.y is None:
+            aug_yb_list = None
+        return model._finish_outputs(learner.theano_fn, output_list, aug_yb_list, learner.X)
+
+    def close(learner):
+        for task_queue in learner._task_queues:
+            try:
+                task_queue.put(None)
+            except Exception:
+                pass
+        for proc in learner._processes:
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        learner._processes = []
+        if getattr(learner.model, '_data_parallel', None) is learner:
+            # Never hand a closed learner to the next fit
+            learner.model._data_parallel = None
+
+
+def process_epoch(model, theano_fn, X, y, w, augment_on=False, accumulate=False):
+    """
+    Data-parallel replacement for the learning call of
+    ``model.process_batch(theano_fn, X, y, w, shuffle=True, ...)``. The workers
+    are (re)started whenever the function or the learning data change, e.g.
+    after era_clean relabels y.
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn.data_parallel import *  # NOQA
+        >>> from wbia_cnn.models.dummy import DummyModel
+        >>> # Learn one epoch serially and one over 2 workers from the same
+        >>> # initial weights and shuffle
+        >>> weights_list = None
+        >>> learn_losses = []
+        >>> for num_workers in [0, 2]:
+        >>>     model = DummyModel(batch_size=16, compile_cache=False)
+        >>>     model._behavior['train_workers'] = num_workers
+        >>>     X, y = model.make_random_testdata(num=256, cv2_format=True, asint=True)
+        >>>     model.ensure_data_params(X, y)
+        >>>     model.init_arch(verbose=False)
+        >>>     if weights_list is None:
+        >>>         weights_list = model.get_all_param_values()
+        >>>     model.set_all_param_values(weights_list)
+        >>>     model._rng = np.random.RandomState(0)
+        >>>     w = model._default_input_weights(X, y)
+        >>>     model._new_fit_session()
+        >>>     theano_backprop = model.build_backprop_func()
+        >>>     learn_info = model._epoch_learn(theano_backprop, X, y, w, epoch=1)
+        >>>     learn_losses.append(float(learn_info['learn_loss']))
+        >>>     model._close_fit_session()
+        >>> serial_loss, parallel_loss = learn_losses
+        >>> # The losses are not equal (see the module docstring) but the
+        >>> # averaged first epoch stays within 10% of the serial one
+        >>> assert np.isclose(parallel_loss, serial_loss, rtol=0.1), learn_losses
+    """
+    learner = getattr(model, '_data_parallel', None)
+    if learner is None or not learner.serves(theano_fn, X, y, w):
+        if learner is not None:
+            learner.close()
+        learner = DataParallelLearner(
+            model,
+            theano_fn,
+            X,
+            y,
+            w,
+            num_workers=model._behavior['train_workers'],
+            sync_freq=model._behavior['sync_freq'],
+        )
+        model._data_parallel = learner
+    return learner.learn_epoch(augment_on=augment_on, accumulate=accumulate)
+
+
+def benchmark_data_parallel(
+    model_class='DummyModel',
+    data_shape=(32, 32, 3),
+    num_workers_list=[1, 2, 4],
+    num=4096,
+    batch_size=64,
+    num_epochs=3,
+):
+    """
+    Measures the seconds per learning epoch for different numbers of workers
+
+    CommandLine:
+        python -m wbia_cnn.data_parallel benchmark_data_parallel
+        python -m wbia_cnn.data_parallel benchmark_data_parallel --model=MNISTModel --shape=28,28,1
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn.data_parallel import *  # NOQA
+        >>> model_class = ut.get_argval('--model', default='DummyModel')
+        >>> data_shape = tuple(ut.get_argval('--shape', type_=list, default=[32, 32, 3]))
+        >>> result = benchmark_data_parallel(model_class, data_shape)
+        >>> print(ut.repr4(result, precision=3))
+    """
+    from wbia_cnn import models
+
+    result = ut.odict()
+    for num_workers in num_workers_list:
+        model = getattr(models, model_class)(
+            batch_size=batch_size,
+            data_shape=data_shape,
+            output_dims=10,
+            compile_cache=False,
+            showprog=False,
+        )
+        model._behavior['train_workers'] = num_workers
+        X, y = model.make_random_testdata(num=num, cv2_format=True, asint=True)
+        model.ensure_data_params(X, y)
+        model.init_arch(verbose=False)
+        w = model._default_input_weights(X, y)
+        model._new_fit_session()
+        theano_backprop = model.build_backprop_func()
+        # The first epoch starts the workers
+        model._epoch_learn(theano_backprop, X, y, w, epoch=1)
+        start = time.time()
+        for epoch in range(2, num_epochs + 2):
+            learn_info = model._epoch_learn(theano_backprop, X, y, w, epoch=epoch)
+        result[num_workers] = ut.odict(
+            [
+                ('sec_per_epoch', (time.time() - start) / num_epochs),
+                ('learn_loss', float(learn_info['learn_loss'])),
+            ]
+        )
+        if getattr(model, '_data_parallel', None) is not None:
+            model._data_parallel.close()
+            model._data_parallel = None
+        sys.stdout.flush()
+    base = result[num_workers_list[0]]['sec_per_epoch']
+    for num_workers in num_workers_list:
+        result[num_workers]['speedup'] = base / result[num_workers]['sec_per_epoch']
+    return result
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.data_parallel
+        python -m wbia_cnn.data_parallel --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
@@ -19,6 +19,14 @@ class DataSet(ut.NiceRepr):
     CommandLine:
         python -m wbia_cnn.dataset DataSet
 
+    Note:
+        When ext='.npy' the full data and labels are written once as raw numpy
+        arrays, splits are stored as index arrays into them, and subsets are
+        opened as read-only memory maps. Several training processes on one host
+        then share the same page cache instead of each holding a copy. The
+        data of a non-contiguous split is a MemmapSubset that the batcher
+        gathers from one batch at a time.
+
     Example:
         >>> from wbia_cnn.ingest_data import *  # NOQA
         >>> dataset = grab_mnist_category_dataset()
@@ -115,7 +123,14 @@ class DataSet(ut.NiceRepr):
 
     @property
     def metadata_fpath(dataset):
-        return join(dataset.full_dpath, '%s_metadata%s' % (dataset.hashid, dataset._ext))
+        # metadata is a dict of lists, which cannot be stored as a raw array
+        ext = '.pkl' if dataset.is_memmap else dataset._ext
+        return join(dataset.full_dpath, '%s_metadata%s' % (dataset.hashid, ext))
+
+    @property
+    def is_memmap(dataset):
+        """ True if the data is stored as raw .npy arrays opened as memmaps """
+        return dataset._ext == '.npy'
 
     @classmethod
     def new_training_set(cls, **kwargs):
@@ -185,25 +200,79 @@ class DataSet(ut.NiceRepr):
         data_dict = ut.dict_subset(dataset.__dict__, key_list)
         return data_dict
 
+    def _load_array(dataset, fpath):
+        if dataset.is_memmap:
+            print('[dataset] memmapping %s' % (fpath,))
+            return np.load(fpath, mmap_mode='r')
+        else:
+            return ut.load_data(fpath, verbose=True)
+
+    @ut.memoize
+    def subset_indices(dataset, key):
+        """
+        Returns the sorted indices of a split into the full arrays, or None if
+        the split is stored as a copy of the data.
+        """
+        idxs_fpath = dataset.fpath_dict[key].get('idxs', None)
+        if idxs_fpath is None:
+            return None
+        return np.load(idxs_fpath)
+
+    def _take_subset(dataset, key, full, data_per_label=1, lazy=False):
+        """
+        Indexes a split of labels out of a full array with data_per_label
+        items per label. Contiguous splits are zero-copy views into the
+        memmap. Other splits are wrapped in a MemmapSubset if lazy is True,
+        and otherwise gathered in sorted order so the file is read
+        sequentially.
+        """
+        idxs = dataset.subset_indices(key)
+        slice_ = contiguous_slice(idxs)
+        if slice_ is not None:
+            return full[
+                slice_.start * data_per_label : slice_.stop * data_per_label
+            ]
+        rows = expand_data_indicies(idxs, data_per_label)
+        if lazy and isinstance(full, np.memmap):
+            return MemmapSubset(full, rows)
+        print(
+            '[dataset] split %r is not contiguous, gathering %d rows' % (key, len(rows))
+        )
+        return full.take(rows, axis=0)
+
     @ut.memoize
     def subset_data(dataset, key='full'):
+        if key != 'full' and 'idxs' in dataset.fpath_dict[key]:
+            full_data = dataset.subset_data('full')
+            # Splits index labels, each of which owns data_per_label items
+            data_per_label = dataset._info['data_per_label'] or 1
+            return dataset._take_subset(key, full_data, data_per_label, lazy=True)
         data_fpath = dataset.fpath_dict[key]['data']
-        data = ut.load_data(data_fpath, verbose=True)
+        data = dataset._load_array(data_fpath)
         if len(data.shape) == 3:
             # add channel dimension for implicit grayscale
-            data.shape = data.shape + (1,)
+            data = data.reshape(data.shape + (1,))
         return data
 
     @ut.memoize
     def subset_labels(dataset, key='full'):
+        if key != 'full' and 'idxs' in dataset.fpath_dict[key]:
+            full_labels = dataset.subset_labels('full')
+            if full_labels is None:
+                return None
+            return dataset._take_subset(key, full_labels)
         labels_fpath = dataset.fpath_dict[key]['labels']
-        labels = (
-            None if labels_fpath is None else ut.load_data(labels_fpath, verbose=True)
-        )
+        labels = None if labels_fpath is None else dataset._load_array(labels_fpath)
         return labels
 
     @ut.memoize
     def subset_metadata(dataset, key='full'):
+        if key != 'full' and 'idxs' in dataset.fpath_dict[key]:
+            full_metadata = dataset.subset_metadata('full')
+            if full_metadata is None:
+                return None
+            taker = ut.partial(ut.take, index_list=dataset.subset_indices(key))
+            return ut.map_dict_vals(taker, full_metadata)
         metadata_fpath = dataset.fpath_dict[key].get('metadata', None)
         if metadata_fpath is not None:
             flat_metadata = ut.load_data(metadata_fpath, verbose=True)
@@ -216,6 +285,7 @@ class DataSet(ut.NiceRepr):
             dataset.subset_data,
             dataset.subset_labels,
             dataset.subset_metadata,
+            dataset.subset_indices,
         ]
         if key is None:
             for cached_func in cached_func_list:
@@ -324,7 +394,7 @@ class DataSet(ut.NiceRepr):
             fpath_dict[key] = splitset
         # check validity of loaded data
         for key, val in fpath_dict.items():
-            assert 'data' in val, 'subset missing data'
+            assert 'data' in val or 'idxs' in val, 'subset missing data'
         dataset.fpath_dict.update(**fpath_dict)
 
     def load(dataset):
@@ -342,12 +412,22 @@ class DataSet(ut.NiceRepr):
             dataset.fpath_dict['full']['metadata'] = None
 
     def save(dataset, data, labels, metadata=None, data_per_label=1):
-        ut.save_data(dataset.data_fpath, data)
-        ut.save_data(dataset.labels_fpath, labels)
+        if dataset.is_memmap:
+            ut.ensuredir(dataset.full_dpath)
+            np.save(dataset.data_fpath, np.ascontiguousarray(data))
+            np.save(dataset.labels_fpath, np.ascontiguousarray(labels))
+        else:
+            ut.save_data(dataset.data_fpath, data)
+            ut.save_data(dataset.labels_fpath, labels)
         if metadata is not None:
             ut.save_data(dataset.metadata_fpath, metadata)
         else:
             dataset.fpath_dict['full']['metadata'] = None
+        if dataset.is_memmap:
+            # Drop the reference to the in-memory copy in favor of the memmap
+            dataset.clear_cache()
+            data = dataset.subset_data('full')
+            labels = dataset.subset_labels('full')
         # cache the data because it is likely going to be used to define a
         # splitset
         dataset.subset_data.cache['full'] = data
@@ -369,6 +449,15 @@ class DataSet(ut.NiceRepr):
         ext = dataset._ext
         fmtdict = dict(key=key, ext=ext, size=len(idxs))
         fmtstr = dataset.get_split_fmtstr(forward=True)
+        if dataset.is_memmap:
+            # Only store the indices, subsets are views into the full arrays.
+            # The order within a split is irrelevant (batches are shuffled),
+            # so sort them to keep reads sequential and ranges contiguous.
+            idxs_fpath = join(dataset.split_dpath, fmtstr.format(type_='idxs', **fmtdict))
+            np.save(idxs_fpath, np.sort(np.asarray(idxs, dtype=np.int64)))
+            dataset.fpath_dict[key] = {'idxs': idxs_fpath}
+            dataset.clear_cache(key)
+            return
         splitset = {
             type_: join(dataset.split_dpath, fmtstr.format(type_=type_, **fmtdict))
             for type_ in ['data', 'labels', 'metadata']
@@ -434,6 +523,111 @@ class DataSet(ut.NiceRepr):
     #         dataset.fpath_dict[key] = splitset
 
 
+class MemmapSubset(object):
+    """
+    Read-only rows of a memory-mapped array selected by an index array.
+
+    Splits of memmapped datasets are random permutations, so taking them out
+    of the full array copied the split into the memory of every trainer. A
+    MemmapSubset only holds the row indices: indexing, slicing, and take
+    gather just the requested rows (in sorted order, see
+    abstract_models._gather_rows), so the batcher reads one batch at a time
+    from the shared page cache. np.asarray materializes the whole subset.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.dataset import *  # NOQA
+        >>> dpath = ut.ensure_app_resource_dir('wbia_cnn', 'test_memmap_subset')
+        >>> fpath = join(dpath, 'data.npy')
+        >>> np.save(fpath, np.arange(20).reshape(10, 2))
+        >>> full = np.load(fpath, mmap_mode='r')
+        >>> subset = MemmapSubset(full, np.array([7, 2, 9, 4]))
+        >>> print(subset.shape, subset[1:3].tolist(), subset[0, 1])
+        (4, 2) [[4, 5], [18, 19]] 15
+        >>> print(subset.take([3, 0], axis=0).tolist())
+        [[8, 9], [14, 15]]
+        >>> assert np.all(np.asarray(subset) == full[[7, 2, 9, 4]])
+    """
+
+    def __init__(subset, full, rows):
+        subset.full = full
+        subset.rows = np.asarray(rows, dtype=np.int64)
+
+    def __repr__(subset):
+        return '<MemmapSubset(shape=%r, dtype=%r)>' % (subset.shape, subset.dtype)
+
+    @property
+    def shape(subset):
+        return (len(subset.rows),) + subset.full.shape[1:]
+
+    @property
+    def dtype(subset):
+        return subset.full.dtype
+
+    @property
+    def ndim(subset):
+        return subset.full.ndim
+
+    @property
+    def size(subset):
+        return int(np.prod(subset.shape))
+
+    def __len__(subset):
+        return len(subset.rows)
+
+    def _gather(subset, rows):
+        from wbia_cnn.models.abstract_models import _gather_rows
+
+        return _gather_rows(subset.full, rows)
+
+    def __getitem__(subset, index):
+        rest = ()
+        if isinstance(index, tuple):
+            index, rest = index[0], index[1:]
+        rows = subset.rows[index]
+        if np.ndim(rows) == 0:
+            return subset.full[(rows,) + rest]
+        data = subset._gather(rows)
+        return data[(slice(None),) + rest] if rest else data
+
+    def take(subset, indices, axis=0):
+        if axis != 0:
+            return np.asarray(subset).take(indices, axis=axis)
+        return subset._gather(subset.rows.take(indices, axis=0))
+
+    def __array__(subset, dtype=None):
+        data = subset._gather(subset.rows)
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def astype(subset, dtype, copy=True):
+        return np.asarray(subset).astype(dtype, copy=False)
+
+    def ravel(subset):
+        return np.asarray(subset).ravel()
+
+
+def contiguous_slice(idxs):
+    """
+    Returns a slice equivalent to a sorted index array if the indices form a
+    contiguous range, otherwise None.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.dataset import *  # NOQA
+        >>> print(contiguous_slice(np.arange(3, 7)))
+        >>> print(contiguous_slice(np.array([1, 2, 4])))
+        slice(3, 7, None)
+        None
+    """
+    idxs = np.asarray(idxs)
+    if len(idxs) == 0:
+        return slice(0, 0)
+    start, stop = int(idxs[0]), int(idxs[-1]) + 1
+    if stop - start == len(idxs) and np.all(np.diff(idxs) == 1):
+        return slice(start, stop)
+    return None
+
+
 def get_alias_dict_fpath():
     alias_fpath = join(get_juction_dpath(), 'alias_dict_v2.txt')
     return alias_fpath
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming accumulators for the per-epoch learning and validation metrics.
+
+_epoch_learn and _epoch_validate used to keep the outputs of every batch,
+concatenate them at the end of the epoch, and run
+sklearn.metrics.precision_recall_fscore_support over the concatenated
+predictions, so memory and end-of-epoch latency grew with the epoch size.
+
+EpochMetrics is updated with the outputs of each batch and then dropped:
+
+    * scalar outputs (loss, loss_determ, loss_reg, accuracy,
+      param_update_magnitude_*) keep a running count, sum, and sum of
+      squares. Each batch is weighted by its number of real (unpadded)
+      items, so a short final batch counts for what it holds and the mean is
+      over items rather than over batches;
+    * loss outputs also fill a fixed log-spaced histogram that counts every
+      item at the loss of its batch;
+    * predictions update a confusion matrix (or per-class counts for
+      multi-label indicator outputs) together with the labels of the batch.
+
+Precision, recall, F-score, support, and accuracy are derived from the counts
+at the end of the epoch, so the state is O(classes ** 2) regardless of the
+epoch size. Outputs of the zero-padded final batch are not counted.
+
+CommandLine:
+    python -m wbia_cnn.epoch_metrics --allexamples
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import numpy as np
+import utool as ut
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+# Edges of the loss histogram: under / overflow bins around 24 log bins
+LOSS_HIST_EDGES = np.hstack([[-np.inf], np.logspace(-4, 2, 25), [np.inf]])
+
+
+class _RunningStat(object):
+    def __init__(stat):
+        stat.count = 0
+        stat.total = 0.0
+        stat.total_sq = 0.0
+
+    def update(stat, value, weight=1):
+        value = np.asarray(value, dtype=np.float64)
+        stat.count += weight * value.size
+        stat.total += weight * value.sum()
+        stat.total_sq += weight * (value ** 2).sum()
+
+    def mean(stat):
+        return stat.total / stat.count if stat.count > 0 else np.nan
+
+    def std(stat):
+        if stat.count == 0:
+            return np.nan
+        mean = stat.mean()
+        return np.sqrt(max(stat.total_sq / stat.count - mean ** 2, 0.0))
+
+
+@ut.reloadable_class
+class EpochMetrics(ut.NiceRepr):
+    """
+    Accumulates the outputs of process_batch one batch at a time.
+
+    Args:
+        output_names (list): names of the theano function outputs
+        num_outputs (int): number of unpadded per-item outputs of the epoch
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.epoch_metrics import *  # NOQA
+        >>> import sklearn.metrics
+        >>> rng = np.random.RandomState(0)
+        >>> y = rng.randint(0, 3, 50)
+        >>> pred = np.where(rng.rand(50) < .7, y, rng.randint(0, 4, 50))
+        >>> metrics = EpochMetrics(['loss', 'predictions'], num_outputs=50)
+        >>> for start in range(0, 64, 16):
+        >>>     # The final batch is padded to 16 items
+        >>>     yb, pb = np.zeros(16, int), np.zeros(16, int)
+        >>>     yb[0:len(y[start:start + 16])] = y[start:start + 16]
+        >>>     pb[0:len(y[start:start + 16])] = pred[start:start + 16]
+        >>>     metrics.update([np.float32(start + 1), pb], yb)
+        >>> p, r, f, s = metrics.precision_recall_fscore_support()
+        >>> p2, r2, f2, s2 = sklearn.metrics.precision_recall_fscore_support(y, pred)
+        >>> assert np.allclose(p, p2) and np.allclose(r, r2) and np.allclose(f, f2)
+        >>> assert np.all(s == s2)
+        >>> assert np.isclose(metrics.accuracy(), np.mean(y == pred))
+        >>> # Batches are weighted by their 16, 16, 16, and 2 real items
+        >>> losses = np.repeat([1, 17, 33, 49], [16, 16, 16, 2])
+        >>> assert np.isclose(metrics.mean('loss'), losses.mean())
+        >>> assert np.isclose(metrics.std('loss'), losses.std())
+        >>> print(metrics.loss_hist('loss').sum())
+        50
+    """
+
+    def __init__(metrics, output_names, num_outputs=None):
+        metrics.output_names = list(output_names)
+        metrics.num_outputs = num_outputs
+        metrics.num_batches = 0
+        metrics._stats = ut.odict()
+        metrics._loss_hists = {}
+        # Number of per-item outputs seen, including padding
+        metrics._num_seen = 0
+        # Scored labels
+        metrics.num_scored = 0
+        metrics.num_correct = 0
+        metrics._confusion = None
+        # Per-class true positive, predicted, and true counts of multi-label
+        # indicator outputs
+        metrics._multilabel = None
+
+    def __nice__(metrics):
+        return 'batches=%d, scored=%d' % (metrics.num_batches, metrics.num_scored)
+
+    def update(metrics, batch_outputs, yb=None):
+        """
+        Args:
+            batch_outputs (list): outputs of the theano function on one batch
+            yb (ndarray): labels of the batch (None when predicting)
+        """
+        outputs = list(zip(metrics.output_names, batch_outputs))
+        predictions = None
+        for name, value in outputs:
+            if name == 'predictions':
+                predictions = np.asarray(value)
+        # The number of items of the batch, including padding
+        batch_len = None
+        if predictions is not None:
+            batch_len = len(predictions)
+        else:
+            lens = [len(value) for name, value in outputs if np.ndim(value) > 0]
+            if len(lens) > 0:
+                batch_len = lens[0]
+            elif yb is not None:
+                batch_len = len(yb)
+        if batch_len is None:
+            # Nothing tells how many items the batch holds
+            num = 1
+        else:
+            num = batch_len
+            if metrics.num_outputs is not None:
+                # Drop the padding of the final batch
+                num = max(min(num, metrics.num_outputs - metrics._num_seen), 0)
+            metrics._num_seen += batch_len
+        for name, value in outputs:
+            if np.ndim(value) == 0:
+                stat = metrics._stats.get(name, None)
+                if stat is None:
+                    stat = metrics._stats[name] = _RunningStat()
+                stat.update(value, weight=num)
+                if name.startswith('loss'):
+                    counts = np.histogram(value, bins=LOSS_HIST_EDGES)[0] * num
+                    if name in metrics._loss_hists:
+                        metrics._loss_hists[name] += counts
+                    else:
+                        metrics._loss_hists[name] = counts
+        metrics.num_batches += 1
+        if predictions is None:
+            return
+        if yb is not None and num > 0:
+            metrics._update_counts(np.asarray(yb)[0:num], predictions[0:num])
+
+    def _update_counts(metrics, yb, pb):
+        if pb.ndim == 1 and yb.ndim == 1:
+            isvalid = yb >= 0
+            yb = yb[isvalid].astype(np.int64)
+            pb = pb[isvalid].astype(np.int64)
+            num_classes = int(max(yb.max(initial=-1), pb.max(initial=-1))) + 1
+            confusion = metrics._confusion
+            if confusion is None or len(confusion) < num_classes:
+                new_confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+                if confusion is not None:
+                    new_confusion[: len(confusion), : len(confusion)] = confusion
+                confusion = metrics._confusion = new_confusion
+            num_classes = len(confusion)
+            confusion += np.bincount(
+                yb * num_classes + pb, minlength=num_classes ** 2
+            ).reshape(num_classes, num_classes)
+            metrics.num_scored += len(yb)
+            metrics.num_correct += int((yb == pb).sum())
+        elif pb.shape == yb.shape and pb.ndim == 2:
+            yb = yb.astype(bool)
+            pb = pb.astype(bool)
+            counts = np.vstack([(yb & pb).sum(axis=0), pb.sum(axis=0), yb.sum(axis=0)])
+            if metrics._multilabel is None:
+                metrics._multilabel = counts
+            else:
+                metrics._multilabel += counts
+            metrics.num_scored += len(yb)
+            metrics.num_correct += int(np.all(yb == pb, axis=1).sum())
+
+    def has(metrics, name):
+        return name in metrics._stats
+
+    def stat_names(metrics):
+        return list(metrics._stats.keys())
+
+    def mean(metrics, name):
+        """ Mean of a scalar output over the items of the batches """
+        return metrics._stats[name].mean()
+
+    def std(metrics, name):
+        """ Standard deviation of a scalar output over the items of the batches """
+        return metrics._stats[name].std()
+
+    def loss_hist(metrics, name):
+        """ Counts of items by their batch loss in the bins of LOSS_HIST_EDGES """
+        return metrics._loss_hists[name].copy()
+
+    def has_predictions(metrics):
+        return metrics._confusion is not None or metrics._multilabel is not None
+
+    def accuracy(metrics):
+        """
+        Fraction of correctly predicted labels (exact matches for multi-label
+        outputs), or the item weighted mean of the accuracy output without
+        predictions
+        """
+        if metrics.num_scored > 0:
+            return metrics.num_correct / metrics.num_scored
+        return metrics.mean('accuracy')
+
+    def confusion(metrics):
+        return None if metrics._confusion is None else metrics._confusion.copy()
+
+    def precision_recall_fscore_support(metrics):
+        """
+        Per-class precision, recall, F1-score, and support in the layout of
+        sklearn.metrics.precision_recall_fscore_support (classes that occur
+        in neither the labels nor the predictions are left out).
+        """
+        if metrics._confusion is not None:
+            confusion = metrics._confusion
+            true_counts = confusion.sum(axis=1)
+            pred_counts = confusion.sum(axis=0)
+            present = (true_counts + pred_counts) > 0
+            tp = np.diag(confusion)[present]
+            true_counts = true_counts[present]
+            pred_counts = pred_counts[present]
+        elif metrics._multilabel is not None:
+            tp, pred_counts, true_counts = metrics._multilabel
+        else:
+            raise ValueError('no predictions were accumulated')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(pred_counts > 0, tp / pred_counts, 0.0)
+            recall = np.where(true_counts > 0, tp / true_counts, 0.0)
+            denom = precision + recall
+            fscore = np.where(denom > 0, 2 * precision * recall / denom, 0.0)
+        return precision, recall, fscore, true_counts
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.epoch_metrics
+        python -m wbia_cnn.epoch_metrics --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
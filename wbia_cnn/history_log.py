@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only log of a training History.
+
+The monitor used to rewrite era_history.txt with History.to_json after every
+epoch, so the cost of each write grew with the length of the run. An EpochLog
+is a JSON lines file that gets one line per era and one line per epoch as
+they are recorded::
+
+    {"era": {"arch_hashid": ..., "learn_state": ..., ...}}
+    {"epoch": {"epoch_num": 0, "era_num": 0, "learn_loss": ..., ...}}
+
+Array values (e.g. per-class precision) are written as lists. A rewind of the
+History appends a ``{"rewind": [num_eras, num_epochs]}`` line. ``read_log``
+rebuilds a History from the file, so the log of a crashed run is usable.
+
+Because the file is append-only, its size after a sync identifies the
+History at that moment. Checkpoints and monitor frames store a HistoryLogRef
+(the path and that size) instead of pickling the whole History, and a
+LogReader rebuilds it, reading only the lines it has not seen yet.
+
+The in-memory side lives in History: it keeps growable float columns of the
+numeric epoch measures (History.get_column, History.era_bounds) and caches
+the era hashes behind hist_id.
+
+CommandLine:
+    python -m wbia_cnn.history_log --allexamples
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import io
+import json
+from os.path import join, dirname, isabs, normpath, exists, abspath
+import numpy as np
+import utool as ut
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if hasattr(value, 'asdict'):
+        return value.asdict()
+    raise TypeError('%r is not JSON serializable' % (type(value),))
+
+
+@ut.reloadable_class
+class EpochLog(ut.NiceRepr):
+    """
+    Appends the eras and epochs of a History to a JSON lines file.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.history_log import *  # NOQA
+        >>> from wbia_cnn.models.abstract_models import History
+        >>> dpath = ut.ensure_app_resource_dir('wbia_cnn', 'test_history_log')
+        >>> fpath = ut.unixjoin(dpath, 'era_history.jsonl')
+        >>> ut.delete(fpath)
+        >>> history = History()
+        >>> history.era_list.append({'num_learn': 10})
+        >>> history._record_epoch({'learn_loss': 1.0, 'valid_loss': 2.0})
+        >>> history.attach_log(fpath)
+        >>> history._record_epoch({'learn_loss': 0.5, 'valid_loss': np.float32(1.5),
+        >>>                        'valid_precision': np.array([.5, .25])})
+        >>> ref = history.log_ref()
+        >>> history._record_epoch({'learn_loss': 0.25, 'valid_loss': 1.25})
+        >>> history.close_log()
+        >>> history2 = read_log(fpath)
+        >>> assert len(history2) == 3 and history2.total_eras == 1
+        >>> print(history2.get_column('valid_loss'))
+        [2.   1.5  1.25]
+        >>> print(history2.epoch_list[1]['valid_precision'])
+        [0.5, 0.25]
+        >>> # The reference still resolves to the history at the time it was taken
+        >>> print(len(ref.resolve()))
+        2
+    """
+
+    def __init__(log, fpath):
+        log.fpath = abspath(fpath)
+        ut.ensuredir(dirname(log.fpath))
+        log.num_eras = 0
+        log.num_epochs = 0
+        log._file = io.open(fpath, 'a', encoding='utf8')
+        # Size of the file after the last complete line
+        log.nbytes = log._file.tell()
+
+    def __nice__(log):
+        return '%s, eras=%d, epochs=%d' % (log.fpath, log.num_eras, log.num_epochs)
+
+    def _write(log, row):
+        line = json.dumps(row, default=_json_default, sort_keys=True)
+        log._file.write(line + '\n')
+
+    def sync(log, history):
+        """ Appends the eras and epochs of history that are not logged yet """
+        for era in history.era_list[log.num_eras :]:
+            log._write({'era': era})
+        log.num_eras = history.total_eras
+        for epoch_info in history.epoch_list[log.num_epochs :]:
+            log._write({'epoch': epoch_info})
+        log.num_epochs = history.total_epochs
+        log._flush()
+
+    def rewind(log, history):
+        """ Records that history was truncated """
+        log._write({'rewind': [history.total_eras, history.total_epochs]})
+        log.num_eras = history.total_eras
+        log.num_epochs = history.total_epochs
+        log._flush()
+
+    def _flush(log):
+        log._file.flush()
+        log.nbytes = log._file.tell()
+
+    def close(log):
+        log._file.close()
+
+
+def session_log_fpath(arch_dpath, session_dpath):
+    """
+    Path of the log of a fit session. The logs are kept outside of the
+    session directories, which are renamed when the next session starts, so
+    the references held by checkpoints stay valid.
+    """
+    from os.path import basename
+
+    session_dname = basename(normpath(session_dpath))
+    return join(arch_dpath, 'history_logs', session_dname + '.jsonl')
+
+
+class HistoryLogRef(object):
+    """
+    Stands in for a History in checkpoints and monitor frames: the first
+    nbytes of the EpochLog at fpath. A relative fpath is relative to the
+    directory of the pickle holding the reference.
+    """
+
+    def __init__(self, fpath, nbytes):
+        self.fpath = fpath
+        self.nbytes = nbytes
+
+    def __repr__(self):
+        return 'HistoryLogRef(%r, %r)' % (self.fpath, self.nbytes)
+
+    def relative_to(self, dpath):
+        from os.path import relpath
+
+        return HistoryLogRef(relpath(self.fpath, dpath), self.nbytes)
+
+    def resolve(self, dpath=None):
+        """ Rebuilds the referenced History """
+        fpath = self.fpath
+        if dpath is not None and not isabs(fpath):
+            fpath = normpath(join(dpath, fpath))
+        return read_log(fpath, self.nbytes)
+
+
+class LogReader(object):
+    """
+    Incrementally rebuilds the History of an EpochLog. Each read only parses
+    the lines appended since the previous one.
+    """
+
+    def __init__(reader, fpath):
+        from wbia_cnn.models.abstract_models import History
+
+        reader.fpath = fpath
+        reader.offset = 0
+        reader.history = History()
+
+    def read(reader, nbytes=None):
+        """ Applies the lines up to byte nbytes (or the end of the file) """
+        history = reader.history
+        with io.open(reader.fpath, 'rb') as file_:
+            file_.seek(reader.offset)
+            if nbytes is None:
+                data = file_.read()
+            else:
+                data = file_.read(max(nbytes - reader.offset, 0))
+        # Leave an incomplete final line for the next read
+        data = data[0 : data.rfind(b'\n') + 1]
+        reader.offset += len(data)
+        for line in data.decode('utf8').splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            if 'era' in row:
+                history.era_list.append(row['era'])
+            elif 'epoch' in row:
+                history.epoch_list.append(row['epoch'])
+            elif 'rewind' in row:
+                num_eras, num_epochs = row['rewind']
+                del history.era_list[num_eras:]
+                del history.epoch_list[num_epochs:]
+                history._init_index()
+        history._start_epoch = history.total_epochs
+        return history
+
+
+def read_log(fpath, nbytes=None):
+    """
+    Rebuilds a History from an EpochLog file, or from its first nbytes
+    """
+    if not exists(fpath):
+        from wbia_cnn.models.abstract_models import History
+
+        print('[history_log] WARNING: missing history log %r' % (fpath,))
+        return History()
+    return LogReader(fpath).read(nbytes)
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.history_log
+        python -m wbia_cnn.history_log --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+In-process micro-batching inference service for the _plugin models.
+
+The web tier calls the _plugin classifiers from many request threads with a
+handful of images each, and every call used to run its own tiny batch through
+the network. The service queues the requests of each model and a worker thread
+per model coalesces them into full batches: a batch runs as soon as it holds
+max_batch_size items or the oldest request has waited max_latency seconds.
+Results are sliced back to the callers.
+
+The service only holds weak references to the models, so a model that is
+evicted from the _plugin_registry (or otherwise released) is not kept alive
+by its batcher; the batcher is stopped when the model goes away.
+
+The _plugin entry points route through the service once it is enabled with
+``enable_service()`` or ``--inference-service``.
+
+CommandLine:
+    python -m wbia_cnn.inference_service --allexamples
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import time
+import weakref
+import threading
+import collections
+import numpy as np
+import utool as ut
+from concurrent import futures
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+# Seconds the oldest request may wait for its batch to fill
+DEFAULT_MAX_LATENCY = ut.get_argval('--inference-max-latency', type_=float, default=0.01)
+
+# Number of recent request latencies kept for the percentiles
+_LATENCY_WINDOW = 10000
+
+
+class _Request(object):
+    def __init__(self, X):
+        self.X = X
+        self.future = futures.Future()
+        self.start = time.time()
+
+
+@ut.reloadable_class
+class MicroBatcher(ut.NiceRepr):
+    """
+    Coalesces concurrent predict requests to one model into full batches.
+
+    Args:
+        model (BaseModel): model with a predict function. Only a weak
+            reference is kept; requests fail once the model is released.
+        max_batch_size (int): defaults to model.batch_size
+        max_latency (float): seconds a request may wait for more requests
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.inference_service import *  # NOQA
+        >>> class Dummy(object):
+        >>>     batch_size = 8
+        >>>     batch_lens = []
+        >>>     def build_predict_func(self):
+        >>>         return None
+        >>>     def process_batch(self, theano_fn, X):
+        >>>         self.batch_lens.append(len(X))
+        >>>         return {'predictions': X.sum(axis=1), 'name': 'dummy'}
+        >>> model = Dummy()
+        >>> batcher = MicroBatcher(model, max_latency=0.5)
+        >>> X_list = [np.full((n, 2), n) for n in [1, 3, 2, 2, 5]]
+        >>> future_list = [batcher.submit(X) for X in X_list]
+        >>> result_list = [future.result() for future in future_list]
+        >>> batcher.close()
+        >>> assert all(np.all(result['predictions'] == 2 * X[:, 0])
+        >>>            for result, X in zip(result_list, X_list))
+        >>> print(model.batch_lens)
+        [8, 5]
+        >>> print(batcher.stats()['fill_ratio'])
+        0.8125
+    """
+
+    def __init__(batcher, model, max_batch_size=None, max_latency=None):
+        if max_batch_size is None:
+            max_batch_size = model.batch_size
+        if max_latency is None:
+            max_latency = DEFAULT_MAX_LATENCY
+        batcher._model_ref = weakref.ref(model)
+        batcher._model_name = model.__class__.__name__
+        batcher.max_batch_size = max_batch_size
+        batcher.max_latency = max_latency
+        batcher._queue = collections.deque()
+        batcher._num_pending = 0
+        batcher._cond = threading.Condition()
+        batcher._closed = False
+        batcher._buffer = None
+        batcher.num_requests = 0
+        batcher.num_batches = 0
+        batcher.num_items = 0
+        batcher.max_queue_depth = 0
+        batcher._latencies = collections.deque(maxlen=_LATENCY_WINDOW)
+        batcher._thread = threading.Thread(target=batcher._run)
+        batcher._thread.daemon = True
+        batcher._thread.start()
+
+    def __nice__(batcher):
+        return '%s, batch=%d, latency=%.1fms' % (
+            batcher._model_name,
+            batcher.max_batch_size,
+            batcher.max_latency * 1000,
+        )
+
+    @property
+    def model(batcher):
+        """ The model, or None once it was released """
+        return batcher._model_ref()
+
+    def submit(batcher, X):
+        """
+        Queues X (an array of items) and returns a Future of the predict
+        outputs of those items
+        """
+        request = _Request(np.asarray(X))
+        with batcher._cond:
+            if batcher._closed:
+                raise RuntimeError('MicroBatcher is closed')
+            batcher._queue.append(request)
+            batcher._num_pending += len(request.X)
+            batcher.num_requests += 1
+            batcher.max_queue_depth = max(batcher.max_queue_depth, batcher._num_pending)
+            batcher._cond.notify()
+        return request.future
+
+    def _next_requests(batcher):
+        """ Waits for a batch worth of requests, or None once closed """
+        with batcher._cond:
+            while len(batcher._queue) == 0 and not batcher._closed:
+                batcher._cond.wait()
+            if len(batcher._queue) == 0:
+                return None
+            deadline = batcher._queue[0].start + batcher.max_latency
+            while batcher._num_pending < batcher.max_batch_size and not batcher._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                batcher._cond.wait(remaining)
+            first = batcher._queue.popleft()
+            request_list = [first]
+            num = len(first.X)
+            # Only requests with the same item shape go in one batch
+            while len(batcher._queue) > 0:
+                request = batcher._queue[0]
+                if num + len(request.X) > batcher.max_batch_size:
+                    break
+                if request.X.shape[1:] != first.X.shape[1:]:
+                    break
+                request_list.append(batcher._queue.popleft())
+                num += len(request.X)
+            batcher._num_pending -= num
+        return request_list
+
+    def _run(batcher):
+        while True:
+            request_list = batcher._next_requests()
+            if request_list is None:
+                return
+            batcher._run_batch(request_list)
+
+    def _stack(batcher, request_list):
+        num_list = [len(request.X) for request in request_list]
+        total = sum(num_list)
+        X0 = request_list[0].X
+        item_shape = X0.shape[1:]
+        buf = batcher._buffer
+        if (
+            buf is None
+            or buf.shape[1:] != item_shape
+            or buf.dtype != X0.dtype
+            or len(buf) < total
+        ):
+            buf = np.empty((max(total, batcher.max_batch_size),) + item_shape, X0.dtype)
+            batcher._buffer = buf
+        offset = 0
+        for request, num in zip(request_list, num_list):
+            buf[offset : offset + num] = request.X
+            offset += num
+        return buf[0:total], num_list
+
+    def _run_batch(batcher, request_list):
+        # Any failure fails the futures of the batch. An exception escaping
+        # here would kill the worker while submit keeps accepting requests.
+        try:
+            model = batcher.model
+            if model is None:
+                raise RuntimeError('the model of this MicroBatcher was released')
+            Xb, num_list = batcher._stack(request_list)
+            theano_predict = model.build_predict_func()
+            outputs = model.process_batch(theano_predict, Xb)
+            del model
+            total = len(Xb)
+            batcher.num_batches += 1
+            batcher.num_items += total
+            offset = 0
+            now = time.time()
+            for request, num in zip(request_list, num_list):
+                result = {}
+                for key, value in outputs.items():
+                    if isinstance(value, np.ndarray) and len(value) == total:
+                        value = value[offset : offset + num]
+                    result[key] = value
+                offset += num
+                batcher._latencies.append(now - request.start)
+                request.future.set_result(result)
+        except Exception as ex:
+            for request in request_list:
+                if not request.future.done():
+                    request.future.set_exception(ex)
+
+    def queue_depth(batcher):
+        """ Number of queued items that are not in a batch yet """
+        return batcher._num_pending
+
+    def stats(batcher):
+        latencies = np.array(batcher._latencies)
+        if len(latencies) > 0:
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        else:
+            p50, p99 = np.nan, np.nan
+        fill_ratio = (
+            batcher.num_items / (batcher.num_batches * batcher.max_batch_size)
+            if batcher.num_batches > 0
+            else np.nan
+        )
+        return ut.odict(
+            [
+                ('num_requests', batcher.num_requests),
+                ('num_batches', batcher.num_batches),
+                ('queue_depth', batcher.queue_depth()),
+                ('max_queue_depth', batcher.max_queue_depth),
+                ('fill_ratio', fill_ratio),
+                ('latency_p50_ms', p50),
+                ('latency_p99_ms', p99),
+            ]
+        )
+
+    def close(batcher, wait=True):
+        """
+        Runs the queued requests and stops the worker. With wait=False the
+        worker finishes the queue in the background.
+        """
+        with batcher._cond:
+            batcher._closed = True
+            batcher._cond.notify_all()
+        if wait and batcher._thread is not threading.current_thread():
+            batcher._thread.join()
+
+
+@ut.reloadable_class
+class InferenceService(ut.NiceRepr):
+    """
+    One MicroBatcher per model, with synchronous and asyncio clients.
+
+    Batchers are keyed by model identity. A batcher is closed and dropped
+    when its model is garbage collected or discarded (see discard_model).
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.inference_service import *  # NOQA
+        >>> import asyncio
+        >>> class Dummy(object):
+        >>>     batch_size = 4
+        >>>     def build_predict_func(self):
+        >>>         return None
+        >>>     def process_batch(self, theano_fn, X):
+        >>>         return {'predictions': X * 2}
+        >>> model = Dummy()
+        >>> service = InferenceService(max_latency=0.001)
+        >>> result = service.predict(model, np.arange(3))
+        >>> loop = asyncio.new_event_loop()
+        >>> async_result = loop.run_until_complete(
+        >>>     service.predict_async(model, np.arange(2), loop=loop))
+        >>> loop.close()
+        >>> print(result['predictions'].tolist(), async_result['predictions'].tolist())
+        [0, 2, 4] [0, 2]
+        >>> batcher = service.get_batcher(model)
+        >>> del model
+        >>> print(len(service._batchers), batcher._closed)
+        0 True
+        >>> service.close()
+    """
+
+    def __init__(service, max_latency=None, max_batch_size=None):
+        service.max_latency = max_latency
+        service.max_batch_size = max_batch_size
+        service._batchers = {}
+        # Reentrant: garbage collection may release a model (and run
+        # _release) on a thread that holds the lock
+        service._lock = threading.RLock()
+
+    def __nice__(service):
+        return 'n=%d' % (len(service._batchers),)
+
+    def get_batcher(service, model):
+        with service._lock:
+            key = id(model)
+            batcher = service._batchers.get(key, None)
+            if batcher is None or batcher.model is not model:
+                if batcher is not None:
+                    batcher.close(wait=False)
+                batcher = MicroBatcher(
+                    model,
+                    max_batch_size=service.max_batch_size,
+                    max_latency=service.max_latency,
+                )
+                service._batchers[key] = batcher
+                weakref.finalize(model, service._release, key, batcher)
+            return batcher
+
+    def _release(service, key, batcher):
+        with service._lock:
+            if service._batchers.get(key, None) is batcher:
+                del service._batchers[key]
+        # May run on the worker thread itself, so do not join it
+        batcher.close(wait=False)
+
+    def discard_model(service, model):
+        """ Closes the batcher of model, e.g. when it is evicted """
+        key = id(model)
+        with service._lock:
+            batcher = service._batchers.get(key, None)
+            if batcher is None or batcher.model is not model:
+                return
+            del service._batchers[key]
+        batcher.close()
+
+    def submit(service, model, X):
+        """ Returns a concurrent.futures.Future of the outputs """
+        return service.get_batcher(model).submit(X)
+
+    def predict(service, model, X, timeout=None):
+        """ Blocks until the outputs of X are ready """
+        return service.submit(model, X).result(timeout=timeout)
+
+    def predict_async(service, model, X, loop=None):
+        """
+        Returns an asyncio future of the outputs. The batch runs on the
+        worker thread, so awaiting it does not block the event loop.
+        """
+        import asyncio
+
+        return asyncio.wrap_future(service.submit(model, X), loop=loop)
+
+    def stats(service):
+        with service._lock:
+            batcher_list = list(service._batchers.values())
+        return ut.odict([(ut.repr2(batcher), batcher.stats()) for batcher in batcher_list])
+
+    def close(service):
+        with service._lock:
+            batcher_list = list(service._batchers.values())
+            service._batchers.clear()
+        for batcher in batcher_list:
+            batcher.close()
+
+
+# The process-wide service used by the _plugin entry points
+_SERVICE_STATE = {'service': None, 'enabled': ut.get_argflag('--inference-service')}
+
+
+def enable_service(flag=True):
+    """ Routes the _plugin classifiers through the micro-batching service """
+    _SERVICE_STATE['enabled'] = flag
+
+
+def is_enabled():
+    return _SERVICE_STATE['enabled']
+
+
+def get_service():
+    if _SERVICE_STATE['service'] is None:
+        _SERVICE_STATE['service'] = InferenceService()
+    return _SERVICE_STATE['service']
+
+
+def discard_model(model):
+    """ Closes the batcher of a model in the process-wide service, if any """
+    if _SERVICE_STATE['service'] is not None:
+        _SERVICE_STATE['service'].discard_model(model)
+
+
+def predict_outputs(model, X):
+    """
+    Runs the predict function of model on X, through the service if it is
+    enabled. Returns the process_batch outputs.
+    """
+    if is_enabled():
+        return get_service().predict(model, X)
+    theano_predict = model.build_predict_func()
+    return model.process_batch(theano_predict, X)
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.inference_service
+        python -m wbia_cnn.inference_service --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
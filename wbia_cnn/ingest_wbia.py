@@ -369,83 +369,49 @@ def get_aidpair_patchmatch_training_data(
     assert len(aid1_list) == len(kpts2_m_list)
     assert len(aid1_list) == len(fm_list)
     print('geting_unflat_chips')
+    from wbia_cnn import patch_store
+
     flat_unique, reconstruct_tup = ut.inverable_unique_two_lists(aid1_list, aid2_list)
-    print('grabbing %d unique chips' % (len(flat_unique)))
-    chip_list = ibs.get_annot_chips(flat_unique)  # TODO config2_
-    # convert to approprate colorspace
-    chip_list = vt.convert_image_list_colorspace(chip_list, colorspace)
-    ut.print_object_size(chip_list, 'chip_list')
-    chip1_list, chip2_list = ut.uninvert_unique_two_lists(chip_list, reconstruct_tup)
+    # Patches are addressed by chip UUID in the persistent store, so a chip is
+    # only read (and converted) if one of its patches has not been warped by a
+    # previous build. Only the most recently read chips are kept in memory:
+    # the pairs of an annotation are usually adjacent, and a chip whose
+    # patches are stored is never needed again.
+    chip_cache = ut.LRUDict(16)
+    num_read = [0]
+
+    def _load_chip(aid):
+        if aid not in chip_cache:
+            chip = ibs.get_annot_chips([aid])[0]  # TODO config2_
+            # convert to approprate colorspace
+            chip_cache[aid] = vt.convert_image_list_colorspace([chip], colorspace)[0]
+            num_read[0] += 1
+        return chip_cache[aid]
+
+    chip_uuid_list = ibs.get_annot_visual_uuids(flat_unique)
+    chip_loader_list = [partial(_load_chip, aid) for aid in flat_unique]
+    uuid1_list, uuid2_list = ut.uninvert_unique_two_lists(chip_uuid_list, reconstruct_tup)
+    loader1_list, loader2_list = ut.uninvert_unique_two_lists(
+        chip_loader_list, reconstruct_tup
+    )
     print('warping')
+    store = patch_store.get_patch_store()
+
+    def _warp_patches(uuid_list, loader_list, kpts_list, lbl):
+        warp_iter = ut.ProgIter(
+            zip(uuid_list, loader_list, kpts_list),
+            nTotal=len(kpts_list),
+            lbl=lbl,
+            adjust=True,
+        )
+        return [
+            store.get_warped_patches(str(uuid), loader, kpts, patch_size, colorspace)
+            for uuid, loader, kpts in warp_iter
+        ]
 
-    class PatchExtractCache(object):
-        def __init__(self, patch_size):
-            self.patch_size = patch_size
-            self.cache_ = {}
-
-        def idcache_find_misses(self, id_list, cache_):
-            # Generalize?
-            val_list = [cache_.get(id_, None) for id_ in id_list]
-            ismiss_list = [val is None for val in val_list]
-            return val_list, ismiss_list
-
-        def idcache_save(self, ismiss_list, miss_vals, id_list, val_list, cache_):
-            # Generalize?
-            miss_indices = ut.list_where(ismiss_list)
-            miss_ids = ut.compress(id_list, ismiss_list)
-            # overwrite missed output
-            for index, val in zip(miss_indices, miss_vals):
-                val_list[index] = val
-            # cache save
-            for id_, val in zip(miss_ids, miss_vals):
-                cache_[id_] = val
-
-        def cacheget_wraped_patches(self, aid, fxs, chip, kpts):
-            # +-- Custom ids
-            id_list = [(aid, fx) for fx in fxs]
-            # L__
-            val_list, ismiss_list = self.idcache_find_misses(id_list, self.cache_)
-            if any(ismiss_list):
-                # +-- Custom evaluate misses
-                kpts_miss = kpts.compress(ismiss_list, axis=0)
-                miss_vals = vt.get_warped_patches(
-                    chip, kpts_miss, patch_size=self.patch_size
-                )[0]
-                # L__
-                self.idcache_save(ismiss_list, miss_vals, id_list, val_list, self.cache_)
-            return val_list
-
-    fx1_list = [fm.T[0] for fm in fm_list]
-    fx2_list = [fm.T[1] for fm in fm_list]
-    warp_iter1 = ut.ProgIter(
-        zip(aid1_list, fx1_list, chip1_list, kpts1_m_list),
-        nTotal=len(kpts1_m_list),
-        lbl='warp1',
-        adjust=True,
-    )
-    warp_iter2 = ut.ProgIter(
-        zip(aid2_list, fx2_list, chip2_list, kpts2_m_list),
-        nTotal=len(kpts2_m_list),
-        lbl='warp2',
-        adjust=True,
-    )
-    pec = PatchExtractCache(patch_size=patch_size)
-    warped_patches1_list = list(
-        itertools.starmap(pec.cacheget_wraped_patches, warp_iter1)
-    )
-    warped_patches2_list = list(
-        itertools.starmap(pec.cacheget_wraped_patches, warp_iter2)
-    )
-    # warp_iter1 = ut.ProgIter(zip(chip1_list, kpts1_m_list),
-    #                             nTotal=len(kpts1_m_list), lbl='warp1',
-    #                             adjust=True)
-    # warp_iter2 = ut.ProgIter(zip(chip2_list, kpts2_m_list),
-    #                             nTotal=len(kpts2_m_list), lbl='warp2',
-    #                             adjust=True)
-    # warped_patches1_list = [vt.get_warped_patches(chip1, kpts1, patch_size=patch_size)[0]
-    #                        for chip1, kpts1 in warp_iter1]
-    # warped_patches2_list = [vt.get_warped_patches(chip2, kpts2, patch_size=patch_size)[0]
-    #                        for chip2, kpts2 in warp_iter2]
+    warped_patches1_list = _warp_patches(uuid1_list, loader1_list, kpts1_m_list, 'warp1')
+    warped_patches2_list = _warp_patches(uuid2_list, loader2_list, kpts2_m_list, 'warp2')
+    print('[ingest] read %d chips, patch store %s' % (num_read[0], store.stats()))
     ut.print_object_size(warped_patches1_list, 'warped_patches1_list')
     ut.print_object_size(warped_patches2_list, 'warped_patches2_list')
     len1_list = list(map(len, fm_list))
@@ -471,8 +437,9 @@ def get_aidpair_patchmatch_training_data(
 
     # flat_metadata = ut.map_dict_vals(np.array, flat_metadata)
 
-    warped_patch1_list = ut.flatten(warped_patches1_list)
-    warped_patch2_list = ut.flatten(warped_patches2_list)
+    # Contiguous (num_patches, h, w[, c]) uint8 arrays
+    warped_patch1_list = np.concatenate(warped_patches1_list)
+    warped_patch2_list = np.concatenate(warped_patches2_list)
     # del warped_patches1_list
     # del warped_patches2_list
     return aid1_list_, aid2_list_, warped_patch1_list, warped_patch2_list, flat_metadata
@@ -557,9 +524,13 @@ def get_patchmetric_training_data_and_labels(
     )
     (aid1_list_, aid2_list_, warped_patch1_list, warped_patch2_list, flat_metadata) = tup
     labels = get_aidpair_training_labels(ibs, aid1_list_, aid2_list_)
-    img_list = ut.flatten(list(zip(warped_patch1_list, warped_patch2_list)))
-    data = np.array(img_list)
-    del img_list
+    # Interleave the pairs
+    data = np.empty(
+        (2 * len(warped_patch1_list),) + warped_patch1_list.shape[1:],
+        dtype=warped_patch1_list.dtype,
+    )
+    data[0::2] = warped_patch1_list
+    data[1::2] = warped_patch2_list
     # data_per_label = 2
     assert labels.shape[0] == data.shape[0] // 2
     from wbia import const
@@ -145,6 +145,31 @@ if 'theano' in sys.modules:
 class History(ut.NiceRepr):
     """
     Manages bookkeeping for training history
+
+    The numeric measures of epoch_list are also kept in float columns that
+    grow as epochs are recorded (see get_column / era_bounds), and the era
+    hashes behind hist_id are computed once per era. Both are derived, so
+    they are rebuilt instead of pickled. attach_log appends the history to a
+    JSON lines file (see wbia_cnn.history_log).
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.models.abstract_models import *  # NOQA
+        >>> history = History()
+        >>> for era_num in range(3):
+        >>>     history.era_list.append({'era': era_num})
+        >>>     for count in range(era_num + 1):
+        >>>         history._record_epoch({'valid_loss': 1.0 / (era_num + count + 1)})
+        >>> print(history.era_bounds(2))
+        (1, 3)
+        >>> print(history.get_column('valid_loss', era_num=3))
+        [0.33333333 0.25       0.2       ]
+        >>> history.rewind_to(2)
+        >>> print(history.get_column('valid_loss'))
+        [1.         0.5        0.33333333]
+        >>> import pickle
+        >>> history2 = pickle.loads(pickle.dumps(history))
+        >>> assert history2.hist_id == history.hist_id
     """
 
     def __init__(history):
@@ -153,6 +178,27 @@ class History(ut.NiceRepr):
         history.epoch_list = []
         # Marks the start of the era
         history._start_epoch = 0
+        history._log = None
+        history._init_index()
+
+    def _init_index(history):
+        # Float columns of the numeric epoch measures (with capacity beyond
+        # _num_indexed so appends are amortized constant time)
+        history._columns = {}
+        history._num_indexed = 0
+        # Hashes of the eras in era_list
+        history._era_hashes = []
+
+    def __getstate__(history):
+        state = history.__dict__.copy()
+        for key in ['_log', '_columns', '_num_indexed', '_era_hashes']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(history, state):
+        history.__dict__.update(state)
+        history._log = None
+        history._init_index()
 
     def __len__(history):
         return history.total_epochs
@@ -183,6 +229,91 @@ class History(ut.NiceRepr):
         history._start_epoch = len(history.epoch_list)
         return history
 
+    def _sync_index(history):
+        """ Indexes the epochs that were recorded since the last query """
+        if history._num_indexed > len(history.epoch_list):
+            # epoch_list was replaced
+            history._init_index()
+        num_new = len(history.epoch_list) - history._num_indexed
+        if num_new == 0:
+            return
+        num_total = history._num_indexed + num_new
+        columns = history._columns
+        for column_key in list(columns.keys()):
+            column = columns[column_key]
+            if len(column) < num_total:
+                new_column = np.full(max(num_total, 2 * len(column)), np.nan)
+                new_column[: history._num_indexed] = column[: history._num_indexed]
+                columns[column_key] = new_column
+            else:
+                # Clear values left behind by a rewind
+                column[history._num_indexed : num_total] = np.nan
+        for index in range(history._num_indexed, num_total):
+            for key, value in six.iteritems(history.epoch_list[index]):
+                if not isinstance(value, (float, np.floating) + six.integer_types + (np.integer,)):
+                    continue
+                if key not in columns:
+                    columns[key] = np.full(max(num_total, 16), np.nan)
+                columns[key][index] = value
+        history._num_indexed = num_total
+
+    def get_column(history, key, era_num=None):
+        """
+        Returns a numeric epoch measure (e.g. valid_loss) of all epochs or of
+        one era as a float array. Epochs without the measure are nan.
+        """
+        history._sync_index()
+        if key in history._columns:
+            column = history._columns[key][: history._num_indexed]
+        else:
+            column = np.full(history._num_indexed, np.nan)
+        if era_num is not None:
+            start, stop = history.era_bounds(era_num)
+            column = column[start:stop]
+        return column.copy()
+
+    def era_bounds(history, era_num):
+        """
+        Returns the (start, stop) epoch indices of the epochs recorded with
+        era_num
+        """
+        era_column = history.get_column('era_num')
+        start = int(np.searchsorted(era_column, era_num, side='left'))
+        stop = int(np.searchsorted(era_column, era_num, side='right'))
+        return start, stop
+
+    def attach_log(history, fpath):
+        """
+        Appends this history to the JSON lines file at fpath and keeps
+        appending as eras and epochs are recorded
+        """
+        from wbia_cnn import history_log
+
+        history.close_log()
+        history._log = history_log.EpochLog(fpath)
+        history._log.sync(history)
+
+    def close_log(history):
+        if getattr(history, '_log', None) is not None:
+            history._log.close()
+        history._log = None
+
+    def _sync_log(history):
+        if getattr(history, '_log', None) is not None:
+            history._log.sync(history)
+
+    def log_ref(history):
+        """
+        Returns a HistoryLogRef to the current state of the attached log, or
+        None without a log. Snapshots store it instead of the whole history.
+        """
+        from wbia_cnn import history_log
+
+        if getattr(history, '_log', None) is None:
+            return None
+        history._log.sync(history)
+        return history_log.HistoryLogRef(history._log.fpath, history._log.nbytes)
+
     @property
     def total_epochs(history):
         return len(history.epoch_list)
@@ -221,7 +352,12 @@ class History(ut.NiceRepr):
         training procedure this model has gone through to produce the current
         architecture weights.
         """
-        era_hash_list = [ut.hashstr27(ut.repr2(era)) for era in history.era_list]
+        era_hash_list = history._era_hashes
+        if len(era_hash_list) > len(history.era_list):
+            # era_list was replaced
+            del era_hash_list[:]
+        for era in history.era_list[len(era_hash_list) :]:
+            era_hash_list.append(ut.hashstr27(ut.repr2(era)))
         # epoch_hash_list = [ut.hashstr27(ut.repr2(epoch)) for epoch in history.epoch_list]
         # epoch_hash_str = ''.join(epoch_hash_list)
         era_hash_str = ''.join(era_hash_list)
@@ -237,7 +373,7 @@ class History(ut.NiceRepr):
         return nice
 
     def grouped_epochs(history):
-        era_num = ut.take_column(history.epoch_list, 'era_num')
+        era_num = history.get_column('era_num')
         unique, groupxs = ut.group_indices(era_num)
         grouped_epochs = ut.apply_grouping(history.epoch_list, groupxs)
         return grouped_epochs
@@ -249,6 +385,7 @@ class History(ut.NiceRepr):
     def record_epoch(history, epoch_info):
         epoch_info['epoch_num'] = len(history.epoch_list)
         history.epoch_list.append(epoch_info)
+        history._sync_log()
 
     def _new_era(history, model, X_learn, y_learn, X_valid, y_valid):
         """
@@ -274,6 +411,7 @@ class History(ut.NiceRepr):
             model.current_era = _new_era
             history.era_list.append(_new_era)
             history._start_epoch = history.total_epochs
+            history._sync_log()
 
     def _record_epoch(history, epoch_info):
         """
@@ -285,6 +423,7 @@ class History(ut.NiceRepr):
         # history.current_era['epoch_info_list'].append(epoch_info)
         epoch_info['era_num'] = history.total_eras
         history.epoch_list.append(epoch_info)
+        history._sync_log()
 
     def rewind_to(history, epoch_num):
         target_epoch = history.epoch_list[epoch_num]
@@ -292,9 +431,13 @@ class History(ut.NiceRepr):
         history.epoch_list = history.epoch_list[: epoch_num + 1]
         history.era_list = history.era_list[: era_num + 1]
         history._start_epoch = history.total_epochs
+        history._num_indexed = min(history._num_indexed, history.total_epochs)
+        del history._era_hashes[history.total_eras :]
+        if getattr(history, '_log', None) is not None:
+            history._log.rewind(history)
 
     def to_json(history):
-        return ut.to_json(history.__dict__)
+        return ut.to_json(history.__getstate__())
 
 
 @ut.reloadable_class
@@ -403,6 +546,30 @@ class _ModelFitter(object):
         # training, but do impact performance / memory usage.
         model._behavior = {
             'buffered': True,
+            # Number of forked processes that prepare (augment / whiten)
+            # learning batches ahead of the compute function. 0 uses a single
+            # buffering thread.
+            'prefetch_workers': ut.get_argval('--prefetch-workers', type_=int, default=0),
+            # Maximum number of batches in flight (defaults to 2 * workers)
+            'prefetch_depth': ut.get_argval('--prefetch-depth', type_=int, default=None),
+            # Compiled functions take raw uint8 cv2 batches and run the
+            # scaling, whitening, and dimshuffle as the first ops of the graph
+            'graph_prep': ut.get_argflag('--graph-prep'),
+            # Number of forked processes that learn on disjoint shards of each
+            # epoch and average their parameters (see wbia_cnn.data_parallel).
+            # 0 or 1 learns in this process.
+            'train_workers': ut.get_argval('--train-workers', type_=int, default=0),
+            # Number of batches each worker learns between parameter averages
+            'sync_freq': ut.get_argval('--sync-freq', type_=int, default=8),
+            # Write checkpoints on a background thread (see
+            # wbia_cnn.checkpoint_writer)
+            'async_checkpoint': not ut.get_argflag('--no-async-checkpoint'),
+            # Render the epoch monitor figures in a forked process (see
+            # wbia_cnn.monitor_renderer)
+            'async_monitor': not ut.get_argflag('--no-async-monitor'),
+            # Shuffle only a label permutation and gather each batch from it
+            # instead of copying the shuffled data every epoch
+            'index_shuffle': not ut.get_argflag('--copy-shuffle'),
         }
         # Static configuration indicating training preferences
         # (these will not influence the model learning)
@@ -413,6 +580,14 @@ class _ModelFitter(object):
             'case_dump_freq': 25,
             'weight_dump_freq': 5,
             'showprog': True,
+            # Number of validation labels (a fixed stratified subsample) that
+            # are evaluated on most epochs. None validates on the full set
+            # every epoch.
+            'valid_subsample': ut.get_argval('--valid-subsample', type_=int, default=None),
+            # Epochs between full validations when subsampling. Checkpoint
+            # epochs always validate fully; subsample improvements only reset
+            # the stopping countdown until a full pass confirms them.
+            'valid_full_freq': ut.get_argval('--valid-full-freq', type_=int, default=10),
         }
         ut.update_existing(model.monitor_config, kwargs)
         ut.delete_dict_keys(kwargs, model.monitor_config.keys())
@@ -563,6 +738,10 @@ class _ModelFitter(object):
                     countdowns[key] = countdown_defaults[key]
                     return True
 
+        # Fixed validation subsample for the epochs between full validations
+        valid_subset = model._valid_subset(X_valid, y_valid, w_valid)
+        best_subset_loss = np.inf
+
         model.history._new_era(model, X_train, y_train, X_train, y_train)
         printcol_info = utils.get_printcolinfo(model.requested_headers)
         utils.print_header_columns(printcol_info)
@@ -575,6 +754,7 @@ class _ModelFitter(object):
             theano_forward, X_learn, y_learn, w_learn
         )
         valid_info = model._epoch_validate(theano_forward, X_valid, y_valid, w_valid)
+        valid_info['valid_mode'] = 'full'
 
         # ---------------------------------------
         # EPOCH 0: Summarize the epoch
@@ -604,210 +784,251 @@ class _ModelFitter(object):
         utils.print_epoch_info(model, printcol_info, epoch_info)
         epoch += 1
 
-        while True:
-            try:
-                # ---------------------------------------
-                # Execute backwards and forward passes
-                tt.tic()
-                learn_info = model._epoch_learn(
-                    theano_backprop, X_learn, y_learn, w_learn, epoch
-                )
-                if learn_info.get('diverged'):
-                    break
-                valid_info = model._epoch_validate(
-                    theano_forward, X_valid, y_valid, w_valid
-                )
+        try:
+            while True:
+                try:
+                    # ---------------------------------------
+                    # Execute backwards and forward passes
+                    tt.tic()
+                    learn_info = model._epoch_learn(
+                        theano_backprop, X_learn, y_learn, w_learn, epoch
+                    )
+                    if learn_info.get('diverged'):
+                        break
+                    valid_mode = 'full'
+                    if valid_subset is not None and not (
+                        utils.checkfreq(model.monitor_config['valid_full_freq'], epoch)
+                        or utils.checkfreq(model.monitor_config['checkpoint_freq'], epoch)
+                        or countdowns['checkpoint'] == 0
+                        or epoch == model.hyperparams['max_epochs']
+                    ):
+                        valid_mode = 'subset'
+                        valid_info = model._epoch_validate(theano_forward, *valid_subset)
+                        if valid_info['valid_loss'] < best_subset_loss:
+                            # Keep training while the subset loss improves. Only
+                            # full validations select the best model, so the
+                            # improvement is confirmed by the next scheduled full
+                            # (or checkpoint) pass instead of an extra one now.
+                            best_subset_loss = valid_info['valid_loss']
+                            countdowns['stop'] = countdown_defaults['stop']
+                    if valid_mode == 'full':
+                        valid_info = model._epoch_validate(
+                            theano_forward, X_valid, y_valid, w_valid
+                        )
+                    valid_info['valid_mode'] = valid_mode
+
+                    # ---------------------------------------
+                    # Summarize the epoch
+                    epoch_info = {'epoch_num': epoch}
+                    epoch_info.update(**learn_info)
+                    epoch_info.update(**valid_info)
+                    epoch_info['duration'] = tt.toc()
+                    epoch_info['learn_state'] = model.learn_state.asdict()
+                    epoch_info['learnval_rat'] = (
+                        epoch_info['learn_loss'] / epoch_info['valid_loss']
+                    )
 
-                # ---------------------------------------
-                # Summarize the epoch
-                epoch_info = {'epoch_num': epoch}
-                epoch_info.update(**learn_info)
-                epoch_info.update(**valid_info)
-                epoch_info['duration'] = tt.toc()
-                epoch_info['learn_state'] = model.learn_state.asdict()
-                epoch_info['learnval_rat'] = (
-                    epoch_info['learn_loss'] / epoch_info['valid_loss']
-                )
+                    # ---------------------------------------
+                    # Record this epoch in history
+                    model.history._record_epoch(epoch_info)
+
+                    # ---------------------------------------
+                    # Check how we are learning
+                    # (subset losses are not comparable to the best full loss)
+                    if (
+                        valid_mode == 'full'
+                        and epoch_info['valid_loss'] < model.best_results['valid_loss']
+                    ):
+                        # Found a better model. Reset countdowns.
+                        for key in countdowns.keys():
+                            countdowns[key] = countdown_defaults[key]
+                        # Cache best results
+                        model.best_results['weights'] = model.get_all_param_values()
+                        model.best_results['epoch_num'] = epoch_info['epoch_num']
+                        if 'valid_precision' in epoch_info:
+                            model.best_results['valid_precision'] = epoch_info[
+                                'valid_precision'
+                            ]
+                            model.best_results['valid_recall'] = epoch_info[
+                                'valid_recall'
+                            ]
+                            model.best_results['valid_fscore'] = epoch_info[
+                                'valid_fscore'
+                            ]
+                            model.best_results['valid_support'] = epoch_info[
+                                'valid_support'
+                            ]
+                        if 'learn_precision' in epoch_info:
+                            model.best_results['learn_precision'] = epoch_info[
+                                'learn_precision'
+                            ]
+                            model.best_results['learn_recall'] = epoch_info[
+                                'learn_recall'
+                            ]
+                            model.best_results['learn_fscore'] = epoch_info[
+                                'learn_fscore'
+                            ]
+                            model.best_results['learn_support'] = epoch_info[
+                                'learn_support'
+                            ]
+                        for key in model.requested_headers:
+                            model.best_results[key] = epoch_info[key]
+
+                    # Check frequencies and countdowns
+                    checkpoint_flag = utils.checkfreq(
+                        model.monitor_config['checkpoint_freq'], epoch
+                    )
 
-                # ---------------------------------------
-                # Record this epoch in history
-                model.history._record_epoch(epoch_info)
-
-                # ---------------------------------------
-                # Check how we are learning
-                if epoch_info['valid_loss'] < model.best_results['valid_loss']:
-                    # Found a better model. Reset countdowns.
-                    for key in countdowns.keys():
-                        countdowns[key] = countdown_defaults[key]
-                    # Cache best results
-                    model.best_results['weights'] = model.get_all_param_values()
-                    model.best_results['epoch_num'] = epoch_info['epoch_num']
-                    if 'valid_precision' in epoch_info:
-                        model.best_results['valid_precision'] = epoch_info[
-                            'valid_precision'
-                        ]
-                        model.best_results['valid_recall'] = epoch_info['valid_recall']
-                        model.best_results['valid_fscore'] = epoch_info['valid_fscore']
-                        model.best_results['valid_support'] = epoch_info['valid_support']
-                    if 'learn_precision' in epoch_info:
-                        model.best_results['learn_precision'] = epoch_info[
-                            'learn_precision'
-                        ]
-                        model.best_results['learn_recall'] = epoch_info['learn_recall']
-                        model.best_results['learn_fscore'] = epoch_info['learn_fscore']
-                        model.best_results['learn_support'] = epoch_info['learn_support']
-                    for key in model.requested_headers:
-                        model.best_results[key] = epoch_info[key]
-
-                # Check frequencies and countdowns
-                checkpoint_flag = utils.checkfreq(
-                    model.monitor_config['checkpoint_freq'], epoch
-                )
+                    if check_countdown('checkpoint'):
+                        countdowns['checkpoint'] = None
+                        checkpoint_flag = True
 
-                if check_countdown('checkpoint'):
-                    countdowns['checkpoint'] = None
-                    checkpoint_flag = True
+                    # ---------------------------------------
+                    # Output Diagnostics
 
-                # ---------------------------------------
-                # Output Diagnostics
+                    # Print the epoch
+                    utils.print_epoch_info(model, printcol_info, epoch_info)
 
-                # Print the epoch
-                utils.print_epoch_info(model, printcol_info, epoch_info)
+                    # Output any diagnostics
+                    if checkpoint_flag:
+                        # FIXME: just move it to the second location
+                        if model.monitor_config['monitor']:
+                            model._dump_best_monitor()
+                        model.save_checkpoint()
 
-                # Output any diagnostics
-                if checkpoint_flag:
-                    # FIXME: just move it to the second location
                     if model.monitor_config['monitor']:
-                        model._dump_best_monitor()
-                    model.checkpoint_save_model_info()
-                    model.checkpoint_save_model_state()
-                    model.save_model_info()
-                    model.save_model_state()
-
-                if model.monitor_config['monitor']:
-                    model._dump_epoch_monitor()
-                    # if epoch > 10:
-                    # TODO: can dump case info every epoch
-                    # But we want to dump the images less often
-                    # Make function to just grab the failure case info
-                    # and another function to visualize it.
-
-                if model.monitor_config['monitor']:
-                    if utils.checkfreq(model.monitor_config['weight_dump_freq'], epoch):
-                        model._dump_weight_monitor()
-                    if utils.checkfreq(model.monitor_config['case_dump_freq'], epoch):
-                        model._dump_case_monitor(X_learn, y_learn, X_valid, y_valid)
-
-                if check_countdown('stop'):
-                    print('Early stopping')
-                    break
-
-                # Check if the era is done
-                max_era_size = model._fit_session['max_era_size']
-                if model.history.current_era_size >= max_era_size:
-                    # Decay learning rate
-                    era = model.history.total_eras
-                    rate_schedule = model.hyperparams['rate_schedule']
-                    rate_schedule = ut.ensure_iterable(rate_schedule)
-                    frac = rate_schedule[min(era, len(rate_schedule) - 1)]
-                    model.learn_state.learning_rate = (
-                        model.learn_state.learning_rate * frac
-                    )
-                    # Increase number of epochs in the next era
-                    max_era_size = np.ceil(max_era_size / (frac ** 2))
-                    model._fit_session['max_era_size'] = max_era_size
-                    # Start a new era
-                    model.history._new_era(model, X_train, y_train, X_train, y_train)
-
-                    if model.hyperparams.get('era_clean', False):
-                        y_learn = model._epoch_clean(
-                            theano_forward, X_learn, y_learn, w_learn
-                        )
-                        y_valid = model._epoch_clean(
-                            theano_forward, X_valid, y_valid, w_valid
-                        )
+                        model._dump_epoch_monitor()
+                        # if epoch > 10:
+                        # TODO: can dump case info every epoch
+                        # But we want to dump the images less often
+                        # Make function to just grab the failure case info
+                        # and another function to visualize it.
 
-                    utils.print_header_columns(printcol_info)
-
-                # Break on max epochs
-                if model.hyperparams['max_epochs'] is not None:
-                    if epoch >= model.hyperparams['max_epochs']:
-                        print('\n[train] maximum number of epochs reached\n')
+                    if model.monitor_config['monitor']:
+                        if utils.checkfreq(
+                            model.monitor_config['weight_dump_freq'], epoch
+                        ):
+                            model._dump_weight_monitor()
+                        if utils.checkfreq(model.monitor_config['case_dump_freq'], epoch):
+                            model._dump_case_monitor(X_learn, y_learn, X_valid, y_valid)
+
+                    if check_countdown('stop'):
+                        print('Early stopping')
                         break
-                # Increment the epoch
-                epoch += 1
 
-            except KeyboardInterrupt:
-                print('\n[train] Caught CRTL+C')
-                print('model.arch_id = %r' % (model.arch_id,))
-                print('learn_state = %s' % ut.repr4(model.learn_state.asdict()))
-                from six.moves import input
-
-                actions = ut.odict(
-                    [
-                        ('resume', (['0', 'r'], 'resume training')),
-                        ('view', (['v', 'view'], 'view session directory')),
-                        ('ipy', (['ipy', 'ipython', 'cmd'], 'embed into IPython')),
-                        ('print', (['p', 'print'], 'print model state')),
-                        ('shock', (['shock'], 'shock the network')),
-                        ('save', (['s', 'save'], 'save best weights')),
-                        ('quit', (['q', 'exit', 'quit'], 'quit')),
-                    ]
-                )
-                while True:
-                    # prompt
-                    msg_list = [
-                        'enter %s to %s'
-                        % (ut.conj_phrase(ut.lmap(repr, map(str, tup[0])), 'or'), tup[1])
-                        for key, tup in actions.items()
-                    ]
-                    msg = ut.indentjoin(msg_list, '\n | * ')
-                    msg = ''.join([' +-----------', msg, '\n L-----------\n'])
-                    print(msg)
-                    #
-                    ans = str(input()).strip()
-
-                    # We have a resolution
-                    if ans in actions['quit'][0]:
-                        print('quit training...')
-                        return
-                    elif ans in actions['resume'][0]:
-                        break
-                    elif ans in actions['ipy'][0]:
-                        ut.embed()
-                    elif ans in actions['save'][0]:
-                        # Save the weights of the network
-                        model.checkpoint_save_model_info()
-                        model.checkpoint_save_model_state()
-                        model.save_model_info()
-                        model.save_model_state()
-                    elif ans in actions['print'][0]:
-                        model.print_state_str()
-                    elif ans in actions['shock'][0]:
-                        utils.shock_network(model.output_layer)
+                    # Check if the era is done
+                    max_era_size = model._fit_session['max_era_size']
+                    if model.history.current_era_size >= max_era_size:
+                        # Decay learning rate
+                        era = model.history.total_eras
+                        rate_schedule = model.hyperparams['rate_schedule']
+                        rate_schedule = ut.ensure_iterable(rate_schedule)
+                        frac = rate_schedule[min(era, len(rate_schedule) - 1)]
                         model.learn_state.learning_rate = (
-                            model.learn_state.learning_rate * 2
+                            model.learn_state.learning_rate * frac
                         )
-                    elif ans in actions['view'][0]:
-                        session_dpath = model._fit_session['session_dpath']
-                        ut.view_directory(session_dpath)
-                    else:
-                        continue
-                    # Handled the resolution
-                    print('resuming training...')
-                    break
-            except (IndexError, ValueError, Exception) as ex:
-                ut.printex(ex, 'Error Occurred Embedding to enable debugging', tb=True)
-                errorstate = {'is_fixed': False}
-                # is_fixed = False
-                import utool
-
-                utool.embed()
-                if not errorstate['is_fixed']:
-                    raise
+                        # Increase number of epochs in the next era
+                        max_era_size = np.ceil(max_era_size / (frac ** 2))
+                        model._fit_session['max_era_size'] = max_era_size
+                        # Start a new era
+                        model.history._new_era(model, X_train, y_train, X_train, y_train)
+
+                        if model.hyperparams.get('era_clean', False):
+                            y_learn = model._epoch_clean(
+                                theano_forward, X_learn, y_learn, w_learn
+                            )
+                            y_valid = model._epoch_clean(
+                                theano_forward, X_valid, y_valid, w_valid
+                            )
+                            valid_subset = model._valid_subset(X_valid, y_valid, w_valid)
+                            best_subset_loss = np.inf
+
+                        utils.print_header_columns(printcol_info)
+
+                    # Break on max epochs
+                    if model.hyperparams['max_epochs'] is not None:
+                        if epoch >= model.hyperparams['max_epochs']:
+                            print('\n[train] maximum number of epochs reached\n')
+                            break
+                    # Increment the epoch
+                    epoch += 1
+
+                except KeyboardInterrupt:
+                    print('\n[train] Caught CRTL+C')
+                    print('model.arch_id = %r' % (model.arch_id,))
+                    print('learn_state = %s' % ut.repr4(model.learn_state.asdict()))
+                    from six.moves import input
+
+                    actions = ut.odict(
+                        [
+                            ('resume', (['0', 'r'], 'resume training')),
+                            ('view', (['v', 'view'], 'view session directory')),
+                            ('ipy', (['ipy', 'ipython', 'cmd'], 'embed into IPython')),
+                            ('print', (['p', 'print'], 'print model state')),
+                            ('shock', (['shock'], 'shock the network')),
+                            ('save', (['s', 'save'], 'save best weights')),
+                            ('quit', (['q', 'exit', 'quit'], 'quit')),
+                        ]
+                    )
+                    while True:
+                        # prompt
+                        msg_list = [
+                            'enter %s to %s'
+                            % (
+                                ut.conj_phrase(ut.lmap(repr, map(str, tup[0])), 'or'),
+                                tup[1],
+                            )
+                            for key, tup in actions.items()
+                        ]
+                        msg = ut.indentjoin(msg_list, '\n | * ')
+                        msg = ''.join([' +-----------', msg, '\n L-----------\n'])
+                        print(msg)
+                        #
+                        ans = str(input()).strip()
+
+                        # We have a resolution
+                        if ans in actions['quit'][0]:
+                            print('quit training...')
+                            return
+                        elif ans in actions['resume'][0]:
+                            break
+                        elif ans in actions['ipy'][0]:
+                            ut.embed()
+                        elif ans in actions['save'][0]:
+                            # Save the weights of the network
+                            model.save_checkpoint(wait=True)
+                        elif ans in actions['print'][0]:
+                            model.print_state_str()
+                        elif ans in actions['shock'][0]:
+                            utils.shock_network(model.output_layer)
+                            model.learn_state.learning_rate = (
+                                model.learn_state.learning_rate * 2
+                            )
+                        elif ans in actions['view'][0]:
+                            session_dpath = model._fit_session['session_dpath']
+                            ut.view_directory(session_dpath)
+                        else:
+                            continue
+                        # Handled the resolution
+                        print('resuming training...')
+                        break
+                except (IndexError, ValueError, Exception) as ex:
+                    ut.printex(
+                        ex, 'Error Occurred Embedding to enable debugging', tb=True
+                    )
+                    errorstate = {'is_fixed': False}
+                    # is_fixed = False
+                    import utool
+
+                    utool.embed()
+                    if not errorstate['is_fixed']:
+                        raise
+        finally:
+            # Also on errors and the Ctrl+C quit: stop the background workers
+            # and write the queued checkpoints before the daemon writer dies
+            model._close_fit_session()
         # Save the best network
-        model.checkpoint_save_model_state()
-        model.save_model_state()
+        model.save_checkpoint(wait=True)
 
         # Set model to best weights
         model.set_all_param_values(model.best_results['weights'])
@@ -884,8 +1105,8 @@ class _ModelFitter(object):
                 print('computing center mean/std. (hacks std=1)')
                 X_ = X_learn.astype(np.float32)
                 try:
-                    if ut.is_int(X_learn):
-                        ut.assert_inbounds(X_learn, 0, 255, eq=True, verbose=ut.VERBOSE)
+                    if np.issubdtype(X_learn.dtype, np.integer):
+                        ut.assert_inbounds(X_, 0, 255, eq=True, verbose=ut.VERBOSE)
                         X_ = X_ / 255
                     ut.assert_inbounds(X_, 0.0, 1.0, eq=True, verbose=ut.VERBOSE)
                 except ValueError:
@@ -949,6 +1170,8 @@ class _ModelFitter(object):
         }
         # TODO: ensure this somewhere else?
         model._rng = ut.ensure_rng(model.hyperparams['random_seed'])
+        # The renderer of a previous session writes to its own session dir
+        model._close_monitor_renderer()
 
         if model.monitor_config['monitor']:
             ut.ensuredir(model.arch_dpath)
@@ -982,6 +1205,15 @@ class _ModelFitter(object):
             ut.ensuredir(session_dpath)
             model._fit_session['session_dpath'] = session_dpath
 
+            # Append the history of this session as it is recorded. The log
+            # is outside the session directory, which _rename_old_sessions
+            # moves, because checkpoints reference it.
+            from wbia_cnn import history_log
+
+            model.history.attach_log(
+                history_log.session_log_fpath(model.arch_dpath, session_dpath)
+            )
+
             if ut.get_argflag('--vd'):
                 # Open session in file explorer
                 ut.view_directory(session_dpath)
@@ -1099,13 +1331,68 @@ class _ModelFitter(object):
         ut.write_to(report_fpath, report_json, verbose=False)
 
     def _dump_epoch_monitor(model):
-        prog_dirs = model._fit_session['prog_dirs']
-        session_dpath = model._fit_session['session_dpath']
+        """
+        Queues the epoch figures to the monitor renderer process when the
+        async_monitor behavior is on, otherwise renders them here.
+        """
+        if model._behavior.get('async_monitor', False) and _can_fork_workers():
+            from wbia_cnn import monitor_renderer
+
+            renderer = getattr(model, '_monitor_renderer', None)
+            if renderer is None or not renderer.is_alive():
+                renderer = monitor_renderer.MonitorRenderer(model)
+                model._monitor_renderer = renderer
+            renderer.submit(model)
+        else:
+            model._render_epoch_monitor()
+
+    def _close_monitor_renderer(model):
+        """ Waits for the newest epoch figures and stops the renderer """
+        renderer = getattr(model, '_monitor_renderer', None)
+        if renderer is not None:
+            renderer.close()
+        model._monitor_renderer = None
 
-        # Save text history info
-        text_fpath = join(session_dpath, 'era_history.txt')
-        history_text = model.history.to_json()
-        ut.write_to(text_fpath, history_text, verbose=False)
+    def _close_fit_session(model):
+        """
+        Stops the data-parallel, prefetch, and augmentation workers and the
+        monitor renderer, closes the history log, and waits for the queued
+        checkpoints
+        """
+        from wbia_cnn import checkpoint_writer
+
+        model._close_data_parallel()
+        model._close_prefetch_workers()
+        model._close_augment_pool()
+        model._close_monitor_renderer()
+        model.history.close_log()
+        checkpoint_writer.flush()
+
+    def _close_data_parallel(model):
+        """ Stops the data-parallel learning workers (see data_parallel) """
+        learner = getattr(model, '_data_parallel', None)
+        if learner is not None:
+            learner.close()
+        model._data_parallel = None
+
+    def _close_prefetch_workers(model):
+        """ Stops the batch preparation workers (see prefetch_batch_iterator) """
+        workers = getattr(model, '_prefetch_workers', None)
+        if workers is not None:
+            workers.close()
+        model._prefetch_workers = None
+
+    def _close_augment_pool(model):
+        """ Stops the parallel augmentation workers (see _shared_augment) """
+        batch_pool = getattr(model, '_augment_pool', None)
+        if batch_pool is not None:
+            batch_pool.close()
+        model._augment_pool = None
+
+    def _render_epoch_monitor(model):
+        prog_dirs = model._fit_session['prog_dirs']
+        # (the text history is appended to history_logs/<session>.jsonl as it
+        # is recorded)
 
         # Save loss graphs
         try:
@@ -1171,62 +1458,39 @@ class _ModelFitter(object):
             # faster.
             augment_on = False
 
-        learn_outputs = model.process_batch(
-            theano_backprop,
-            X_learn,
-            y_learn,
-            w_learn,
-            shuffle=True,
-            augment_on=augment_on,
-            buffered=buffered,
-        )
+        num_workers = model._behavior.get('train_workers', 0)
+        if num_workers > 1 and _can_fork_workers():
+            # Data-parallel learning in forked worker processes
+            from wbia_cnn import data_parallel
+
+            learn_metrics = data_parallel.process_epoch(
+                model,
+                theano_backprop,
+                X_learn,
+                y_learn,
+                w_learn,
+                augment_on=augment_on,
+                accumulate=True,
+            )
+        else:
+            learn_metrics = model.process_batch(
+                theano_backprop,
+                X_learn,
+                y_learn,
+                w_learn,
+                shuffle=True,
+                augment_on=augment_on,
+                buffered=buffered,
+                accumulate=True,
+            )
 
         # average loss over all learning batches
-        learn_info = {}
-        learn_info['learn_loss'] = learn_outputs['loss'].mean()
-        learn_info['learn_loss_std'] = learn_outputs['loss'].std()
-
-        if 'loss_reg' in learn_outputs:
-            # Regularization information
-            learn_info['learn_loss_reg'] = learn_outputs['loss_reg']
-            reg_amount = learn_outputs['loss_reg'] - learn_outputs['loss']
-            reg_ratio = reg_amount / learn_outputs['loss']
-            reg_percent = reg_amount / learn_outputs['loss_reg']
-
-            if 'accuracy' in learn_outputs:
-                learn_info['learn_acc'] = learn_outputs['accuracy'].mean()
-                learn_info['learn_acc_std'] = learn_outputs['accuracy'].std()
-            if 'predictions' in learn_outputs:
-                try:
-                    p, r, f, s = sklearn.metrics.precision_recall_fscore_support(
-                        y_true=learn_outputs['auglbl_list'],
-                        y_pred=learn_outputs['predictions'],
-                    )
-                except ValueError:
-                    p, r, f, s = 0.0, 0.0, 0.0, 0.0
-                # report = sklearn.metrics.classification_report(
-                #    y_true=learn_outputs['auglbl_list'], y_pred=learn_outputs['predictions']
-                # )
-                learn_info['learn_precision'] = p
-                learn_info['learn_recall'] = r
-                learn_info['learn_fscore'] = f
-                learn_info['learn_support'] = s
-
-            learn_info['reg_percent'] = reg_percent
-            learn_info['reg_ratio'] = reg_ratio
-
-        param_update_mags = {}
-        for key, val in learn_outputs.items():
-            if key.startswith('param_update_magnitude_'):
-                key_ = key.replace('param_update_magnitude_', '')
-                param_update_mags[key_] = (val.mean(), val.std())
-        if param_update_mags:
-            learn_info['param_update_mags'] = param_update_mags
+        learn_info = model._learn_info(learn_metrics, 'loss')
 
         # If the training loss is nan, the training has diverged
         if np.isnan(learn_info['learn_loss']):
             print('\n[train] train loss is Nan. training diverged\n')
-            print('learn_outputs = %r' % (learn_outputs,))
+            print('learn_info = %r' % (learn_info,))
             print('\n[train] train loss is Nan. training diverged\n')
             """
             from wbia_cnn import draw_net
@@ -1236,40 +1500,29 @@ class _ModelFitter(object):
             learn_info['diverged'] = True
         return learn_info
 
-    def _epoch_validate_learn(model, theano_forward, X_learn, y_learn, w_learn):
+    def _learn_info(model, learn_metrics, loss_key):
         """
-        Forwards propagate -- Run validation set through the forwards pass
+        Summarizes the EpochMetrics of a pass over the learning set
         """
-        augment_on = model.hyperparams.get('augment_on_validate', False)
-        learn_outputs = model.process_batch(
-            theano_forward, X_learn, y_learn, w_learn, augment_on=augment_on
-        )
-        # average loss over all learning batches
         learn_info = {}
-        learn_info['learn_loss'] = learn_outputs['loss_determ'].mean()
-        learn_info['learn_loss_std'] = learn_outputs['loss_determ'].std()
+        learn_info['learn_loss'] = learn_metrics.mean(loss_key)
+        learn_info['learn_loss_std'] = learn_metrics.std(loss_key)
+        learn_info['learn_loss_hist'] = learn_metrics.loss_hist(loss_key)
 
-        if 'loss_reg' in learn_outputs:
+        if learn_metrics.has('loss_reg'):
             # Regularization information
-            learn_info['learn_loss_reg'] = learn_outputs['loss_reg']
-            reg_amount = learn_outputs['loss_reg'] - learn_outputs['loss']
-            reg_ratio = reg_amount / learn_outputs['loss']
-            reg_percent = reg_amount / learn_outputs['loss_reg']
-
-            if 'accuracy' in learn_outputs:
-                learn_info['learn_acc'] = learn_outputs['accuracy'].mean()
-                learn_info['learn_acc_std'] = learn_outputs['accuracy'].std()
-            if 'predictions' in learn_outputs:
-                try:
-                    p, r, f, s = sklearn.metrics.precision_recall_fscore_support(
-                        y_true=learn_outputs['auglbl_list'],
-                        y_pred=learn_outputs['predictions'],
-                    )
-                except ValueError:
-                    p, r, f, s = 0.0, 0.0, 0.0, 0.0
-                # report = sklearn.metrics.classification_report(
-                #    y_true=learn_outputs['auglbl_list'], y_pred=learn_outputs['predictions']
-                # )
+            loss = learn_metrics.mean('loss')
+            loss_reg = learn_metrics.mean('loss_reg')
+            learn_info['learn_loss_reg'] = loss_reg
+            reg_amount = loss_reg - loss
+            reg_ratio = reg_amount / loss
+            reg_percent = reg_amount / loss_reg
+
+            if learn_metrics.has('accuracy'):
+                learn_info['learn_acc'] = learn_metrics.accuracy()
+                learn_info['learn_acc_std'] = learn_metrics.std('accuracy')
+            if learn_metrics.has_predictions():
+                p, r, f, s = learn_metrics.precision_recall_fscore_support()
                 learn_info['learn_precision'] = p
                 learn_info['learn_recall'] = r
                 learn_info['learn_fscore'] = f
@@ -1279,36 +1532,103 @@ class _ModelFitter(object):
             learn_info['reg_ratio'] = reg_ratio
 
         param_update_mags = {}
-        for key, val in learn_outputs.items():
+        for key in learn_metrics.stat_names():
             if key.startswith('param_update_magnitude_'):
                 key_ = key.replace('param_update_magnitude_', '')
-                param_update_mags[key_] = (val.mean(), val.std())
+                param_update_mags[key_] = (learn_metrics.mean(key), learn_metrics.std(key))
         if param_update_mags:
             learn_info['param_update_mags'] = param_update_mags
         return learn_info
 
+    def _epoch_validate_learn(model, theano_forward, X_learn, y_learn, w_learn):
+        """
+        Forwards propagate -- Run validation set through the forwards pass
+        """
+        augment_on = model.hyperparams.get('augment_on_validate', False)
+        learn_metrics = model.process_batch(
+            theano_forward,
+            X_learn,
+            y_learn,
+            w_learn,
+            augment_on=augment_on,
+            accumulate=True,
+        )
+        # average loss over all learning batches
+        learn_info = model._learn_info(learn_metrics, 'loss_determ')
+        return learn_info
+
+    def _valid_subset(model, X_valid, y_valid, w_valid):
+        """
+        Returns the fixed validation subsample (X, y, w) of valid_subsample
+        labels, stratified by class, or None if every epoch validates on the
+        full set. The same labels are drawn every epoch so subset losses are
+        comparable with each other.
+
+        Example:
+            >>> # ENABLE_DOCTEST
+            >>> from wbia_cnn.models.abstract_models import *  # NOQA
+            >>> model = BaseModel(valid_subsample=10)
+            >>> model.data_per_label_input = 2
+            >>> y_valid = np.array([0] * 80 + [1] * 20)
+            >>> X_valid = np.arange(200)
+            >>> w_valid = np.ones(100, dtype=np.float32)
+            >>> X, y, w = model._valid_subset(X_valid, y_valid, w_valid)
+            [model] validating on 10 of 100 labels between full validations
+            >>> print(np.bincount(y))
+            [8 2]
+            >>> assert np.all(X[0::2] // 2 == X[1::2] // 2)
+            >>> assert np.all(y_valid[X[0::2] // 2] == y)
+        """
+        num = model.monitor_config.get('valid_subsample', None)
+        num_labels = len(y_valid)
+        if not num or num >= num_labels:
+            return None
+        rng = np.random.RandomState(0)
+        if y_valid.ndim == 1:
+            unique, groupxs = ut.group_indices(y_valid)
+            sizes = np.array(list(map(len, groupxs)))
+            # Proportional allocation with at least one label per class
+            nums = np.clip(np.round(num * sizes / num_labels).astype(int), 1, sizes)
+            label_idx = np.hstack(
+                [rng.choice(groupx, n, replace=False) for groupx, n in zip(groupxs, nums)]
+            )
+        else:
+            label_idx = rng.choice(num_labels, num, replace=False)
+        label_idx = np.sort(label_idx)
+        dpl = model.data_per_label_input
+        data_idx = (label_idx[:, None] * dpl + np.arange(dpl)).ravel()
+        print(
+            '[model] validating on %d of %d labels between full validations'
+            % (len(label_idx), num_labels)
+        )
+        return (
+            X_valid.take(data_idx, axis=0),
+            y_valid.take(label_idx, axis=0),
+            w_valid.take(label_idx, axis=0),
+        )
+
     def _epoch_validate(model, theano_forward, X_valid, y_valid, w_valid):
         """
         Forwards propagate -- Run validation set through the forwards pass
         """
         augment_on = model.hyperparams.get('augment_on_validate', False)
-        valid_outputs = model.process_batch(
-            theano_forward, X_valid, y_valid, w_valid, augment_on=augment_on
+        valid_metrics = model.process_batch(
+            theano_forward,
+            X_valid,
+            y_valid,
+            w_valid,
+            augment_on=augment_on,
+            accumulate=True,
         )
         valid_info = {}
-        valid_info['valid_loss'] = valid_outputs['loss_determ'].mean()
-        valid_info['valid_loss_std'] = valid_outputs['loss_determ'].std()
+        valid_info['valid_loss'] = valid_metrics.mean('loss_determ')
+        valid_info['valid_loss_std'] = valid_metrics.std('loss_determ')
+        valid_info['valid_loss_hist'] = valid_metrics.loss_hist('loss_determ')
         if 'valid_acc' in model.requested_headers:
-            valid_info['valid_acc'] = valid_outputs['accuracy'].mean()
-            valid_info['valid_acc_std'] = valid_outputs['accuracy'].std()
-        if 'predictions' in valid_outputs:
-            try:
-                p, r, f, s = sklearn.metrics.precision_recall_fscore_support(
-                    y_true=valid_outputs['auglbl_list'],
-                    y_pred=valid_outputs['predictions'],
-                )
-            except ValueError:
-                p, r, f, s = 0.0, 0.0, 0.0, 0.0
+            valid_info['valid_acc'] = valid_metrics.accuracy()
+            valid_info['valid_acc_std'] = valid_metrics.std('accuracy')
+        if valid_metrics.has_predictions():
+            p, r, f, s = valid_metrics.precision_recall_fscore_support()
             valid_info['valid_precision'] = p
             valid_info['valid_recall'] = r
             valid_info['valid_fscore'] = f
@@ -1476,29 +1796,75 @@ class _BatchUtility(object):
 
     @classmethod
     def slice_batch(
-        cls, X, y, w, batch_size, batch_index, data_per_label=1, wraparound=False
+        cls,
+        X,
+        y,
+        w,
+        batch_size,
+        batch_index,
+        data_per_label=1,
+        wraparound=False,
+        pad_buffers=None,
+        label_perm=None,
     ):
+        """
+        Takes a batch of data. If wraparound is True the final batch is zero
+        padded up to batch_size (for functions compiled with a fixed batch
+        size). The padded batches are written to reusable arrays kept in the
+        pad_buffers dict.
+
+        If label_perm is given the batch is gathered from the labels at that
+        position of the permutation (and their data_per_label items) instead
+        of sliced, so shuffled epochs never copy the whole dataset.
+
+        Example:
+            >>> # ENABLE_DOCTEST
+            >>> from wbia_cnn.models.abstract_models import *  # NOQA
+            >>> X = np.arange(10).reshape(5, 2)
+            >>> y = np.arange(5)
+            >>> slice_kw = dict(batch_size=4, wraparound=True, pad_buffers={})
+            >>> Xb, yb, wb = _BatchUtility.slice_batch(X, y, None, batch_index=1, **slice_kw)
+            >>> print(Xb.tolist(), yb.tolist(), wb)
+            [[8, 9], [0, 0], [0, 0], [0, 0]] [4, 0, 0, 0] None
+
+        Example:
+            >>> # ENABLE_DOCTEST
+            >>> from wbia_cnn.models.abstract_models import *  # NOQA
+            >>> # Siamese pairs stay together when gathering from a permutation
+            >>> X = np.arange(12).reshape(6, 2)
+            >>> y = np.arange(3)
+            >>> slice_kw = dict(batch_size=4, data_per_label=2, label_perm=np.array([2, 0, 1]))
+            >>> Xb, yb, wb = _BatchUtility.slice_batch(X, y, None, batch_index=0, **slice_kw)
+            >>> print(Xb.tolist(), yb.tolist())
+            [[8, 9], [10, 11], [0, 1], [2, 3]] [2, 0]
+        """
         start_x = batch_index * batch_size
         end_x = (batch_index + 1) * batch_size
         # Take full batch of images and take the fraction of labels if
         # data_per_label > 1
-        x_sl = slice(start_x, end_x)
         y_sl = slice(start_x // data_per_label, end_x // data_per_label)
-        Xb = X[x_sl]
-        yb = y if y is None else y[y_sl]
-        wb = w if w is None else w[y_sl]
-        if wraparound:
-            # Append extra data to ensure the batch size is full
-            if Xb.shape[0] != batch_size:
-                extra = batch_size - Xb.shape[0]
-                Xb_wrap = X[slice(0, extra)]
-                Xb = np.concatenate([Xb, Xb_wrap], axis=0)
-                if yb is not None:
-                    yb_wrap = y[slice(0, extra // data_per_label)]
-                    yb = np.concatenate([yb, yb_wrap], axis=0)
-                if wb is not None:
-                    wb_wrap = w[slice(0, extra // data_per_label)]
-                    wb = np.concatenate([wb, wb_wrap], axis=0)
+        if label_perm is None:
+            x_sl = slice(start_x, end_x)
+            Xb = X[x_sl]
+            yb = y if y is None else y[y_sl]
+            wb = w if w is None else w[y_sl]
+        else:
+            label_idx = label_perm[y_sl]
+            data_idx = cls.expand_data_indicies(label_idx, data_per_label)
+            Xb = _gather_rows(X, data_idx)
+            yb = y if y is None else y.take(label_idx, axis=0)
+            wb = w if w is None else w.take(label_idx, axis=0)
+        if wraparound and Xb.shape[0] != batch_size:
+            # Zero pad the batch to the fixed size. Padded items have zero
+            # weight and their outputs are sliced off by _unwrap_outputs.
+            if pad_buffers is None:
+                pad_buffers = {}
+            num_labels = batch_size // data_per_label
+            Xb = _pad_batch(Xb, batch_size, pad_buffers, 'X')
+            if yb is not None:
+                yb = _pad_batch(yb, num_labels, pad_buffers, 'y')
+            if wb is not None:
+                wb = _pad_batch(wb, num_labels, pad_buffers, 'w')
         return Xb, yb, wb
 
     def _pad_labels(model, yb):
@@ -1532,20 +1898,189 @@ class _BatchUtility(object):
         return outputs
 
     def _unwrap_outputs(model, outputs, X):
-        # batch iteration may wrap-around returned data.
+        # the final batch may be padded to a fixed batch size.
         # slice off the padding
-        num_inputs = X.shape[0] / model.data_per_label_input
-        num_outputs = num_inputs * model.data_per_label_output
-        for key in outputs.keys():
-            outputs[key] = outputs[key][0 : int(num_outputs)]
+        dpl_in = model.data_per_label_input
+        dpl_out = model.data_per_label_output
+        batch_size = model.batch_size
+        num_outputs = (X.shape[0] // dpl_in) * dpl_out
+        if batch_size is None:
+            num_padded = X.shape[0]
+        else:
+            num_padded = ((X.shape[0] + batch_size - 1) // batch_size) * batch_size
+        num_padded_outputs = (num_padded // dpl_in) * dpl_out
+        for key, value in outputs.items():
+            if np.ndim(value) > 0 and len(value) == num_padded_outputs:
+                outputs[key] = value[0:num_outputs]
         return outputs
 
 
+def _gather_rows(X, data_idx):
+    """
+    Returns X[data_idx]. Memory-mapped data is read in sorted index order, so
+    the pages of a batch are touched sequentially, and then reordered.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.models.abstract_models import *  # NOQA
+        >>> dpath = ut.ensure_app_resource_dir('wbia_cnn', 'test_gather')
+        >>> fpath = join(dpath, 'X.npy')
+        >>> np.save(fpath, np.arange(20).reshape(10, 2))
+        >>> X = np.load(fpath, mmap_mode='r')
+        >>> print(_gather_rows(X, np.array([7, 2, 9])).tolist())
+        [[14, 15], [4, 5], [18, 19]]
+    """
+    if not isinstance(X, np.memmap):
+        return X.take(data_idx, axis=0)
+    sortx = np.argsort(data_idx, kind='mergesort')
+    Xb = np.empty((len(data_idx),) + X.shape[1:], dtype=X.dtype)
+    Xb[sortx] = X[data_idx[sortx]]
+    return Xb
+
+
+def _pad_batch(arr, num, pad_buffers, key):
+    """
+    Copies arr into the front of a reusable zeroed buffer of length num
+    """
+    shape = (num,) + arr.shape[1:]
+    buf = pad_buffers.get(key, None)
+    if buf is None or buf.shape != shape or buf.dtype != arr.dtype:
+        buf = pad_buffers[key] = np.zeros(shape, dtype=arr.dtype)
+    buf[0 : len(arr)] = arr
+    buf[len(arr) :] = 0
+    return buf
+
+
+def _can_fork_workers():
+    import multiprocessing
+
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+# State of a forked prefetch worker (see _ModelBatch.prefetch_batch_iterator)
+_PREFETCH_STATE = {}
+
+
+def _prefetch_worker_init(model, X, y, w):
+    try:
+        import cv2
+
+        # The OpenCV thread pool of the parent does not survive the fork
+        cv2.setNumThreads(0)
+    except ImportError:
+        pass
+    if 'parallel' in ut.get_func_argspec(model.augment).args:
+        # Daemonic workers cannot start process pools of their own
+        model.augment = ut.partial(model.augment, parallel=False)
+    # The worker pads its final batches into buffers of its own
+    model._pad_buffers = {}
+    _PREFETCH_STATE.update(model=model, X=X, y=y, w=w)
+
+
+def _prefetch_worker_batch(batch_index, seed, label_idx, slice_kw, prep_kw):
+    import random
+
+    state = _PREFETCH_STATE
+    model = state['model']
+    # Augmentations use the random module, the global numpy state, or
+    # model._rng. Reseed all of them for every batch.
+    random.seed(seed)
+    np.random.seed(seed)
+    model._rng = np.random.RandomState(seed)
+    if label_idx is not None:
+        # Shuffled epoch: gather the labels of this batch from the inherited
+        # (unshuffled) data
+        slice_kw = dict(slice_kw, label_perm=label_idx)
+        batch_index = 0
+    Xb_, yb_, wb_ = model.slice_batch(
+        state['X'],
+        state['y'],
+        state['w'],
+        batch_index=batch_index,
+        pad_buffers=model._pad_buffers,
+        **slice_kw
+    )
+    return model._prepare_batch(Xb_, yb_, wb_, **prep_kw)
+
+
+@ut.reloadable_class
+class _PrefetchWorkers(object):
+    """
+    Pool of forked processes that prepare the batches of
+    prefetch_batch_iterator. The workers are forked with the data, so they
+    only serve the X, y, and w they were created with and are kept until the
+    data change or the fit session closes.
+    """
+
+    def __init__(workers, model, X, y, w, num_workers):
+        import multiprocessing
+
+        # Forked workers inherit their initargs without pickling them
+        ctx = multiprocessing.get_context('fork')
+        workers.X, workers.y, workers.w = X, y, w
+        workers.num_workers = num_workers
+        workers._pool = ctx.Pool(
+            num_workers, initializer=_prefetch_worker_init, initargs=(model, X, y, w)
+        )
+
+    def serves(workers, X, y, w, num_workers):
+        return (
+            workers._pool is not None
+            and workers.X is X
+            and workers.y is y
+            and workers.w is w
+            and workers.num_workers == num_workers
+        )
+
+    def submit(workers, *args):
+        return workers._pool.apply_async(_prefetch_worker_batch, args)
+
+    def close(workers):
+        if workers._pool is not None:
+            workers._pool.terminate()
+            workers._pool.join()
+            workers._pool = None
+
+    def __del__(workers):
+        if getattr(workers, '_pool', None) is not None:
+            workers.close()
+
+
 @ut.reloadable_class
 class _ModelBatch(_BatchUtility):
     def _init_batch_vars(model, kwargs):
         model.pad_labels = False
         model.X_is_cv2_native = True
+        # Reused arrays for zero padding final batches to a fixed batch size
+        model._pad_buffers = {}
+        # Worker processes of data-parallel learning (see data_parallel)
+        model._data_parallel = None
+        # Lazily created shared memory slots for parallel augmentation
+        model._augment_pool = None
+        # Batch preparation workers (see prefetch_batch_iterator)
+        model._prefetch_workers = None
+
+    def _shared_augment(model, func, Xb, yb=None):
+        """
+        Runs a batch augmentation function in parallel over shared memory batch
+        slots (see wbia_cnn.shared_batch). Xb is returned as a view into a slot.
+
+        Returns None if shared slots are not supported on this platform.
+        """
+        from wbia_cnn import shared_batch
+
+        if not shared_batch.can_share_batches():
+            return None
+        batch_pool = model._augment_pool
+        if batch_pool is None or batch_pool.func is not func or not batch_pool.fits(Xb):
+            if batch_pool is not None:
+                batch_pool.close()
+            batch_size = max(len(Xb), model.batch_size or 0)
+            batch_pool = shared_batch.SharedBatchPool(
+                func, Xb.shape[1:], Xb.dtype, batch_size=batch_size
+            )
+            model._augment_pool = batch_pool
+        return batch_pool.map_inplace(Xb, yb)
 
     def process_batch(
         model,
@@ -1557,14 +2092,35 @@ class _ModelBatch(_BatchUtility):
         unwrap=False,
         shuffle=False,
         augment_on=False,
+        accumulate=False,
     ):
-        """ Execute a theano function on batches of X and y """
+        """
+        Execute a theano function on batches of X and y
+
+        With accumulate=True the batch outputs are folded into an
+        EpochMetrics (see wbia_cnn.epoch_metrics) as they are computed and it
+        is returned instead of the stacked outputs.
+        """
         # Break data into generated batches
         # TODO: sliced batches when there is no shuffling
         # Create an iterator to generate batches of data
-        batch_iter = model.batch_iterator(X, y, w, shuffle=shuffle, augment_on=augment_on)
-        if buffered:
-            batch_iter = ut.buffered_generator(batch_iter)
+        num_workers = model._behavior.get('prefetch_workers', 0)
+        if buffered and num_workers > 0 and _can_fork_workers():
+            batch_iter = model.prefetch_batch_iterator(
+                X,
+                y,
+                w,
+                shuffle=shuffle,
+                augment_on=augment_on,
+                num_workers=num_workers,
+                max_prefetch=model._behavior.get('prefetch_depth', None),
+            )
+        else:
+            batch_iter = model.batch_iterator(
+                X, y, w, shuffle=shuffle, augment_on=augment_on
+            )
+            if buffered:
+                batch_iter = ut.buffered_generator(batch_iter)
         if model.monitor_config['showprog']:
             num_batches = (X.shape[0] + model.batch_size - 1) // model.batch_size
             batch_iter = ut.ProgIter(
@@ -1576,6 +2132,15 @@ class _ModelBatch(_BatchUtility):
                 adjust=True,
             )
 
+        if accumulate:
+            epoch_metrics = model._new_epoch_metrics(theano_fn, X)
+            for Xb, yb, wb in batch_iter:
+                if y is None:
+                    epoch_metrics.update(theano_fn(Xb))
+                else:
+                    epoch_metrics.update(theano_fn(Xb, yb, wb), yb)
+            return epoch_metrics
+
         # Execute the function with either known or unknown y-targets
         output_list = []
         if y is None:
@@ -1590,9 +2155,22 @@ class _ModelBatch(_BatchUtility):
                 output_list.append(batch_label)
                 aug_yb_list.append(yb)
 
+        return model._finish_outputs(theano_fn, output_list, aug_yb_list, X, unwrap)
+
+    def _new_epoch_metrics(model, theano_fn, X):
+        """ Returns an empty EpochMetrics for the outputs of theano_fn on X """
+        from wbia_cnn import epoch_metrics
+
+        output_vars = [outexpr.variable for outexpr in theano_fn.outputs]
+        output_names = [str(var) if var.name is None else var.name for var in output_vars]
+        num_outputs = (X.shape[0] // model.data_per_label_input) * model.data_per_label_output
+        return epoch_metrics.EpochMetrics(output_names, num_outputs)
+
+    def _finish_outputs(model, theano_fn, output_list, aug_yb_list, X, unwrap=False):
+        """ Combines the per-batch outputs of process_batch """
         # Combine results of batches into one big result
         outputs = model._stack_outputs(theano_fn, output_list)
-        if y is not None:
+        if aug_yb_list is not None:
             # Hack in special outputs
             if isinstance(model, AbstractVectorVectorModel):
                 auglbl_list = np.array(aug_yb_list)
@@ -1601,8 +2179,9 @@ class _ModelBatch(_BatchUtility):
             else:
                 auglbl_list = np.hstack(aug_yb_list)
             outputs['auglbl_list'] = auglbl_list
-        if unwrap:
-            # slice of batch induced padding
+        if unwrap or aug_yb_list is not None:
+            # slice of batch induced padding (labeled outputs are always
+            # unwrapped so padding does not enter the metrics)
             outputs = model._unwrap_outputs(outputs, X)
         return outputs
 
@@ -1637,6 +2216,23 @@ class _ModelBatch(_BatchUtility):
             >>> result = depth
             >>> print(result)
         """
+        X, y, w, num_batches, slice_kw, prep_kw = model._setup_batches(
+            X, y, w, shuffle=shuffle, augment_on=augment_on
+        )
+        # Slice and preprocess data in batch
+        for batch_index in range(num_batches):
+            # Take a slice from the data
+            Xb_, yb_, wb_ = model.slice_batch(
+                X, y, w, batch_index=batch_index, **slice_kw
+            )
+            # Prepare data for the GPU
+            Xb, yb, wb = model._prepare_batch(Xb_, yb_, wb_, **prep_kw)
+            yield Xb, yb, wb
+
+    def _setup_batches(model, X, y=None, w=None, shuffle=False, augment_on=False):
+        """
+        Shuffles the inputs and determines how they are sliced and prepared
+        """
         # need to be careful with batchsizes if directly specified to theano
         batch_size = model.batch_size
         data_per_label = model.data_per_label_input
@@ -1645,34 +2241,147 @@ class _ModelBatch(_BatchUtility):
 
         num_batches = (X.shape[0] + batch_size - 1) // batch_size
 
+        label_perm = None
         if shuffle:
             rng = model._rng
-            X, y, w = model.shuffle_input(X, y, w, data_per_label, rng=rng)
+            if model._behavior.get('index_shuffle', False):
+                # Same draw as shuffle_input, but batches are gathered through
+                # the permutation by slice_batch
+                num_labels = X.shape[0] // data_per_label
+                label_perm = ut.random_indexes(num_labels, rng=rng)
+            else:
+                X, y, w = model.shuffle_input(X, y, w, data_per_label, rng=rng)
+
+        slice_kw = dict(
+            batch_size=batch_size,
+            data_per_label=data_per_label,
+            wraparound=wraparound,
+            pad_buffers=model._pad_buffers,
+            label_perm=label_perm,
+        )
+        prep_kw = dict(
+            # X may be a dataset.MemmapSubset, which ut.is_int does not know
+            is_int=np.issubdtype(X.dtype, np.integer),
+            is_cv2=model.X_is_cv2_native,
+            augment_on=augment_on,
+            whiten_on=model.hyperparams['whiten_on'],
+            graph_prep=model._graph_prep_mode() is not None,
+        )
+        if prep_kw['graph_prep']:
+            model._sync_graph_prep()
+        return X, y, w, num_batches, slice_kw, prep_kw
 
-        is_int = ut.is_int(X)
-        is_cv2 = model.X_is_cv2_native
-        whiten_on = model.hyperparams['whiten_on']
+    def prefetch_batch_iterator(
+        model,
+        X,
+        y=None,
+        w=None,
+        shuffle=False,
+        augment_on=False,
+        num_workers=2,
+        max_prefetch=None,
+    ):
+        """
+        Like batch_iterator, but the batches are sliced, augmented, and
+        preprocessed by a pool of forked worker processes while the caller runs
+        the compute function.
+
+        The shuffle happens in the parent process and only the indices of each
+        batch are sent to the workers. The workers are forked once with the
+        (copy-on-write) data and the model as it is at that point, and are
+        reused by later calls with the same X, y, and w (see
+        _close_prefetch_workers). Each batch is prepared with its own RNG
+        stream seeded from model._rng, so an epoch is reproducible regardless
+        of which worker prepares which batch. Batches are yielded in order and
+        at most max_prefetch batches are in flight.
 
-        # Slice and preprocess data in batch
-        for batch_index in range(num_batches):
-            # Take a slice from the data
-            Xb_, yb_, wb_ = model.slice_batch(
-                X, y, w, batch_size, batch_index, data_per_label, wraparound
-            )
-            # Prepare data for the GPU
-            Xb, yb, wb = model._prepare_batch(
-                Xb_,
-                yb_,
-                wb_,
-                is_int=is_int,
-                is_cv2=is_cv2,
-                augment_on=augment_on,
-                whiten_on=whiten_on,
-            )
+        CommandLine:
+            python -m wbia_cnn.models.abstract_models _ModelBatch.prefetch_batch_iterator
+
+        Example:
+            >>> # ENABLE_DOCTEST
+            >>> from wbia_cnn.models.abstract_models import *  # NOQA
+            >>> from wbia_cnn import models
+            >>> model = models.DummyModel(batch_size=16)
+            >>> X, y = model.make_random_testdata(num=37, cv2_format=True)
+            >>> model.ensure_data_params(X, y)
+            >>> serial_list = list(model.batch_iterator(X, y))
+            >>> prefetch_iter = model.prefetch_batch_iterator(X, y, num_workers=2)
+            >>> prefetch_list = list(prefetch_iter)
+            >>> assert len(serial_list) == len(prefetch_list)
+            >>> for (Xb1, yb1, _), (Xb2, yb2, _) in zip(serial_list, prefetch_list):
+            >>>     assert np.all(Xb1 == Xb2) and np.all(yb1 == yb2)
+            >>> # Shuffled epochs reuse the same workers
+            >>> workers = model._prefetch_workers
+            >>> model._rng = np.random.RandomState(0)
+            >>> serial_list = list(model.batch_iterator(X, y, shuffle=True))
+            >>> model._rng = np.random.RandomState(0)
+            >>> prefetch_iter = model.prefetch_batch_iterator(X, y, shuffle=True)
+            >>> prefetch_list = list(prefetch_iter)
+            >>> assert model._prefetch_workers is workers
+            >>> for (Xb1, yb1, _), (Xb2, yb2, _) in zip(serial_list, prefetch_list):
+            >>>     assert np.all(Xb1 == Xb2) and np.all(yb1 == yb2)
+            >>> model._close_prefetch_workers()
+        """
+        import collections
+
+        if max_prefetch is None:
+            max_prefetch = 2 * num_workers
+        workers = model._prefetch_workers
+        if workers is None or not workers.serves(X, y, w, num_workers):
+            if workers is not None:
+                workers.close()
+            workers = _PrefetchWorkers(model, X, y, w, num_workers)
+            model._prefetch_workers = workers
+        _, _, _, num_batches, slice_kw, prep_kw = model._setup_batches(
+            X, y, w, shuffle=False, augment_on=augment_on
+        )
+        data_per_label = slice_kw['data_per_label']
+        # The workers have their own pad buffers
+        slice_kw.pop('pad_buffers')
+        label_perm = None
+        if shuffle:
+            # Same draw as shuffle_input
+            num_labels = X.shape[0] // data_per_label
+            label_perm = ut.random_indexes(num_labels, rng=model._rng)
+        # Seeds are drawn up front so the epoch only depends on model._rng
+        seed_list = model._rng.randint(0, 2 ** 31 - 1, size=num_batches)
+        num_labels_per_batch = slice_kw['batch_size'] // data_per_label
+
+        pending = collections.deque()
+        index_iter = iter(range(num_batches))
+
+        def _submit(batch_index):
+            label_idx = None
+            if label_perm is not None:
+                start = batch_index * num_labels_per_batch
+                label_idx = label_perm[start : start + num_labels_per_batch]
+            seed = int(seed_list[batch_index])
+            result = workers.submit(batch_index, seed, label_idx, slice_kw, prep_kw)
+            pending.append(result)
+
+        for batch_index in index_iter:
+            _submit(batch_index)
+            if len(pending) >= max_prefetch:
+                break
+        while len(pending) > 0:
+            Xb, yb, wb = pending.popleft().get()
+            # Keep the queue full while the caller uses this batch
+            for batch_index in index_iter:
+                _submit(batch_index)
+                break
             yield Xb, yb, wb
 
     def _prepare_batch(
-        model, Xb_, yb_, wb_, is_int=True, is_cv2=True, augment_on=False, whiten_on=False
+        model,
+        Xb_,
+        yb_,
+        wb_,
+        is_int=True,
+        is_cv2=True,
+        augment_on=False,
+        whiten_on=False,
+        graph_prep=False,
     ):
         if augment_on:
             has_encoder = getattr(model, 'encoder', None) is not None
@@ -1682,9 +2391,21 @@ class _ModelBatch(_BatchUtility):
             else:
                 Xb_, yb_ = model.augment(Xb_, yb_)
             yb_ = model.encoder.transform(yb_) if has_encoder else yb_
-        Xb = Xb_.astype(np.float32, copy=True)
         yb = None if yb_ is None else yb_.astype(np.int32, copy=True)
-        wb = None if wb_ is None else wb_.astype(np.float32, copy=False)
+        # Copy: wb_ may be the pad buffer reused for the next final batch
+        wb = None if wb_ is None else wb_.astype(np.float32, copy=True)
+        if graph_prep:
+            # The compiled function scales, whitens, and transposes
+            if not is_int:
+                raise ValueError('graph_prep requires uint8 inputs')
+            # Always copy: Xb_ may be a view into a shared augmentation slot
+            # or a pad buffer that the buffered producer reuses while this
+            # batch is still being trained on
+            Xb = np.array(Xb_, dtype=np.uint8, order='C', copy=True)
+            if yb is not None and model.data_per_label_input > 1 and model.pad_labels:
+                yb = model._pad_labels(yb)
+            return Xb, yb, wb
+        Xb = Xb_.astype(np.float32, copy=True)
         if is_int:
             # Rescale the batch data to the range 0 to 1
             Xb = Xb / 255.0
@@ -1713,8 +2434,15 @@ class _ModelBatch(_BatchUtility):
         is_int = ut.is_int(X)
         is_cv2 = model.X_is_cv2_native
         whiten_on = model.hyperparams['whiten_on']
+        graph_prep = model._graph_prep_mode() is not None
         Xb, yb, wb = model._prepare_batch(
-            X, y, w, is_int=is_int, is_cv2=is_cv2, whiten_on=whiten_on
+            X,
+            y,
+            w,
+            is_int=is_int,
+            is_cv2=is_cv2,
+            whiten_on=whiten_on,
+            graph_prep=graph_prep,
         )
         if y is None:
             return Xb
@@ -1778,6 +2506,64 @@ class _ModelBackend(object):
         model._theano_mode = None
         # theano.compile.FAST_COMPILE
         # theano.compile.FAST_RUN
+        # Reuse compiled functions pickled by previous processes
+        model._compile_cache = kwargs.pop(
+            'compile_cache', not ut.get_argflag('--nocompilecache')
+        )
+
+    def _rebuild_copy(model):
+        """
+        Returns a copy of the model for building a variant of its network
+        (e.g. for another input shape). The configuration is deep copied, so
+        init_arch on the copy never touches the original. The theano graph,
+        compiled functions, learning state, history, and worker processes
+        are not copied.
+        """
+        import copy
+
+        runtime_keys = [
+            'output_layer',
+            'learn_state',
+            'history',
+            '_theano_backprop',
+            '_theano_forward',
+            '_theano_predict',
+            '_theano_mode',
+            '_fit_session',
+            '_monitor_renderer',
+            '_data_parallel',
+            '_augment_pool',
+            '_prefetch_workers',
+            '_fcn_predict_funcs',
+            '_fcn_lock',
+            '_dream',
+        ]
+        state = {
+            key: value
+            for key, value in model.__dict__.items()
+            if key not in runtime_keys and key not in ['_theano_exprs', '_pad_buffers']
+        }
+        new_model = model.__class__.__new__(model.__class__)
+        new_model.__dict__.update(copy.deepcopy(state))
+        for key in runtime_keys:
+            if key in model.__dict__:
+                setattr(new_model, key, None)
+        new_model._theano_exprs = ut.ddict(lambda: None)
+        new_model._pad_buffers = {}
+        return new_model
+
+    def _load_compiled_func(model, fn_kind):
+        if not model._compile_cache:
+            return None
+        from wbia_cnn import compile_cache
+
+        return compile_cache.load_compiled_func(model, fn_kind)
+
+    def _save_compiled_func(model, fn_kind, theano_fn):
+        if model._compile_cache:
+            from wbia_cnn import compile_cache
+
+            compile_cache.save_compiled_func(model, fn_kind, theano_fn)
 
     def build(model):
         print('[model] --- BUILDING SYMBOLIC THEANO FUNCTIONS ---')
@@ -1788,6 +2574,8 @@ class _ModelBackend(object):
 
     def build_predict_func(model):
         """ Computes predictions given unlabeled data """
+        if model._theano_predict is None:
+            model._theano_predict = model._load_compiled_func('predict')
         if model._theano_predict is None:
             print('[model.build] request_predict')
             netout_exprs = model._get_network_output()
@@ -1805,6 +2593,7 @@ class _ModelBackend(object):
                 mode=model._theano_mode,
                 name=':predict',
             )
+            model._save_compiled_func('predict', theano_predict)
             model._theano_predict = theano_predict
         return model._theano_predict
 
@@ -1830,8 +2619,10 @@ class _ModelBackend(object):
             >>> loss_batch = loss_item.eval({X_in: Xb, y_in: yb})
         """
         if model._theano_forward is None:
-            print('[model.build] request_forward')
             model.learn_state.init()
+            model._theano_forward = model._load_compiled_func('forward')
+        if model._theano_forward is None:
+            print('[model.build] request_forward')
             fn_inputs = model._theano_fn_inputs
             X_batch, X_given = ut.take(fn_inputs, ['X_batch', 'X_given'])
             y_batch, y_given = ut.take(fn_inputs, ['y_batch', 'y_given'])
@@ -1854,6 +2645,7 @@ class _ModelBackend(object):
                 mode=model._theano_mode,
                 name=':feedforward',
             )
+            model._save_compiled_func('forward', theano_forward)
             model._theano_forward = theano_forward
         return model._theano_forward
 
@@ -1863,9 +2655,11 @@ class _ModelBackend(object):
         Returns diagnostic information.
         """
         if model._theano_backprop is None:
-            print('[model.build] request_backprop')
             # Must have an initialized learning state
             model.learn_state.init()
+            model._theano_backprop = model._load_compiled_func('backprop')
+        if model._theano_backprop is None:
+            print('[model.build] request_backprop')
 
             fn_inputs = model._theano_fn_inputs
             X_batch, X_given = ut.take(fn_inputs, ['X_batch', 'X_given'])
@@ -1898,6 +2692,7 @@ class _ModelBackend(object):
                 mode=model._theano_mode,
                 name=':backprop',
             )
+            model._save_compiled_func('backprop', theano_backprop)
             model._theano_backprop = theano_backprop
         return model._theano_backprop
 
@@ -1906,6 +2701,9 @@ class _ModelBackend(object):
         if model._theano_exprs['fn_inputs'] is None:
             if isinstance(model, AbstractVectorVectorModel):
                 x_type = T.matrix
+            elif model._graph_prep_mode() is not None:
+                # Raw cv2 batches (b, h, w, c), see _get_network_input
+                x_type = T.TensorType('uint8', (False,) * 4)
             else:
                 x_type = T.tensor4
 
@@ -1976,6 +2774,31 @@ class _ModelBackend(object):
             >>> input2 = {X_in: Xb, y_in: yb}
             >>> _loss = loss.eval(input1)
             >>> _loss_item = loss_item.eval(input2)
+
+        Example:
+            >>> # DISABLE_DOCTEST
+            >>> from wbia_cnn.models.abstract_models import *  # NOQA
+            >>> from wbia_cnn.models.dummy import DummyModel
+            >>> import theano
+            >>> model = DummyModel(batch_size=8, autoinit=True)
+            >>> rng = np.random.RandomState(0)
+            >>> X = rng.rand(5, 1, 4, 4).astype(np.float32)
+            >>> y = np.array([0, 1, 2, 0, 1], dtype=np.int32)
+            >>> w = np.array([1, 2, 1, 1, 2], dtype=np.float32)
+            >>> # The final batch of a fixed size function is zero padded
+            >>> slice_kw = dict(batch_size=8, wraparound=True, pad_buffers={})
+            >>> Xp, yp, wp = model.slice_batch(X, y, w, batch_index=0, **slice_kw)
+            >>> fn_inputs = model._theano_fn_inputs
+            >>> X_in, y_in, w_in = ut.take(fn_inputs, ['X_batch', 'y_batch', 'w_batch'])
+            >>> loss_determ = model._theano_loss_exprs['loss_determ']
+            >>> givens = {fn_inputs['X_given']: X_in, fn_inputs['y_given']: y_in,
+            >>>           fn_inputs['w_given']: w_in}
+            >>> loss_fn = theano.function([X_in, y_in, w_in], loss_determ, givens=givens)
+            >>> loss_unpadded = loss_fn(X, y, w)
+            >>> loss_padded = loss_fn(Xp, yp, wp)
+            >>> assert np.isclose(loss_unpadded, loss_padded)
+            >>> print(Xp.shape, wp.tolist())
+            (8, 1, 4, 4) [1.0, 2.0, 1.0, 1.0, 2.0, 0.0, 0.0, 0.0]
         """
         if model._theano_exprs['loss'] is None:
             with warnings.catch_warnings():
@@ -1993,6 +2816,9 @@ class _ModelBackend(object):
 
                 # Loss of each example/item
                 # Record loss standard deviation over batch for diagnostics
+                # The weighted mean is normalized by the weight sum so the
+                # zero-weight items slice_batch pads onto the final batch do
+                # not dilute its loss
 
                 print('Building symbolic loss function')
                 loss_item = model.loss_function(netout_learn, y_batch)
@@ -2000,7 +2826,7 @@ class _ModelBackend(object):
                 # loss_std = loss_item.std()
                 # loss_std.name = 'loss_std'
                 loss = lasagne.objectives.aggregate(
-                    loss_item, weights=w_batch, mode='mean'
+                    loss_item, weights=w_batch, mode='normalized_sum'
                 )
                 loss.name = 'loss'
 
@@ -2010,7 +2836,7 @@ class _ModelBackend(object):
                 # loss_std_determ = loss_item_determ.std()
                 # loss_std_determ.name = 'loss_std_determ'
                 loss_determ = lasagne.objectives.aggregate(
-                    loss_item_determ, weights=w_batch, mode='mean'
+                    loss_item_determ, weights=w_batch, mode='normalized_sum'
                 )
                 loss_determ.name = 'loss_determ'
 
@@ -2061,12 +2887,64 @@ class _ModelBackend(object):
                 updates[param] = T.patternbroadcast(update, param.broadcastable)
         return updates
 
+    def _graph_prep_mode(model):
+        """
+        Returns None if batches are prepared on the host by _prepare_batch.
+        Otherwise returns 'scale' or 'whiten', the preprocessing that the
+        compiled functions apply to raw uint8 cv2 batches.
+        """
+        if not model._behavior.get('graph_prep', False):
+            return None
+        if isinstance(model, AbstractVectorVectorModel) or not model.X_is_cv2_native:
+            return None
+        return 'whiten' if model.hyperparams['whiten_on'] else 'scale'
+
+    def _get_graph_prep_shared(model):
+        """
+        Shared variables holding the whitening params used in the graph. Their
+        shapes are fixed when the graph is built.
+        """
+        if model._theano_exprs['prep_shared'] is None:
+            prep_shared = {}
+            for key in ['center_mean', 'center_std']:
+                value = np.asarray(model.data_params[key], dtype=np.float32)
+                broadcastable = tuple(dim == 1 for dim in value.shape)
+                prep_shared[key] = theano.shared(
+                    value, name=key, broadcastable=broadcastable
+                )
+            model._theano_exprs['prep_shared'] = prep_shared
+        return model._theano_exprs['prep_shared']
+
+    def _sync_graph_prep(model):
+        """ Copies the current data_params into the graph whitening params """
+        prep_shared = model._theano_exprs['prep_shared']
+        if prep_shared is not None:
+            for key, shared in prep_shared.items():
+                value = np.asarray(model.data_params[key], dtype=np.float32)
+                shared.set_value(value.reshape(shared.get_value().shape))
+
+    def _get_network_input(model):
+        """
+        Returns the expression fed to the input layer. With graph_prep the
+        uint8 (b, h, w, c) batch is converted to whitened float32 (b, c, h, w)
+        data here instead of in _prepare_batch.
+        """
+        X_batch = model._theano_fn_inputs['X_batch']
+        mode = model._graph_prep_mode()
+        if mode is None:
+            return X_batch
+        X_net = T.cast(X_batch, 'float32') * np.float32(1.0 / 255.0)
+        if mode == 'whiten':
+            prep_shared = model._get_graph_prep_shared()
+            X_net = (X_net - prep_shared['center_mean']) / prep_shared['center_std']
+        return X_net.dimshuffle(0, 3, 1, 2)
+
     def _get_network_output(model):
         """
         gets the activations of the output neurons
         """
         if model._theano_exprs['netout'] is None:
-            X_batch = model._theano_fn_inputs['X_batch']
+            X_batch = model._get_network_input()
 
             network_output_learn = lasagne.layers.get_output(model.output_layer, X_batch)
             network_output_learn.name = 'network_output_learn'
@@ -3260,6 +4138,16 @@ class _ModelIO(object):
         )
         return model_state_fpath
 
+    def get_model_weights_fpath(
+        model, fpath=None, dpath=None, fname=None, checkpoint_tag=None
+    ):
+        from wbia_cnn import weights_io
+
+        model_state_fpath = model.get_model_state_fpath(
+            fpath, dpath, fname, checkpoint_tag
+        )
+        return weights_io.get_weights_fpath(model_state_fpath)
+
     def checkpoint_save_model_state(model):
         fpath = model.get_model_state_fpath(checkpoint_tag=model.history.hist_id)
         ut.ensuredir(dirname(fpath))
@@ -3271,28 +4159,84 @@ class _ModelIO(object):
         ut.ensuredir(dirname(fpath))
         model.save_model_info(fpath=fpath)
 
+    def save_checkpoint(model, wait=False):
+        """
+        Saves the checkpoint state and info and the current state, info, and
+        weights. The model is snapshotted here and written on the checkpoint
+        writer thread unless the async_checkpoint behavior is off.
+        Checkpoint weights are stored once in <arch_dpath>/weight_blobs.
+
+        Args:
+            wait (bool): block until the checkpoint is on disk
+        """
+        from wbia_cnn import checkpoint_writer
+        from wbia_cnn import weights_io
+
+        checkpoint_tag = model.history.hist_id
+        model_state_fpath = model.get_model_state_fpath()
+        fpath_dict = {
+            'checkpoint_state': model.get_model_state_fpath(checkpoint_tag=checkpoint_tag),
+            'checkpoint_info': model.get_model_info_fpath(checkpoint_tag=checkpoint_tag),
+            'state': model_state_fpath,
+            'info': model.get_model_info_fpath(),
+            'weights': weights_io.get_weights_fpath(model_state_fpath),
+        }
+        store = checkpoint_writer.WeightBlobStore(join(model.arch_dpath, 'weight_blobs'))
+        snapshot = checkpoint_writer.snapshot_model(model)
+        if model._behavior.get('async_checkpoint', False):
+            writer = checkpoint_writer.get_writer()
+            writer.submit(checkpoint_writer.write_checkpoint, snapshot, fpath_dict, store)
+            if wait:
+                writer.flush()
+        else:
+            checkpoint_writer.write_checkpoint(snapshot, fpath_dict, store)
+        return fpath_dict['checkpoint_state']
+
     def save_model_state(model, **kwargs):
         """ saves current model state """
-        current_weights = model.get_all_param_values()
-        model_state = {
-            'best_results': model.best_results,
-            'data_params': model.data_params,
-            'current_weights': current_weights,
-            'encoder': getattr(model, 'encoder', None),
-            'input_shape': model.input_shape,
-            'data_shape': model.data_shape,
-            'batch_size': model.data_shape,
-            'output_dims': model.output_dims,
-            'era_history': model.history,
-            # 'arch_tag': model.arch_tag,
-        }
+        from wbia_cnn import checkpoint_writer
+        from wbia_cnn import weights_io
+
         model_state_fpath = model.get_model_state_fpath(**kwargs)
-        # print('saving model state to: %s' % (model_state_fpath,))
-        ut.save_cPkl(model_state_fpath, model_state, verbose=False)
+        snapshot = checkpoint_writer.snapshot_model(model)
+        checkpoint_writer.write_model_state(model_state_fpath, snapshot)
         print('saved model state to %r' % (model_state_fpath,))
-        # print('finished saving')
+        # Inference only needs the best weights, keep them next to the state
+        model_weights_fpath = weights_io.get_weights_fpath(model_state_fpath)
+        checkpoint_writer.write_model_weights(model_weights_fpath, snapshot)
+        print('saved model weights to %r' % (model_weights_fpath,))
         return model_state_fpath
 
+    def save_model_weights(model, **kwargs):
+        """
+        saves the best weights and the preprocessing parameters as an
+        inference-only weights artifact (see wbia_cnn.weights_io)
+        """
+        from wbia_cnn import weights_io
+
+        weights_list = model.best_results.get('weights', None)
+        if weights_list is None:
+            weights_list = model.get_all_param_values()
+        model_weights_fpath = model.get_model_weights_fpath(**kwargs)
+        weights_io.save_weights(
+            model_weights_fpath,
+            weights_list,
+            data_params=model.data_params,
+            encoder=getattr(model, 'encoder', None),
+            input_shape=model.input_shape,
+            output_dims=model.output_dims,
+            arch_hashid=model.get_arch_hashid(),
+            model_class=model.__class__.__name__,
+            data_shape=model.data_shape,
+            category_list=getattr(model, 'category_list', None),
+            best_results=ut.dict_subset(
+                model.best_results,
+                [key for key in model.best_results if key != 'weights'],
+            ),
+        )
+        print('saved model weights to %r' % (model_weights_fpath,))
+        return model_weights_fpath
+
     def save_model_info(model, **kwargs):
         """ save model information (history and results but no weights) """
         model_info = {
@@ -3301,10 +4245,12 @@ class _ModelIO(object):
             'output_dims': model.output_dims,
             'era_history': model.history,
         }
-        model_info_fpath = model.get_model_state_fpath(**kwargs)
-        # print('saving model info to: %s' % (model_info_fpath,))
-        ut.save_cPkl(model_info_fpath, model_info, verbose=False)
+        from wbia_cnn import checkpoint_writer
+
+        model_info_fpath = model.get_model_info_fpath(**kwargs)
+        checkpoint_writer.atomic_save_cPkl(model_info_fpath, model_info)
         print('saved model info')
+        return model_info_fpath
 
     def load_model_state(model, **kwargs):
         """
@@ -3321,9 +4267,13 @@ class _ModelIO(object):
             >>> model.init_arch()
             >>> model.load_model_state()
         """
+        from wbia_cnn import checkpoint_writer
+
         model_state_fpath = model.get_model_state_fpath(**kwargs)
         print('[model] loading model state from: %s' % (model_state_fpath,))
         model_state = ut.load_cPkl(model_state_fpath)
+        # Checkpoint states reference deduplicated weight blobs
+        checkpoint_writer.resolve_model_state(model_state, model_state_fpath)
         if model.__class__.__name__ != 'BaseModel':
             assert (
                 model_state['input_shape'][1:] == model.input_shape[1:]
@@ -3340,7 +4290,12 @@ class _ModelIO(object):
             # HACK TO LOAD ABSTRACT MODEL FOR DIAGNOSITIC REASONS
             print('WARNING LOADING ABSTRACT MODEL')
         model.best_results = model_state['best_results']
-        model.input_shape = model_state['input_shape']
+        input_shape = tuple(model_state['input_shape'])
+        if getattr(model, 'input_shape', None) is not None and model.input_shape[0] is None:
+            # Keep the symbolic batch dimension of this model, so one compiled
+            # function serves every batch size
+            input_shape = (None,) + input_shape[1:]
+        model.input_shape = input_shape
         model.output_dims = model_state['output_dims']
         model.encoder = model_state.get('encoder', None)
         if 'era_history' in model_state:
@@ -3356,11 +4311,58 @@ class _ModelIO(object):
             # model.output_layer is not None
             model.set_all_param_values(model.best_results['weights'])
 
+    def load_model_weights(model, mmap=True, **kwargs):
+        """
+        Loads an inference-only weights artifact. The weights are memory
+        mapped and copied directly into the network parameters. The training
+        history is not part of the artifact and is left untouched.
+
+        Example:
+            >>> # DISABLE_DOCTEST
+            >>> # Assumes mnist is trained
+            >>> from wbia_cnn.models.abstract_models import  *  # NOQA
+            >>> from wbia_cnn.models import mnist
+            >>> model, dataset = mnist.testdata_mnist()
+            >>> model.init_arch()
+            >>> model.load_model_weights()
+        """
+        from wbia_cnn import weights_io
+
+        model_weights_fpath = model.get_model_weights_fpath(**kwargs)
+        print('[model] loading model weights from: %s' % (model_weights_fpath,))
+        artifact = weights_io.load_weights(model_weights_fpath, mmap=mmap)
+        if artifact['input_shape'] is not None:
+            assert (
+                tuple(artifact['input_shape'][1:]) == tuple(model.input_shape[1:])
+            ), 'architecture disagreement'
+        if model.output_dims is None:
+            model.output_dims = artifact['output_dims']
+        assert artifact['output_dims'] == model.output_dims, 'architecture disagreement'
+        if model.output_layer is None:
+            model.init_arch()
+        arch_hashid = artifact['arch_hashid']
+        if arch_hashid is not None and arch_hashid != model.get_arch_hashid():
+            # set_all_param_values still checks the parameter shapes
+            print('[model] WARNING: weights were saved by arch %s' % (arch_hashid,))
+        model.data_params = artifact['data_params']
+        model._fix_center_mean_std()
+        model.encoder = artifact['encoder']
+        model.best_results = ut.dict_union(
+            artifact.get('best_results', {}), {'weights': artifact['weights']}
+        )
+        if artifact.get('category_list', None) is not None:
+            model.category_list = artifact['category_list']
+        model.set_all_param_values(artifact['weights'])
+        return artifact
+
     def load_extern_weights(model, **kwargs):
         """ load weights from another model """
+        from wbia_cnn import checkpoint_writer
+
         model_state_fpath = model.get_model_state_fpath(**kwargs)
         print('[model] loading extern weights from: %s' % (model_state_fpath,))
         model_state = ut.load_cPkl(model_state_fpath)
+        checkpoint_writer.resolve_model_state(model_state, model_state_fpath)
         if VERBOSE_CNN:
             print('External Model State:')
             print(ut.dict_str(model_state, truncate=True))
@@ -3382,7 +4384,10 @@ class _ModelIO(object):
             model.data_params = model_state['data_params']
 
         if 'era_history' in model_state:
-            model.history = History.from_oldstyle(model_state['era_history'])
+            try:
+                model.history = History.from_oldstyle(model_state['era_history'])
+            except TypeError:
+                model.history = model_state['era_history']
         else:
             model.history = History()
             model.history.__dict__.update(**model_state['history'])
@@ -3898,6 +4903,56 @@ def testdata_model_with_history():
     return model
 
 
+def benchmark_graph_prep(data_shape=(128, 128, 3), batch_size=128, num_batches=20):
+    """
+    Compares the host time spent preparing each batch with and without the
+    graph_prep behavior, and checks that both predict the same outputs.
+
+    CommandLine:
+        python -m wbia_cnn.models.abstract_models benchmark_graph_prep
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn.models.abstract_models import *  # NOQA
+        >>> result = benchmark_graph_prep(data_shape=(32, 32, 3), batch_size=32)
+        >>> print(ut.repr4(result, precision=4))
+    """
+    from wbia_cnn import models
+
+    num = batch_size * num_batches
+    result = ut.odict()
+    outputs = {}
+    weights_list = None
+    for graph_prep in [False, True]:
+        model = models.DummyModel(
+            batch_size=batch_size,
+            data_shape=data_shape,
+            whiten_on=True,
+            compile_cache=False,
+        )
+        model._behavior['graph_prep'] = graph_prep
+        X, y = model.make_random_testdata(num=num, cv2_format=True, asint=True)
+        model.ensure_data_params(X, y)
+        model.init_arch(verbose=False)
+        if weights_list is None:
+            weights_list = model.get_all_param_values()
+        model.set_all_param_values(weights_list)
+        X_, _, _, num_batches_, slice_kw, prep_kw = model._setup_batches(X)
+        with ut.Timer(verbose=False) as timer:
+            for batch_index in range(num_batches_):
+                Xb_, _, _ = model.slice_batch(
+                    X_, None, None, batch_index=batch_index, **slice_kw
+                )
+                model._prepare_batch(Xb_, None, None, **prep_kw)
+        key = 'graph' if graph_prep else 'host'
+        result[key + '_prep_ms_per_batch'] = 1000 * timer.ellapsed / num_batches_
+        with ut.Timer(verbose=False) as timer:
+            outputs[key] = model.predict_proba(X)
+        result[key + '_predict_s'] = timer.ellapsed
+    result['max_abs_diff'] = float(np.abs(outputs['host'] - outputs['graph']).max())
+    return result
+
+
 if __name__ == '__main__':
     """
     CommandLine:
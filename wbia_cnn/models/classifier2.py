@@ -8,7 +8,6 @@ from wbia_cnn import ingest_data
 from lasagne import init, layers, nonlinearities
 from theano import tensor as T  # NOQA
 from wbia_cnn.models import abstract_models, pretrained
-from os.path import exists
 
 print, rrr, profile = ut.inject2(__name__)
 
@@ -18,78 +17,14 @@ def augment_parallel(X, y):
 
 
 def augment_wrapper(Xb, yb=None):
-    import random
-    import cv2
-
-    for index in range(len(Xb)):
-        X = np.copy(Xb[index])
-        y = None if yb is None else yb[index]
-        # Adjust the exposure
-        X_Lab = cv2.cvtColor(X, cv2.COLOR_BGR2LAB)
-        X_L = X_Lab[:, :, 0].astype(dtype=np.float32)
-        # margin = np.min([np.min(X_L), 255.0 - np.max(X_L), 64.0])
-        margin = 64.0
-        exposure = random.uniform(-margin, margin)
-        X_L += exposure
-        X_L = np.around(X_L)
-        X_L[X_L < 0.0] = 0.0
-        X_L[X_L > 255.0] = 255.0
-        X_Lab[:, :, 0] = X_L.astype(dtype=X_Lab.dtype)
-        X = cv2.cvtColor(X_Lab, cv2.COLOR_LAB2BGR)
-        # Rotate, Scale, Skew
-        h, w, c = X.shape
-        degree = random.randint(-15, 15)
-        scale = random.uniform(0.90, 1.10)
-        skew_x = random.uniform(0.90, 1.10)
-        skew_y = random.uniform(0.90, 1.10)
-        skew_x_offset = abs(1.0 - skew_x)
-        skew_y_offset = abs(1.0 - skew_y)
-        skew_offset = np.sqrt(
-            skew_x_offset ** skew_x_offset + skew_y_offset ** skew_y_offset
-        )
-        skew_scale = 1.0 + skew_offset
-        padding = np.sqrt((w) ** 2 / 4 - 2 * (w) ** 2 / 16)
-        padding /= scale
-        padding *= skew_scale
-        padding = int(np.ceil(padding))
-        for channel in range(c):
-            X_ = X[:, :, channel]
-            X_ = np.pad(X_, padding, 'reflect', reflect_type='even')
-            h_, w_ = X_.shape
-            # Calculate Affine transform
-            center = (w_ // 2, h_ // 2)
-            A = cv2.getRotationMatrix2D(center, degree, scale)
-            # Add skew
-            A[0][0] *= skew_x
-            A[1][0] *= skew_x
-            A[0][1] *= skew_y
-            A[1][1] *= skew_y
-            # Apply Affine
-            X_ = cv2.warpAffine(X_, A, (w_, h_), flags=cv2.INTER_LANCZOS4, borderValue=0)
-            X_ = X_[padding : -1 * padding, padding : -1 * padding]
-            X[:, :, channel] = X_
-        # Horizontal flip
-        if random.uniform(0.0, 1.0) <= 0.5:
-            X = cv2.flip(X, 1)
-        # Blur
-        if random.uniform(0.0, 1.0) <= 0.01:
-            X = cv2.blur(X, (3, 3))
-        # Reshape
-        X = X.reshape(Xb[index].shape)
-        X = X.astype(Xb[index].dtype)
-        # Show image
-        canvas_filepath = '/home/jason/Desktop/temp-%s-%d.png' % (
-            y,
-            random.randint(0, 100),
-        )
-        if False and not exists(canvas_filepath):
-            canvas = np.hstack((Xb[index], X))
-            cv2.imwrite(canvas_filepath, canvas)
-        # Save
-        Xb[index] = X
-        if yb is not None:
-            yb[index] = y
-    return Xb, yb
+    from wbia_cnn import augment
+
+    return augment.augment_exposure_affine(
+        Xb,
+        yb,
+        exposure_margin=64.0,
+        blur_prob=0.01,
+    )
 
 
 @six.add_metaclass(ut.ReloadingMetaclass)
@@ -109,7 +44,10 @@ class Classifier2Model(abstract_models.AbstractVectorModel):
     def augment(model, Xb, yb=None, parallel=True):
         if not parallel:
             return augment_wrapper(Xb, yb)
-        # Run in parallel
+        # Run in parallel, augmenting in place in shared memory
+        result = model._shared_augment(augment_wrapper, Xb, yb)
+        if result is not None:
+            return result
         if yb is None:
             yb = [None] * len(Xb)
         arg_iter = list(zip(Xb, yb))
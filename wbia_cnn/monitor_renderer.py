@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Off-thread rendering of the per-epoch monitor figures.
+
+With monitoring on, _ModelFitter.fit renders the loss, precision / recall,
+and learning rate figures and saves them as PNGs after every epoch. For short
+epochs of small models the matplotlib rendering takes longer than the epoch.
+
+The MonitorRenderer forks a process that holds a copy of the model. After
+each epoch the trainer queues a frame of the History. While the history is
+appended to its log (see wbia_cnn.history_log) a frame is only a
+HistoryLogRef, and the process catches up by reading the new lines of the
+log; otherwise the History is pickled on the training thread, which keeps
+later epochs out of the frame. The process always renders the newest queued
+frame and drops the stale ones, so it coalesces when it falls behind and the
+trainer never waits on it.
+
+The figures are the same ones _ModelFitter._render_epoch_monitor draws in
+process when the async_monitor behavior is off (``--no-async-monitor``) or
+fork is unavailable.
+
+CommandLine:
+    python -m wbia_cnn.monitor_renderer --allexamples
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import utool as ut
+from six.moves import cPickle as pickle
+from six.moves import queue
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+def _latest_frame(frame_queue):
+    """
+    Blocks for the next frame and then drains the queue.
+
+    Returns:
+        tuple: (frame, num_skipped, done) where frame is the newest frame
+            (or None) and done is True once the trainer closed
+    """
+    frame = frame_queue.get()
+    if frame is None:
+        return None, 0, True
+    num_skipped = 0
+    while True:
+        try:
+            next_frame = frame_queue.get_nowait()
+        except queue.Empty:
+            return frame, num_skipped, False
+        if next_frame is None:
+            return frame, num_skipped, True
+        frame = next_frame
+        num_skipped += 1
+
+
+def _load_frame(frame, reader_dict):
+    """ Returns the History of a ('log', HistoryLogRef) or ('pickle', bytes) frame """
+    from wbia_cnn import history_log
+
+    kind, value = frame
+    if kind == 'pickle':
+        return pickle.loads(value)
+    reader = reader_dict.get(value.fpath, None)
+    if reader is None or reader.offset > value.nbytes:
+        reader = reader_dict[value.fpath] = history_log.LogReader(value.fpath)
+    return reader.read(value.nbytes)
+
+
+def _renderer_main(model, frame_queue, render_func):
+    try:
+        # The GUI backend of the parent does not survive the fork
+        import matplotlib.pyplot as plt
+
+        plt.switch_backend('agg')
+    except Exception:
+        pass
+    num_skipped = 0
+    reader_dict = {}
+    while True:
+        frame, skipped, done = _latest_frame(frame_queue)
+        num_skipped += skipped
+        if frame is not None:
+            try:
+                model.history = _load_frame(frame, reader_dict)
+                render_func(model)
+            except Exception as ex:
+                ut.printex(ex, '[monitor] failed to render epoch figures', iswarning=True)
+        if done:
+            if num_skipped > 0:
+                print('[monitor] skipped %d stale frames' % (num_skipped,))
+            return
+
+
+def _render_epoch_monitor(model):
+    model._render_epoch_monitor()
+
+
+@ut.reloadable_class
+class MonitorRenderer(ut.NiceRepr):
+    """
+    Renders epoch monitor figures of a model in a forked process.
+
+    Args:
+        model (BaseModel): model in a fit session
+        render_func (func): renders the figures of a model whose history was
+            replaced by a frame (defaults to model._render_epoch_monitor)
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.monitor_renderer import *  # NOQA
+        >>> import time
+        >>> from os.path import join
+        >>> dpath = ut.ensure_app_resource_dir('wbia_cnn', 'test_monitor_renderer')
+        >>> class Dummy(object):
+        >>>     history = []
+        >>> def render_func(model):
+        >>>     time.sleep(0.05)
+        >>>     ut.write_to(join(dpath, 'frame.txt'), str(model.history[-1]))
+        >>> model = Dummy()
+        >>> renderer = MonitorRenderer(model, render_func=render_func)
+        >>> for epoch in range(20):
+        >>>     model.history.append(epoch)
+        >>>     renderer.submit(model)
+        >>> renderer.close()
+        >>> print(ut.read_from(join(dpath, 'frame.txt')))
+        19
+    """
+
+    def __init__(renderer, model, render_func=None):
+        import multiprocessing
+
+        if render_func is None:
+            render_func = _render_epoch_monitor
+        ctx = multiprocessing.get_context('fork')
+        renderer._queue = ctx.Queue()
+        renderer.num_submitted = 0
+        renderer._proc = ctx.Process(
+            target=_renderer_main, args=(model, renderer._queue, render_func)
+        )
+        renderer._proc.daemon = True
+        renderer._proc.start()
+
+    def __nice__(renderer):
+        return 'pid=%r, submitted=%d' % (renderer._proc.pid, renderer.num_submitted)
+
+    def is_alive(renderer):
+        return renderer._proc.is_alive()
+
+    def submit(renderer, model):
+        """ Queues a frame of the current history. Never blocks. """
+        history_ref = None
+        if hasattr(model.history, 'log_ref'):
+            history_ref = model.history.log_ref()
+        if history_ref is not None:
+            frame = ('log', history_ref)
+        else:
+            frame = ('pickle', pickle.dumps(model.history, protocol=2))
+        renderer._queue.put(frame)
+        renderer.num_submitted += 1
+
+    def close(renderer, timeout=None):
+        """
+        Renders the newest queued frame and stops the process. It is
+        terminated if it does not finish within timeout seconds.
+        """
+        if renderer._proc.is_alive():
+            renderer._queue.put(None)
+            renderer._proc.join(timeout)
+            if renderer._proc.is_alive():
+                renderer._proc.terminate()
+                renderer._proc.join()
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.monitor_renderer
+        python -m wbia_cnn.monitor_renderer --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
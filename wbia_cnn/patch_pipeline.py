@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined extraction of patch descriptors (e.g. siam128) from chips.
+
+The serial extractor handled one chunk of chips at a time: read keypoints and
+chips, warp the patches of every chip in Python, stack them with np.array, copy
+them again with a transpose, and only then run the network. Every stage waited
+on the one before it.
+
+PatchDescriptorPipeline runs three overlapping stages:
+
+    * the caller's thread reads chips / keypoints (so non thread-safe readers,
+      like the sqlite backed controllers, stay on the thread that owns them)
+      and submits each chip to a pool of warp worker processes.
+    * the warp workers extract the patches of one chip each.
+    * an inference thread copies the warped patches of each chip directly into
+      a preallocated batch buffer that is already in network layout,
+      normalizes the buffer in place, and runs the predict function whenever
+      the buffer is full.
+
+Descriptors are streamed back per chip, in input order, as soon as the last
+batch holding one of its patches is done.
+
+CommandLine:
+    python -m wbia_cnn.patch_pipeline --allexamples
+    python -m wbia_cnn.patch_pipeline --exec-benchmark_patch_pipeline --num-chips=64
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import sys
+import time
+import threading
+import collections
+import multiprocessing
+import six
+import numpy as np
+import utool as ut
+from six.moves import queue
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+def _warp_chip_patches(chip, kpts, patch_size, colorspace=None):
+    """ Warp worker. Returns the uint8 patches of a chip stacked in one array """
+    import vtool as vt
+
+    if colorspace is not None:
+        chip = vt.convert_image_list_colorspace([chip], colorspace)[0]
+    if len(kpts) == 0:
+        return np.empty((0, patch_size, patch_size) + chip.shape[2:], dtype=chip.dtype)
+    patch_list = vt.get_warped_patches(chip, kpts, patch_size=patch_size)[0]
+    return np.asarray(patch_list)
+
+
+class _StoredWarp(object):
+    """
+    Patches of a chip that were partially found in a PatchStore. The missing
+    ones are warped by a worker and stored once they are needed.
+    """
+
+    def __init__(self, store, miss_keys, patches, ismiss, warped):
+        self.store = store
+        self.miss_keys = miss_keys
+        self.patches = patches
+        self.ismiss = ismiss
+        self.warped = warped
+
+    def result(self):
+        warped = self.warped
+        miss_patches = warped if isinstance(warped, np.ndarray) else warped.result()
+        self.patches[self.ismiss] = miss_patches
+        self.store.add(self.miss_keys, miss_patches)
+        return self.patches
+
+
+def get_input_transform(model):
+    """
+    Returns the scale, mean, and std that _ModelBatch._prepare_batch applies to
+    integer inputs, with mean and std in network layout (c, h, w).
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.patch_pipeline import *  # NOQA
+        >>> from wbia_cnn import models
+        >>> model = models.DummyModel(batch_size=16)
+        >>> X, y = model.make_random_testdata(num=37, cv2_format=True, asint=True)
+        >>> model.ensure_data_params(X, y)
+        >>> scale, mean, std = get_input_transform(model)
+        >>> Xb = X[0:16].transpose((0, 3, 1, 2)).astype(np.float32)
+        >>> Xb = (Xb * scale - mean) / std
+        >>> assert np.allclose(Xb, model.prepare_data(X[0:16]))
+    """
+    scale, mean, std = 1.0 / 255.0, 0.0, 1.0
+    if model.hyperparams['whiten_on']:
+        mean = np.asarray(model.data_params['center_mean'], dtype=np.float32)
+        std = np.asarray(model.data_params['center_std'], dtype=np.float32)
+        if model.X_is_cv2_native:
+            if mean.ndim == 3:
+                mean = mean.transpose((2, 0, 1))
+            if std.ndim == 3:
+                std = std.transpose((2, 0, 1))
+    return scale, mean, std
+
+
+@ut.reloadable_class
+class PatchDescriptorPipeline(ut.NiceRepr):
+    """
+    Overlaps chip reading, patch warping, and network inference.
+
+    Args:
+        model (BaseModel): initialized model with loaded weights. Its predict
+            function maps a patch to a descriptor.
+        patch_size (int): defaults to the model input size
+        colorspace (str): colorspace the chips are converted to by the warp
+            workers (e.g. 'gray'). None keeps the chips as they are.
+        num_workers (int): number of warp processes. 0 warps in the caller's
+            thread.
+        max_pending (int): maximum number of chips that are read but not yet
+            fed to the network (defaults to 4 * num_workers)
+        patch_store (PatchStore): if given, patches are looked up by a hash
+            of the chip pixels and only the missing ones are warped
+
+    Attributes:
+        num_chips (int): chips yielded so far
+        num_feats (int): descriptors computed so far
+        predict_time (float): time spent in the predict function
+        warp_wait_time (float): time the inference thread waited on warping
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.patch_pipeline import *  # NOQA
+        >>> from wbia_cnn import models
+        >>> model = models.DummyModel(batch_size=16, data_shape=(4, 4, 1))
+        >>> X, y = model.make_random_testdata(num=37, cv2_format=True, asint=True)
+        >>> model.init_arch()
+        >>> model.ensure_data_params(X, y)
+        >>> pipeline = PatchDescriptorPipeline(model, num_workers=0)
+        >>> # Feed precomputed patches to bypass the warping
+        >>> pipeline._warp_func = lambda chip, kpts, size, colorspace: chip[kpts, :, :, 0]
+        >>> item_list = [('a', X, np.arange(10)), ('b', X, np.arange(0)),
+        >>>              ('c', X, np.arange(10, 37))]
+        >>> result_list = list(pipeline.extract(item_list))
+        >>> assert [key for key, kpts, vecs in result_list] == ['a', 'b', 'c']
+        >>> vecs = np.vstack([vecs for key, kpts, vecs in result_list])
+        >>> assert np.allclose(vecs, model.predict_proba(X), atol=1e-5)
+    """
+
+    def __init__(
+        pipeline,
+        model,
+        patch_size=None,
+        colorspace=None,
+        num_workers=None,
+        max_pending=None,
+        patch_store=None,
+    ):
+        if patch_size is None:
+            patch_size = model.input_shape[-1]
+        if num_workers is None:
+            num_workers = ut.get_argval(
+                '--warp-workers', type_=int, default=multiprocessing.cpu_count()
+            )
+        if max_pending is None:
+            max_pending = 4 * max(1, num_workers)
+        pipeline.model = model
+        pipeline.patch_size = patch_size
+        pipeline.colorspace = colorspace
+        pipeline.num_workers = num_workers
+        pipeline.max_pending = max_pending
+        pipeline.patch_store = patch_store
+        pipeline._warp_func = _warp_chip_patches
+        pipeline.num_chips = 0
+        pipeline.num_feats = 0
+        pipeline.predict_time = 0.0
+        pipeline.warp_wait_time = 0.0
+
+    def __nice__(pipeline):
+        return 'patch_size=%d, %d workers' % (pipeline.patch_size, pipeline.num_workers)
+
+    def timing_str(pipeline):
+        return 'chips=%d, feats=%d, predict=%.2fs, warp wait=%.2fs' % (
+            pipeline.num_chips,
+            pipeline.num_feats,
+            pipeline.predict_time,
+            pipeline.warp_wait_time,
+        )
+
+    def extract(pipeline, item_iter):
+        """
+        Args:
+            item_iter (iterable): lazily yields (key, chip, kpts) tuples. It is
+                consumed in the caller's thread.
+
+        Yields:
+            tuple: (key, kpts, vecs) in input order
+        """
+        from concurrent import futures
+
+        in_queue = queue.Queue(maxsize=pipeline.max_pending)
+        out_queue = queue.Queue()
+        stop_event = threading.Event()
+        executor = None
+        if pipeline.num_workers > 0:
+            executor = futures.ProcessPoolExecutor(pipeline.num_workers)
+        thread = threading.Thread(
+            target=pipeline._inference_loop, args=(in_queue, out_queue, stop_event)
+        )
+        thread.daemon = True
+        thread.start()
+        try:
+            for key, chip, kpts in item_iter:
+                if pipeline.patch_store is None:
+                    warped = pipeline._submit_warp(executor, chip, kpts)
+                else:
+                    warped = pipeline._lookup_patches(executor, chip, kpts)
+                item = (key, kpts, warped)
+                # Blocks while max_pending chips are in flight
+                for result in pipeline._put(in_queue, out_queue, thread, item):
+                    yield result
+                for result in pipeline._drain(out_queue, block=False):
+                    yield result
+            for result in pipeline._put(in_queue, out_queue, thread, None):
+                yield result
+            for result in pipeline._drain(out_queue, block=True):
+                yield result
+        finally:
+            if thread.is_alive():
+                # The consumer stopped early or something failed
+                stop_event.set()
+                try:
+                    while True:
+                        in_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                in_queue.put(None)
+                thread.join()
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def _submit_warp(pipeline, executor, chip, kpts):
+        args = (chip, kpts, pipeline.patch_size, pipeline.colorspace)
+        if executor is None:
+            return pipeline._warp_func(*args)
+        return executor.submit(pipeline._warp_func, *args)
+
+    def _lookup_patches(pipeline, executor, chip, kpts):
+        from wbia_cnn import patch_store
+
+        store = pipeline.patch_store
+        patch_size, colorspace = pipeline.patch_size, pipeline.colorspace
+        chip_key = patch_store.chip_content_key(chip)
+        key_list = patch_store.make_patch_keys(chip_key, kpts, patch_size, colorspace)
+        patch_shape = patch_store.get_patch_shape(patch_size, colorspace, chip)
+        patches, ismiss = store.lookup(key_list, patch_shape)
+        if not np.any(ismiss):
+            return patches
+        kpts_miss = np.asarray(kpts).compress(ismiss, axis=0)
+        warped = pipeline._submit_warp(executor, chip, kpts_miss)
+        miss_keys = ut.compress(key_list, ismiss)
+        return _StoredWarp(store, miss_keys, patches, ismiss, warped)
+
+    def _put(pipeline, in_queue, out_queue, thread, item, timeout=0.1):
+        """
+        Puts item on the bounded in_queue. While it is full, yields finished
+        results and re-raises an error of the inference thread, which stops
+        reading in_queue when it fails.
+        """
+        while True:
+            try:
+                in_queue.put(item, timeout=timeout)
+                return
+            except queue.Full:
+                pass
+            for result in pipeline._drain(out_queue, block=False):
+                yield result
+            if not thread.is_alive():
+                for result in pipeline._drain(out_queue, block=False):
+                    yield result
+                raise RuntimeError('the inference thread stopped unexpectedly')
+
+    def _drain(pipeline, out_queue, block):
+        while True:
+            try:
+                kind, value = out_queue.get(block=block)
+            except queue.Empty:
+                return
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                six.reraise(*value)
+            pipeline.num_chips += 1
+            pipeline.num_feats += len(value[1])
+            yield value
+
+    def _inference_loop(pipeline, in_queue, out_queue, stop_event):
+        try:
+            pipeline._run_inference(in_queue, out_queue, stop_event)
+            out_queue.put(('done', None))
+        except Exception:
+            out_queue.put(('error', sys.exc_info()))
+
+    def _run_inference(pipeline, in_queue, out_queue, stop_event):
+        model = pipeline.model
+        batch_size = model.batch_size
+        fixed_batch = model.input_shape[0] is not None
+        scale, mean, std = get_input_transform(model)
+        graph_prep = model._graph_prep_mode() is not None
+        if graph_prep:
+            # The predict function normalizes raw (b, h, w, c) uint8 batches
+            model._sync_graph_prep()
+            chw = tuple(model.input_shape[1:])
+            buf = np.empty((batch_size,) + chw[1:] + chw[0:1], dtype=np.uint8)
+        else:
+            # Batch buffer in network layout, reused for every batch
+            buf = np.empty((batch_size,) + tuple(model.input_shape[1:]), dtype=np.float32)
+        # Chips that are not finished yet, in input order
+        chip_queue = collections.deque()
+        # (chip, start in chip, start in buffer, count) of the current batch
+        owners = []
+        num_filled = 0
+
+        def _flush():
+            Xb = buf if fixed_batch else buf[:num_filled]
+            if not graph_prep:
+                np.multiply(Xb, scale, out=Xb)
+                np.subtract(Xb, mean, out=Xb)
+                np.divide(Xb, std, out=Xb)
+            start = time.time()
+            outputs = model.predict_proba_Xb(Xb)
+            pipeline.predict_time += time.time() - start
+            for chip, chip_start, buf_start, count in owners:
+                if chip['vecs'] is None:
+                    shape = (len(chip['kpts']),) + outputs.shape[1:]
+                    chip['vecs'] = np.empty(shape, dtype=outputs.dtype)
+                chip['vecs'][chip_start : chip_start + count] = outputs[
+                    buf_start : buf_start + count
+                ]
+                chip['num_done'] += count
+            del owners[:]
+
+        def _emit(output_shape):
+            while len(chip_queue) > 0:
+                chip = chip_queue[0]
+                if chip['num_done'] < len(chip['kpts']):
+                    break
+                chip_queue.popleft()
+                if chip['vecs'] is None:
+                    chip['vecs'] = np.empty((0,) + output_shape, dtype=np.float32)
+                out_queue.put(('result', (chip['key'], chip['kpts'], chip['vecs'])))
+
+        output_shape = None
+        while True:
+            item = in_queue.get()
+            if item is None or stop_event.is_set():
+                break
+            key, kpts, warped = item
+            start = time.time()
+            patches = warped if isinstance(warped, np.ndarray) else warped.result()
+            pipeline.warp_wait_time += time.time() - start
+            chip = {'key': key, 'kpts': kpts, 'vecs': None, 'num_done': 0}
+            chip_queue.append(chip)
+            num_patches = len(patches)
+            chip_start = 0
+            while chip_start < num_patches:
+                count = min(num_patches - chip_start, batch_size - num_filled)
+                dst = buf[num_filled : num_filled + count]
+                src = patches[chip_start : chip_start + count]
+                if graph_prep:
+                    dst[...] = src.reshape(dst.shape)
+                elif src.ndim == 3:
+                    dst[:, 0] = src
+                else:
+                    dst[...] = src.transpose((0, 3, 1, 2))
+                owners.append((chip, chip_start, num_filled, count))
+                chip_start += count
+                num_filled += count
+                if num_filled == batch_size:
+                    _flush()
+                    num_filled = 0
+                    output_shape = chip['vecs'].shape[1:]
+            if output_shape is not None:
+                _emit(output_shape)
+        if stop_event.is_set():
+            return
+        if num_filled > 0:
+            _flush()
+            num_filled = 0
+        if output_shape is None:
+            # Only happens if all chips fit in one batch (or had no patches)
+            if len(chip_queue) > 0 and chip_queue[-1]['vecs'] is not None:
+                output_shape = chip_queue[-1]['vecs'].shape[1:]
+            else:
+                output_shape = tuple(model.output_layer.output_shape[1:])
+        _emit(output_shape)
+
+
+def extract_patch_descriptors_serial(
+    model, chip_list, kpts_list, patch_size=None, colorspace=None
+):
+    """
+    Reference implementation: warps every chip, stacks the patches, and runs
+    the network once.
+    """
+    if patch_size is None:
+        patch_size = model.input_shape[-1]
+    warped_patches_list = [
+        _warp_chip_patches(chip, kpts, patch_size, colorspace)
+        for chip, kpts in zip(chip_list, kpts_list)
+    ]
+    flat_list, cumlen_list = ut.invertible_flatten2(warped_patches_list)
+    stacked_patches = np.transpose(np.array(flat_list)[None, :], (1, 2, 3, 0))
+    vecs = model.predict_proba(stacked_patches)
+    return ut.unflatten2(vecs, cumlen_list)
+
+
+def make_synthetic_chips(num_chips=32, num_kpts=500, chip_shape=(300, 400), seed=0):
+    """
+    Random grayscale chips with random keypoints in (x, y, a, c, d, ori) format
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.patch_pipeline import *  # NOQA
+        >>> chip_list, kpts_list = make_synthetic_chips(3, 10, (30, 40))
+        >>> print(ut.repr2([chip_list[0].shape, kpts_list[0].shape]))
+        [(30, 40), (10, 6)]
+    """
+    rng = np.random.RandomState(seed)
+    h, w = chip_shape
+    chip_list = []
+    kpts_list = []
+    for _ in range(num_chips):
+        chip = rng.randint(0, 256, size=chip_shape).astype(np.uint8)
+        num = rng.randint(num_kpts // 2, num_kpts + 1)
+        kpts = np.zeros((num, 6), dtype=np.float32)
+        kpts[:, 0] = rng.uniform(0, w, size=num)
+        kpts[:, 1] = rng.uniform(0, h, size=num)
+        kpts[:, 2] = rng.uniform(3, 20, size=num)
+        kpts[:, 3] = rng.uniform(-2, 2, size=num)
+        kpts[:, 4] = rng.uniform(3, 20, size=num)
+        kpts[:, 5] = rng.uniform(0, 2 * np.pi, size=num)
+        chip_list.append(chip)
+        kpts_list.append(kpts)
+    return chip_list, kpts_list
+
+
+def benchmark_patch_pipeline(model=None, num_chips=32, num_kpts=500, num_workers=None):
+    """
+    Reports features / second of the serial and the pipelined extractors on a
+    synthetic chip set.
+
+    CommandLine:
+        python -m wbia_cnn.patch_pipeline --exec-benchmark_patch_pipeline
+        python -m wbia_cnn.patch_pipeline --exec-benchmark_patch_pipeline --num-chips=128 --warp-workers=8
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn.patch_pipeline import *  # NOQA
+        >>> num_chips = ut.get_argval('--num-chips', type_=int, default=32)
+        >>> rates = benchmark_patch_pipeline(num_chips=num_chips)
+        >>> print(ut.repr2(rates, precision=1))
+    """
+    if model is None:
+        from wbia_cnn import _plugin
+
+        model = _plugin.get_siam_l2_model()
+    chip_list, kpts_list = make_synthetic_chips(num_chips, num_kpts)
+    num_feats = sum(map(len, kpts_list))
+    # Compile outside of the timings
+    model.build_predict_func()
+
+    with ut.Timer('serial', verbose=False) as t_serial:
+        serial_vecs_list = extract_patch_descriptors_serial(model, chip_list, kpts_list)
+    pipeline = PatchDescriptorPipeline(model, num_workers=num_workers)
+    item_iter = zip(range(num_chips), chip_list, kpts_list)
+    with ut.Timer('pipelined', verbose=False) as t_pipe:
+        result_list = list(pipeline.extract(item_iter))
+    for (key, kpts, vecs), vecs_ in zip(result_list, serial_vecs_list):
+        assert np.allclose(vecs, vecs_, atol=1e-4), 'pipeline disagrees with serial'
+    rates = ut.odict(
+        [
+            ('num_feats', num_feats),
+            ('serial_feats_per_sec', num_feats / t_serial.ellapsed),
+            ('pipelined_feats_per_sec', num_feats / t_pipe.ellapsed),
+        ]
+    )
+    print('[patch_pipeline] %s' % (pipeline.timing_str(),))
+    print('[patch_pipeline] %s' % (ut.repr2(rates, precision=1),))
+    return rates
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.patch_pipeline
+        python -m wbia_cnn.patch_pipeline --allexamples
+    """
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
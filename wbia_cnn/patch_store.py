@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent, content-addressed store of warped keypoint patches.
+
+Building a patch-match dataset warps the patch of every matched keypoint. The
+patches used to be cached in memory for the duration of a single build, so
+rebuilding a dataset (e.g. with different pair filters) warped all of them
+again.
+
+PatchStore keeps the patches on disk in an sqlite database. A patch is
+addressed by a hash of the chip it comes from (its UUID or a hash of its
+pixels), the keypoint, the patch size, and the colorspace, so any caller that
+warps the same keypoint of the same chip shares the entry. Lookups are batched
+and return one contiguous uint8 array. The store is bounded by a byte budget
+and evicts the least recently used patches when it grows past it.
+
+CommandLine:
+    python -m wbia_cnn.patch_store --allexamples
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+import utool as ut
+from os.path import join
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+# Maximum number of keys in one sqlite query
+_QUERY_CHUNKSIZE = 500
+
+
+def chip_content_key(chip):
+    """
+    Identifies a chip that has no UUID by hashing its pixels
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.patch_store import *  # NOQA
+        >>> chip = np.zeros((4, 5), dtype=np.uint8)
+        >>> assert chip_content_key(chip) == chip_content_key(chip.copy())
+        >>> assert chip_content_key(chip) != chip_content_key(chip.reshape(5, 4))
+    """
+    chip = np.ascontiguousarray(chip)
+    hasher = hashlib.sha1(('%r|%s|' % (chip.shape, chip.dtype.str)).encode('utf8'))
+    hasher.update(chip.data)
+    return hasher.hexdigest()
+
+
+def get_patch_shape(patch_size, colorspace, chip=None):
+    """
+    Shape of one patch warped from a chip in the given colorspace. Without a
+    chip, colorspaces other than gray are assumed to have 3 channels.
+    """
+    if colorspace == 'gray':
+        return (patch_size, patch_size)
+    if chip is None:
+        return (patch_size, patch_size, 3)
+    return (patch_size, patch_size) + chip.shape[2:]
+
+
+def make_patch_keys(chip_key, kpts, patch_size, colorspace=None):
+    """
+    Returns the store key of the patch of each keypoint
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.patch_store import *  # NOQA
+        >>> kpts = np.array([[1, 2, 3, 0, 3, 0], [1, 2, 3, 0, 3, 0], [5, 2, 3, 0, 3, 0]])
+        >>> key_list = make_patch_keys('chip', kpts, 32, 'gray')
+        >>> assert key_list[0] == key_list[1] != key_list[2]
+        >>> assert key_list[0] != make_patch_keys('chip', kpts, 64, 'gray')[0]
+    """
+    prefix = '%s|%d|%s|' % (chip_key, patch_size, colorspace)
+    base = hashlib.sha1(prefix.encode('utf8'))
+    kpts_ = np.ascontiguousarray(kpts, dtype=np.float32)
+    key_list = []
+    for kpt in kpts_:
+        hasher = base.copy()
+        hasher.update(kpt.tobytes())
+        key_list.append(hasher.digest())
+    return key_list
+
+
+@ut.reloadable_class
+class PatchStore(ut.NiceRepr):
+    """
+    On-disk LRU store of uint8 patches.
+
+    Args:
+        dpath (str): directory of the store database
+        budget_mb (float): size the store is kept under
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.patch_store import *  # NOQA
+        >>> dpath = ut.ensure_app_resource_dir('wbia_cnn', 'test_patch_store')
+        >>> ut.delete(join(dpath, 'patches.sqlite3'), verbose=False)
+        >>> store = PatchStore(dpath, budget_mb=10 * 16 / 2.0 ** 20)
+        >>> patches = np.arange(12 * 16, dtype=np.uint8).reshape(12, 4, 4)
+        >>> key_list = make_patch_keys('chip', np.random.rand(12, 6), 4)
+        >>> store.add(key_list[0:6], patches[0:6])
+        >>> found, ismiss = store.lookup(key_list[0:3], (4, 4))
+        >>> store.add(key_list[6:12], patches[6:12])
+        >>> found, ismiss = store.lookup(key_list, (4, 4))
+        >>> assert np.all(found[~ismiss] == patches[~ismiss])
+        >>> # The least recently used patches were evicted
+        >>> print(ismiss.astype(int).tolist())
+        [0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0, 0]
+        >>> store.close()
+    """
+
+    def __init__(store, dpath=None, budget_mb=None):
+        if dpath is None:
+            dpath = ut.get_argval('--patch-store-dir', type_=str, default=None)
+            if dpath is None:
+                dpath = ut.ensure_app_cache_dir('wbia_cnn', 'patch_store')
+        if budget_mb is None:
+            budget_mb = ut.get_argval('--patch-store-mb', type_=float, default=4096.0)
+        store.dpath = ut.ensuredir(dpath)
+        store.fpath = join(store.dpath, 'patches.sqlite3')
+        store.budget_mb = budget_mb
+        store.num_hits = 0
+        store.num_misses = 0
+        store.num_evictions = 0
+        store._lock = threading.RLock()
+        # The pipeline may add patches from its inference thread
+        store._conn = sqlite3.connect(store.fpath, check_same_thread=False)
+        store._conn.execute('PRAGMA journal_mode=WAL')
+        store._conn.execute('PRAGMA synchronous=NORMAL')
+        store._conn.execute(
+            'CREATE TABLE IF NOT EXISTS patches ('
+            ' key BLOB PRIMARY KEY, data BLOB NOT NULL,'
+            ' nbytes INTEGER NOT NULL, atime INTEGER NOT NULL)'
+        )
+        store._conn.execute(
+            'CREATE INDEX IF NOT EXISTS patches_atime ON patches (atime)'
+        )
+        store._conn.commit()
+        clock, total = store._conn.execute(
+            'SELECT COALESCE(MAX(atime), 0), COALESCE(SUM(nbytes), 0) FROM patches'
+        ).fetchone()
+        store._clock = clock
+        store._total_nbytes = total
+
+    def __nice__(store):
+        return '%.1f/%.1fMB, %s' % (
+            store._total_nbytes / 2.0 ** 20,
+            store.budget_mb,
+            store.fpath,
+        )
+
+    def _tick(store):
+        store._clock += 1
+        return store._clock
+
+    def lookup(store, key_list, patch_shape):
+        """
+        Args:
+            key_list (list): patch keys (see make_patch_keys)
+            patch_shape (tuple): shape of one patch
+
+        Returns:
+            tuple: (patches, ismiss) where patches is a contiguous uint8 array
+                of shape (len(key_list),) + patch_shape. Missing rows are
+                zero and flagged in the boolean array ismiss.
+        """
+        num = len(key_list)
+        patches = np.zeros((num,) + tuple(patch_shape), dtype=np.uint8)
+        ismiss = np.ones(num, dtype=np.bool_)
+        index_dict = ut.ddict(list)
+        for index, key in enumerate(key_list):
+            index_dict[key].append(index)
+        unique_keys = list(index_dict.keys())
+        nbytes = int(np.prod(patch_shape))
+        with store._lock:
+            atime = store._tick()
+            for key_chunk in ut.ichunks(unique_keys, _QUERY_CHUNKSIZE):
+                marks = ','.join('?' * len(key_chunk))
+                rows = store._conn.execute(
+                    'SELECT key, data FROM patches WHERE key IN (%s)' % (marks,),
+                    key_chunk,
+                ).fetchall()
+                hit_keys = []
+                for key, data in rows:
+                    if len(data) != nbytes:
+                        # Same key with a different shape is treated as a miss
+                        continue
+                    patch = np.frombuffer(data, dtype=np.uint8).reshape(patch_shape)
+                    indices = index_dict[bytes(key)]
+                    patches[indices] = patch
+                    ismiss[indices] = False
+                    hit_keys.append(key)
+                if hit_keys:
+                    marks = ','.join('?' * len(hit_keys))
+                    store._conn.execute(
+                        'UPDATE patches SET atime=? WHERE key IN (%s)' % (marks,),
+                        [atime] + hit_keys,
+                    )
+            store._conn.commit()
+        num_misses = int(ismiss.sum())
+        store.num_misses += num_misses
+        store.num_hits += num - num_misses
+        return patches, ismiss
+
+    def add(store, key_list, patches):
+        """ Stores patches (an array or a list of uint8 arrays) """
+        if len(key_list) == 0:
+            return
+        row_list = []
+        with store._lock:
+            atime = store._tick()
+            for key, patch in zip(key_list, patches):
+                data = np.ascontiguousarray(patch, dtype=np.uint8).tobytes()
+                row_list.append((key, data, len(data), atime))
+            old_total = store._stored_nbytes([row[0] for row in row_list])
+            store._conn.executemany(
+                'INSERT OR REPLACE INTO patches VALUES (?, ?, ?, ?)', row_list
+            )
+            store._conn.commit()
+            store._total_nbytes += sum(row[2] for row in row_list) - old_total
+            if store._total_nbytes > store.budget_mb * 2.0 ** 20:
+                store.shrink()
+
+    def _stored_nbytes(store, key_list):
+        total = 0
+        for key_chunk in ut.ichunks(list(set(key_list)), _QUERY_CHUNKSIZE):
+            marks = ','.join('?' * len(key_chunk))
+            (nbytes,) = store._conn.execute(
+                'SELECT COALESCE(SUM(nbytes), 0) FROM patches WHERE key IN (%s)'
+                % (marks,),
+                key_chunk,
+            ).fetchone()
+            total += nbytes
+        return total
+
+    def shrink(store, target_frac=0.9):
+        """
+        Evicts the least recently used patches until the store is below
+        target_frac of its budget.
+
+        Returns:
+            int: number of evicted patches
+        """
+        target_nbytes = target_frac * store.budget_mb * 2.0 ** 20
+        num = 0
+        with store._lock:
+            # Other processes may share the store, so start from the truth
+            (store._total_nbytes,) = store._conn.execute(
+                'SELECT COALESCE(SUM(nbytes), 0) FROM patches'
+            ).fetchone()
+            while store._total_nbytes > target_nbytes:
+                rows = store._conn.execute(
+                    'SELECT key, nbytes FROM patches ORDER BY atime LIMIT ?',
+                    (_QUERY_CHUNKSIZE,),
+                ).fetchall()
+                if len(rows) == 0:
+                    break
+                evict_keys = []
+                for key, nbytes in rows:
+                    if store._total_nbytes <= target_nbytes:
+                        break
+                    evict_keys.append(key)
+                    store._total_nbytes -= nbytes
+                marks = ','.join('?' * len(evict_keys))
+                store._conn.execute(
+                    'DELETE FROM patches WHERE key IN (%s)' % (marks,), evict_keys
+                )
+                num += len(evict_keys)
+            store._conn.commit()
+        store.num_evictions += num
+        return num
+
+    def get_warped_patches(store, chip_key, chip, kpts, patch_size, colorspace=None):
+        """
+        Returns the patches of kpts as a contiguous uint8 array, warping and
+        storing only the ones that are not in the store yet.
+
+        Args:
+            chip_key (str): chip UUID (or chip_content_key)
+            chip (ndarray or callable): chip in the requested colorspace, or a
+                function that loads it. It is only loaded on a miss.
+            kpts (ndarray): keypoints
+            patch_size (int): width and height of a patch
+            colorspace (str): colorspace of the chip
+        """
+        import vtool as vt
+
+        if colorspace is None and callable(chip):
+            chip = chip()
+        patch_shape = get_patch_shape(
+            patch_size, colorspace, None if callable(chip) else chip
+        )
+        key_list = make_patch_keys(chip_key, kpts, patch_size, colorspace)
+        patches, ismiss = store.lookup(key_list, patch_shape)
+        if np.any(ismiss):
+            if callable(chip):
+                chip = chip()
+            kpts_miss = np.asarray(kpts).compress(ismiss, axis=0)
+            miss_patches = vt.get_warped_patches(chip, kpts_miss, patch_size=patch_size)[0]
+            patches[ismiss] = miss_patches
+            store.add(ut.compress(key_list, ismiss), patches[ismiss])
+        return patches
+
+    def stats(store):
+        return ut.odict(
+            [
+                ('total_mb', store._total_nbytes / 2.0 ** 20),
+                ('budget_mb', store.budget_mb),
+                ('num_hits', store.num_hits),
+                ('num_misses', store.num_misses),
+                ('num_evictions', store.num_evictions),
+            ]
+        )
+
+    def close(store):
+        with store._lock:
+            if store._conn is not None:
+                store._conn.close()
+                store._conn = None
+
+
+# Stores shared within a process, keyed by directory
+_PATCH_STORES = {}
+
+
+def get_patch_store(dpath=None, budget_mb=None):
+    """ Returns the process-wide store for dpath """
+    key = dpath
+    if key not in _PATCH_STORES:
+        _PATCH_STORES[key] = PatchStore(dpath, budget_mb=budget_mb)
+    return _PATCH_STORES[key]
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.patch_store
+        python -m wbia_cnn.patch_store --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory batch slots for parallel data augmentation.
+
+The parallel augment functions of the Labeler / Classifier models used to send
+every image to a new process pool with ut.util_parallel.generate2 and pickle
+the augmented images back. For 128x128x3 and larger inputs serialization costs
+more than the augmentation itself.
+
+SharedBatchPool preallocates a ring of batch slots in shared memory and forks a
+persistent pool of workers that inherit it. A batch is copied into a slot once,
+the workers augment their share of the slot in place, and the caller gets a
+numpy view of the slot back. Only the (small) labels and the slot coordinates
+cross process boundaries.
+
+CommandLine:
+    python -m wbia_cnn.shared_batch --allexamples
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import multiprocessing
+import numpy as np
+import utool as ut
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+def can_share_batches():
+    """ The workers find the shared slots by inheriting them through a fork """
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+# State of a forked augmentation worker
+_WORKER_STATE = {}
+
+
+def _worker_init(func, buffer_, slots_shape, dtype):
+    try:
+        import cv2
+
+        # The OpenCV thread pool of the parent does not survive the fork
+        cv2.setNumThreads(0)
+    except ImportError:
+        pass
+    slots = np.frombuffer(buffer_, dtype=dtype).reshape(slots_shape)
+    _WORKER_STATE.update(func=func, slots=slots)
+
+
+def _worker_apply(slot_index, start, stop, yb_chunk, seed):
+    import random
+
+    random.seed(seed)
+    np.random.seed(seed)
+    Xb = _WORKER_STATE['slots'][slot_index, start:stop]
+    Xb_, yb_ = _WORKER_STATE['func'](Xb, yb_chunk)
+    if Xb_ is not Xb:
+        Xb[...] = Xb_
+    return yb_
+
+
+@ut.reloadable_class
+class SharedBatchPool(ut.NiceRepr):
+    """
+    Ring of shared-memory batch slots with a pool of workers that apply an
+    in-place batch function to them.
+
+    Args:
+        func (callable): func(Xb, yb) -> (Xb, yb). Xb is a view into a slot
+            and is expected to be modified in place. yb is a list of labels.
+        item_shape (tuple): shape of one item (e.g. (h, w, c))
+        dtype (dtype): item dtype
+        batch_size (int): capacity of a slot
+        num_slots (int): number of slots in the ring. A returned view stays
+            valid until num_slots more batches have been mapped.
+        num_workers (int): number of forked workers (defaults to
+            --augment-workers or at most 4)
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.shared_batch import *  # NOQA
+        >>> def _flip(Xb, yb):
+        >>>     Xb[:] = Xb[:, ::-1]
+        >>>     return Xb, yb
+        >>> batch_pool = SharedBatchPool(_flip, (3,), np.uint8, batch_size=8,
+        >>>                              num_workers=2)
+        >>> Xb = np.arange(15, dtype=np.uint8).reshape(5, 3)
+        >>> Xb_, yb_ = batch_pool.map_inplace(Xb, ['a', 'b', 'c', 'd', 'e'])
+        >>> batch_pool.close()
+        >>> assert np.all(Xb_ == Xb[:, ::-1])
+        >>> assert list(yb_) == ['a', 'b', 'c', 'd', 'e']
+    """
+
+    def __init__(
+        batch_pool,
+        func,
+        item_shape,
+        dtype=np.uint8,
+        batch_size=128,
+        num_slots=2,
+        num_workers=None,
+    ):
+        if num_workers is None:
+            # The workers live as long as the model, keep them few by default
+            default = min(4, multiprocessing.cpu_count())
+            num_workers = ut.get_argval('--augment-workers', type_=int, default=default)
+        batch_pool.func = func
+        batch_pool.item_shape = tuple(item_shape)
+        batch_pool.dtype = np.dtype(dtype)
+        batch_pool.batch_size = batch_size
+        batch_pool.num_slots = num_slots
+        batch_pool.num_workers = max(1, num_workers)
+        batch_pool._next_slot = 0
+        batch_pool._pool = None
+
+        slots_shape = (num_slots, batch_size) + batch_pool.item_shape
+        nbytes = int(np.prod(slots_shape)) * batch_pool.dtype.itemsize
+        ctx = multiprocessing.get_context('fork')
+        batch_pool._buffer = ctx.RawArray('B', nbytes)
+        batch_pool.slots = np.frombuffer(
+            batch_pool._buffer, dtype=batch_pool.dtype
+        ).reshape(slots_shape)
+        # Workers are forked after the buffer exists, so they share it
+        batch_pool._pool = ctx.Pool(
+            batch_pool.num_workers,
+            initializer=_worker_init,
+            initargs=(func, batch_pool._buffer, slots_shape, batch_pool.dtype),
+        )
+
+    def __nice__(batch_pool):
+        return '%s x %d x %r, %d workers' % (
+            batch_pool.num_slots,
+            batch_pool.batch_size,
+            batch_pool.item_shape,
+            batch_pool.num_workers,
+        )
+
+    def fits(batch_pool, Xb):
+        return (
+            len(Xb) <= batch_pool.batch_size
+            and tuple(Xb.shape[1:]) == batch_pool.item_shape
+            and Xb.dtype == batch_pool.dtype
+        )
+
+    def map_inplace(batch_pool, Xb, yb=None):
+        """
+        Copies a batch into the next slot, applies func to it in parallel, and
+        returns a view of the slot with the new labels.
+        """
+        import random
+
+        assert batch_pool.fits(Xb), 'batch does not fit the slots'
+        num = len(Xb)
+        slot_index = batch_pool._next_slot
+        batch_pool._next_slot = (slot_index + 1) % batch_pool.num_slots
+        slot = batch_pool.slots[slot_index, :num]
+        np.copyto(slot, Xb)
+
+        bounds = np.linspace(0, num, batch_pool.num_workers + 1).astype(int)
+        result_list = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if start == stop:
+                continue
+            yb_chunk = None if yb is None else list(yb[start:stop])
+            # Seeds come from the caller's random state, so seeding the
+            # parent makes the augmentation reproducible
+            seed = random.randint(0, 2 ** 31 - 1)
+            args = (slot_index, start, stop, yb_chunk, seed)
+            result_list.append(batch_pool._pool.apply_async(_worker_apply, args))
+        yb_list = [result.get() for result in result_list]
+        if yb is None:
+            yb_ = None
+        else:
+            yb_ = np.array(ut.flatten(yb_list))
+        return slot, yb_
+
+    def close(batch_pool):
+        if batch_pool._pool is not None:
+            batch_pool._pool.terminate()
+            batch_pool._pool.join()
+            batch_pool._pool = None
+
+    def __del__(batch_pool):
+        batch_pool.close()
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.shared_batch
+        python -m wbia_cnn.shared_batch --allexamples
+    """
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    ut.doctest_funcs()
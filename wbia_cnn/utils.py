@@ -748,6 +748,101 @@ def extract_patches_stride(image, patch_size, stride):
     return patch_list, coord_list
 
 
+def _timed_call(func, item):
+    """ Worker side of PrefetchIter, returns the result and the time it took """
+    start = time.time()
+    result = func(item)
+    return result, time.time() - start
+
+
+@ut.reloadable_class
+class PrefetchIter(object):
+    """
+    Lazily maps func over an iterable with a pool of background workers.
+
+    At most ``max_prefetch`` items are in flight at any time. A new item is
+    only submitted once the consumer takes a result, which gives backpressure
+    when the consumer is slower than the workers. Results are yielded in input
+    order.
+
+    Args:
+        func (callable): function applied to every item (must be picklable if
+            use_processes is True)
+        iterable (iterable): input items, consumed lazily
+        num_workers (int): number of worker threads / processes
+        max_prefetch (int): bounded queue depth (defaults to 4 * num_workers)
+        use_processes (bool): use processes instead of threads
+
+    Attributes:
+        work_time (float): summed time spent by the workers inside func
+        wait_time (float): time the consumer spent blocked on results
+        num_items (int): number of yielded results
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.utils import *  # NOQA
+        >>> prefetch_iter = PrefetchIter(np.sqrt, range(10), num_workers=3, max_prefetch=4)
+        >>> result = [float(x) ** 2 for x in prefetch_iter]
+        >>> assert np.allclose(result, list(range(10)))
+        >>> assert prefetch_iter.num_items == 10
+    """
+
+    def __init__(
+        self, func, iterable, num_workers=2, max_prefetch=None, use_processes=False
+    ):
+        if max_prefetch is None:
+            max_prefetch = 4 * num_workers
+        self.func = func
+        self.iterable = iterable
+        self.num_workers = max(1, num_workers)
+        self.max_prefetch = max(1, max_prefetch)
+        self.use_processes = use_processes
+        self.work_time = 0.0
+        self.wait_time = 0.0
+        self.num_items = 0
+
+    def __iter__(self):
+        import collections
+        from concurrent import futures
+        import functools
+
+        if self.use_processes:
+            executor = futures.ProcessPoolExecutor(self.num_workers)
+        else:
+            executor = futures.ThreadPoolExecutor(self.num_workers)
+        timed_func = functools.partial(_timed_call, self.func)
+        pending = collections.deque()
+        item_iter = iter(self.iterable)
+        try:
+            for item in item_iter:
+                pending.append(executor.submit(timed_func, item))
+                if len(pending) >= self.max_prefetch:
+                    break
+            while len(pending) > 0:
+                start = time.time()
+                result, duration = pending.popleft().result()
+                self.wait_time += time.time() - start
+                self.work_time += duration
+                # Refill the queue before handing the result to the consumer
+                for item in item_iter:
+                    pending.append(executor.submit(timed_func, item))
+                    break
+                self.num_items += 1
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def timing_str(self):
+        return 'work=%.2fs (%d workers), consumer wait=%.2fs, n=%d' % (
+            self.work_time,
+            self.num_workers,
+            self.wait_time,
+            self.num_items,
+        )
+
+
 if __name__ == '__main__':
     """
     CommandLine:
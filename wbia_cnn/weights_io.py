@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+Inference-only model weights artifacts.
+
+A model state pickle (see _ModelIO.save_model_state) holds the best and current
+weights, the whole training history, the label encoder and the data params in
+one pickled dict. Inference only needs the best weights and the preprocessing
+parameters, but had to unpickle all of it on every load.
+
+A weights artifact is a single file with a JSON header followed by the raw
+parameter arrays, each aligned to 64 bytes::
+
+    magic (8 bytes) | header length (uint32 LE) | JSON header | arrays ...
+
+The header records the shapes and dtypes of the arrays, the encoder classes,
+the data params and the architecture hash. Loading reads the header and
+memory-maps the arrays, so the weights go straight from the page cache into
+set_all_param_values without a pickle round trip. (An .npz cannot be used for
+this because numpy ignores mmap_mode for zip archives.)
+
+Array-valued data params (e.g. a per-pixel center_mean) are stored as arrays
+and referenced from the header.
+
+CommandLine:
+    python -m wbia_cnn.weights_io --allexamples
+    # Convert model state / legacy weight pickles
+    python -m wbia_cnn.weights_io --convert --fpath=model_state.pkl
+    python -m wbia_cnn.weights_io --convert --fpath=old_weights.pkl --loader=legacy2
+    # Convert the published models in the model cache
+    python -m wbia_cnn.weights_io --convert --models=labeler_v3,background_zebra_plains
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import json
+import struct
+import numpy as np
+import utool as ut
+from os.path import splitext, exists
+
+print, rrr, profile = ut.inject2(__name__)
+
+
+WEIGHTS_EXT = '.weights'
+WEIGHTS_FORMAT = 'wbia_cnn.weights'
+WEIGHTS_VERSION = 1
+_MAGIC = b'\x93WBIACNN'
+_ALIGN = 64
+
+
+def get_weights_fpath(fpath):
+    """
+    Returns the artifact path that sits next to a model state / weight pickle
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.weights_io import *  # NOQA
+        >>> print(get_weights_fpath('models/model_state_arch_abc.pkl'))
+        models/model_state_arch_abc.weights
+    """
+    if fpath.endswith(WEIGHTS_EXT):
+        return fpath
+    return splitext(fpath)[0] + WEIGHTS_EXT
+
+
+def _align(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _jsonify(value, array_dict, name):
+    """
+    Converts a value to JSON types. Arrays are moved into array_dict and
+    replaced by a reference.
+    """
+    if isinstance(value, np.ndarray):
+        array_dict[name] = value
+        return {'__array__': name}
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, dict):
+        return {
+            str(key): _jsonify(val, array_dict, name + '/' + str(key))
+            for key, val in value.items()
+        }
+    elif isinstance(value, (list, tuple)):
+        return [
+            _jsonify(val, array_dict, name + '/%d' % (count,))
+            for count, val in enumerate(value)
+        ]
+    return value
+
+
+def _unjsonify(value, array_dict):
+    if isinstance(value, dict):
+        if list(value.keys()) == ['__array__']:
+            # Small arrays are copied so they can be modified in place
+            return np.array(array_dict[value['__array__']])
+        return {key: _unjsonify(val, array_dict) for key, val in value.items()}
+    elif isinstance(value, list):
+        return [_unjsonify(val, array_dict) for val in value]
+    return value
+
+
+def _encoder_classes(encoder):
+    if encoder is None:
+        return None
+    classes_ = getattr(encoder, 'classes_', None)
+    if classes_ is None:
+        print(
+            '[weights_io] WARNING: cannot store encoder of type %r'
+            % (type(encoder).__name__,)
+        )
+        return None
+    return np.asarray(classes_).tolist()
+
+
+def _make_encoder(encoder_classes):
+    if encoder_classes is None:
+        return None
+    import sklearn.preprocessing
+
+    encoder = sklearn.preprocessing.LabelEncoder()
+    encoder.classes_ = np.array(encoder_classes)
+    return encoder
+
+
+def save_weights(
+    fpath,
+    weights_list,
+    data_params=None,
+    encoder=None,
+    input_shape=None,
+    output_dims=None,
+    arch_hashid=None,
+    **info
+):
+    """
+    Writes a weights artifact.
+
+    Args:
+        fpath (str): output path
+        weights_list (list): parameter values in get_all_param_values order
+        data_params (dict): preprocessing parameters
+        encoder (LabelEncoder): label encoder (only its classes are stored)
+        input_shape (tuple): theano input shape
+        output_dims (int): number of outputs
+        arch_hashid (str): architecture hash of the model
+        **info: additional JSON-serializable header entries
+
+    Returns:
+        str: fpath
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from wbia_cnn.weights_io import *  # NOQA
+        >>> dpath = ut.ensure_app_resource_dir('wbia_cnn', 'test_weights_io')
+        >>> fpath = ut.unixjoin(dpath, 'test.weights')
+        >>> weights_list = [np.random.rand(3, 2, 5, 5).astype(np.float32),
+        >>>                 np.arange(3, dtype=np.float32)]
+        >>> data_params = {'center_mean': np.full((4, 4, 1), 3.0), 'center_std': 255}
+        >>> save_weights(fpath, weights_list, data_params, arch_hashid='abc',
+        >>>              input_shape=(None, 1, 4, 4), output_dims=3)
+        >>> artifact = load_weights(fpath)
+        >>> assert isinstance(artifact['weights'][0], np.memmap)
+        >>> assert all(np.all(w1 == w2) for w1, w2 in zip(weights_list, artifact['weights']))
+        >>> assert np.all(artifact['data_params']['center_mean'] == 3.0)
+        >>> result = ut.repr2(ut.dict_subset(artifact, ['arch_hashid', 'input_shape', 'output_dims']))
+        >>> print(result)
+        {'arch_hashid': 'abc', 'input_shape': [None, 1, 4, 4], 'output_dims': 3}
+    """
+    array_dict = ut.odict()
+    param_names = []
+    for count, weights in enumerate(weights_list):
+        name = 'param/%03d' % (count,)
+        array_dict[name] = np.asarray(weights)
+        param_names.append(name)
+    data_params_ = _jsonify(data_params, array_dict, 'data_params')
+    output_dims_ = _jsonify(output_dims, array_dict, 'output_dims')
+    info_ = _jsonify(info, array_dict, 'info')
+
+    array_infos = []
+    offset = 0
+    for name, arr in array_dict.items():
+        assert arr.dtype != object, 'cannot store object array %r' % (name,)
+        offset = _align(offset)
+        array_infos.append(
+            {
+                'name': name,
+                'dtype': arr.dtype.str,
+                'shape': list(arr.shape),
+                'offset': offset,
+            }
+        )
+        offset += arr.nbytes
+
+    header = ut.odict(
+        [
+            ('format', WEIGHTS_FORMAT),
+            ('version', WEIGHTS_VERSION),
+            ('arch_hashid', arch_hashid),
+            ('input_shape', None if input_shape is None else list(input_shape)),
+            ('output_dims', output_dims_),
+            ('encoder_classes', _encoder_classes(encoder)),
+            ('data_params', data_params_),
+            ('params', param_names),
+            ('arrays', array_infos),
+        ]
+    )
+    header.update(info_)
+    header_bytes = json.dumps(header, default=str).encode('utf8')
+    # Pad the header so the array data starts aligned
+    prefix_nbytes = len(_MAGIC) + 4
+    data_start = _align(prefix_nbytes + len(header_bytes))
+    header_bytes += b' ' * (data_start - prefix_nbytes - len(header_bytes))
+
+    # Write to a temporary file first so readers never see partial data
+    tmp_fpath = fpath + '.tmp%d' % (os.getpid(),)
+    with open(tmp_fpath, 'wb') as file_:
+        file_.write(_MAGIC)
+        file_.write(struct.pack('<I', len(header_bytes)))
+        file_.write(header_bytes)
+        for info_, arr in zip(array_infos, array_dict.values()):
+            file_.seek(data_start + info_['offset'])
+            file_.write(np.ascontiguousarray(arr).tobytes())
+    os.rename(tmp_fpath, fpath)
+    return fpath
+
+
+def read_weights_header(fpath):
+    """
+    Returns:
+        tuple: (header, data_start)
+    """
+    with open(fpath, 'rb') as file_:
+        magic = file_.read(len(_MAGIC))
+        if magic != _MAGIC:
+            raise IOError('%r is not a weights artifact' % (fpath,))
+        (header_nbytes,) = struct.unpack('<I', file_.read(4))
+        header = json.loads(file_.read(header_nbytes).decode('utf8'))
+    if header.get('version', None) != WEIGHTS_VERSION:
+        raise IOError(
+            'unsupported weights artifact version %r in %r'
+            % (header.get('version', None), fpath)
+        )
+    data_start = len(_MAGIC) + 4 + header_nbytes
+    return header, data_start
+
+
+def load_weights(fpath, mmap=True):
+    """
+    Reads a weights artifact.
+
+    Args:
+        fpath (str): path to the artifact
+        mmap (bool): if True the weights are read-only memory maps of the
+            file, otherwise they are read into memory.
+
+    Returns:
+        dict: the header entries with 'weights' (list of arrays),
+            'data_params' (dict) and 'encoder' (LabelEncoder or None)
+    """
+    header, data_start = read_weights_header(fpath)
+    array_dict = {}
+    if header['arrays']:
+        if mmap:
+            buf = np.memmap(fpath, dtype=np.uint8, mode='r', offset=data_start)
+        else:
+            with open(fpath, 'rb') as file_:
+                file_.seek(data_start)
+                buf = np.frombuffer(file_.read(), dtype=np.uint8)
+        for info in header['arrays']:
+            dtype = np.dtype(info['dtype'])
+            count = int(np.prod(info['shape']))
+            arr = buf[info['offset'] : info['offset'] + count * dtype.itemsize]
+            array_dict[info['name']] = arr.view(dtype).reshape(info['shape'])
+    artifact = _unjsonify(header, array_dict)
+    artifact['weights'] = [array_dict[name] for name in header['params']]
+    if artifact['encoder_classes'] is not None:
+        artifact['encoder'] = _make_encoder(artifact['encoder_classes'])
+    else:
+        artifact['encoder'] = None
+    return artifact
+
+
+def _state_to_weights_kw(model_state):
+    """ Maps a model state pickle to save_weights arguments """
+    if 'preproc_kw' in model_state:
+        data_params = model_state['preproc_kw']
+    else:
+        data_params = model_state['data_params']
+    best_results = model_state['best_results']
+    if 'weights' in best_results:
+        weights_list = best_results['weights']
+    else:
+        weights_list = model_state['best_weights']
+    weights_kw = {
+        'weights_list': weights_list,
+        'data_params': data_params,
+        'encoder': model_state.get('encoder', None),
+        'input_shape': model_state['input_shape'],
+        'output_dims': model_state['output_dims'],
+        'best_results': ut.dict_subset(
+            best_results, [key for key in best_results if key != 'weights']
+        ),
+    }
+    if model_state.get('category_list', None) is not None:
+        weights_kw['category_list'] = list(model_state['category_list'])
+    return weights_kw
+
+
+def _legacy_to_weights_kw(oldkw):
+    """ Mirrors _ModelLegacy.load_old_weights_kw """
+    data_shape = oldkw['model_shape'][1:]
+    input_shape = (None, data_shape[2], data_shape[0], data_shape[1])
+    return {
+        'weights_list': oldkw['best_weights'],
+        'data_params': {
+            'center_mean': oldkw['center_mean'],
+            'center_std': oldkw['center_std'],
+        },
+        'encoder': oldkw.get('encoder', None),
+        'input_shape': input_shape,
+        'output_dims': oldkw['output_dims'],
+        'best_results': {
+            'epoch': oldkw['best_epoch'],
+            'test_accuracy': oldkw['best_test_accuracy'],
+            'learn_loss': oldkw['best_learn_loss'],
+            'valid_accuracy': oldkw['best_valid_accuracy'],
+            'valid_loss': oldkw['best_valid_loss'],
+        },
+    }
+
+
+def _legacy2_to_weights_kw(oldkw):
+    """ Mirrors _ModelLegacy.load_old_weights_kw2 """
+    return {
+        'weights_list': oldkw['best_fit_weights'],
+        'data_params': {
+            'center_mean': oldkw['data_whiten_mean'],
+            'center_std': oldkw['data_whiten_std'],
+        },
+        'encoder': oldkw.get('data_label_encoder', None),
+        'output_dims': oldkw['best_weights'][-1].shape[0],
+        'best_results': {
+            'epoch': oldkw['best_epoch'],
+            'test_accuracy': oldkw['best_valid_accuracy'],
+            'learn_loss': oldkw['best_train_loss'],
+            'valid_accuracy': oldkw['best_valid_accuracy'],
+            'valid_loss': oldkw['best_valid_loss'],
+        },
+        'batch_size': oldkw['train_batch_size'],
+    }
+
+
+def convert_to_weights(fpath, weights_fpath=None, loader='state', arch_hashid=None):
+    """
+    Converts a model state pickle, or a legacy weights pickle, into a weights
+    artifact.
+
+    The center mean / std are stored as found. Like the pickle loaders,
+    load_model_weights applies _fix_center_mean_std to old 0-255 params.
+
+    Args:
+        fpath (str): path to the pickle
+        weights_fpath (str): output path. Defaults to the pickle path with the
+            WEIGHTS_EXT extension, which is where the plugin looks for it.
+        loader (str): 'state', 'legacy' or 'legacy2' (see
+            _plugin_registry.load_plugin_model)
+        arch_hashid (str): architecture hash to record (optional)
+
+    Returns:
+        str: weights_fpath
+    """
+    if weights_fpath is None:
+        weights_fpath = get_weights_fpath(fpath)
+    print('[weights_io] converting %s (%s)' % (fpath, loader))
+    if loader == 'state':
+        from wbia_cnn import checkpoint_writer
+
+        model_state = checkpoint_writer.resolve_model_state(ut.load_cPkl(fpath), fpath)
+        weights_kw = _state_to_weights_kw(model_state)
+    elif loader == 'legacy':
+        weights_kw = _legacy_to_weights_kw(ut.load_cPkl(fpath))
+    elif loader == 'legacy2':
+        weights_kw = _legacy2_to_weights_kw(ut.load_cPkl(fpath, n=None))
+    else:
+        raise ValueError('Unknown weight loader %r' % (loader,))
+    weights_kw['source_loader'] = loader
+    save_weights(weights_fpath, arch_hashid=arch_hashid, **weights_kw)
+    print('[weights_io] wrote %s' % (weights_fpath,))
+    return weights_fpath
+
+
+def convert_published_models(model_tag_list=None, overwrite=False):
+    """
+    Writes weights artifacts next to the downloaded published models, where
+    _plugin_registry.load_plugin_model picks them up.
+
+    CommandLine:
+        python -m wbia_cnn.weights_io --exec-convert_published_models --models=labeler_v3
+
+    Example:
+        >>> # DISABLE_DOCTEST
+        >>> from wbia_cnn.weights_io import *  # NOQA
+        >>> model_tag_list = ut.get_argval('--models', type_=list, default=['labeler_v3'])
+        >>> convert_published_models(model_tag_list)
+    """
+    from wbia_cnn import _plugin_grabmodels as grabmodels
+
+    if model_tag_list is None:
+        model_tag_list = sorted(grabmodels.MODEL_URLS.keys())
+    weights_fpath_list = []
+    for model_tag in model_tag_list:
+        try:
+            spec = grabmodels.get_model_spec(model_tag)
+        except ValueError:
+            # Pretrained weight slices are not complete networks
+            print('[weights_io] skipping %r' % (model_tag,))
+            continue
+        fpath = grabmodels.ensure_model(model_tag, redownload=False)
+        weights_fpath = get_weights_fpath(fpath)
+        if overwrite or not exists(weights_fpath):
+            convert_to_weights(fpath, weights_fpath, loader=spec['loader'])
+        weights_fpath_list.append(weights_fpath)
+    return weights_fpath_list
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m wbia_cnn.weights_io
+        python -m wbia_cnn.weights_io --allexamples
+    """
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # for win32
+    import utool as ut  # NOQA
+
+    if ut.get_argflag('--convert'):
+        fpath = ut.get_argval('--fpath', type_=str, default=None)
+        if fpath is not None:
+            convert_to_weights(
+                fpath,
+                weights_fpath=ut.get_argval('--out', type_=str, default=None),
+                loader=ut.get_argval('--loader', type_=str, default='state'),
+            )
+        else:
+            convert_published_models(
+                ut.get_argval('--models', type_=list, default=None),
+                overwrite=ut.get_argflag('--overwrite'),
+            )
+    else:
+        ut.doctest_funcs()